@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class AppsConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'apps'
+
+    def ready(self):
+        # Registra os signals de invalidação de versões/caches
+        from . import signals  # noqa: F401
@@ -1,15 +1,36 @@
+import asyncio
 import json
+from datetime import datetime
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.utils import timezone
 from django.contrib.auth.models import User
 from .models import Trem, NotificacaoUsuario, PreferenciasUsuario
+from cptm_tracker.services.replay import replay_service
 
 class TremConsumer(AsyncWebsocketConsumer):
+    # Intervalo mínimo entre envios ao cliente; atualizações que chegam nesse
+    # meio tempo são conflacionadas (fica só o estado mais recente de cada trem)
+    INTERVALO_MINIMO_ENVIO = 0.5
+
+    # Replay: janela máxima, velocidade máxima e trecho do histórico lido por vez
+    REPLAY_DURACAO_MAXIMA = 6 * 60 * 60
+    REPLAY_VELOCIDADE_MAXIMA = 600
+    REPLAY_JANELA_LEITURA = 5 * 60
+
     async def connect(self):
+        self._pendentes = {}
+        self._removidos = set()
+        self._versao = 0
+        self._envio = None
+        self._replay = None
         await self.channel_layer.group_add("trens_real_time", self.channel_name)
         await self.accept()
 
     async def disconnect(self, close_code):
+        if self._envio and not self._envio.done():
+            self._envio.cancel()
+        self._parar_replay()
         await self.channel_layer.group_discard("trens_real_time", self.channel_name)
 
     async def receive(self, text_data):
@@ -22,6 +43,10 @@ class TremConsumer(AsyncWebsocketConsumer):
         elif message_type == 'unsubscribe_linha':
             linha_id = text_data_json.get('linha_id')
             await self.channel_layer.group_discard(f"linha_{linha_id}", self.channel_name)
+        elif message_type == 'iniciar_replay':
+            await self._iniciar_replay(text_data_json)
+        elif message_type == 'parar_replay':
+            self._parar_replay()
 
     async def trem_update(self, event):
         await self.send(text_data=json.dumps({
@@ -35,6 +60,116 @@ class TremConsumer(AsyncWebsocketConsumer):
             'data': event['data']
         }))
 
+    async def linha_trens(self, event):
+        """Lote de trens alterados de uma linha (um por ciclo do atualizador)"""
+        if self._replay is not None:
+            return  # em replay; o cliente ressincroniza por /api/trens/ ao final
+        data = event['data']
+        for trem in data['trens']:
+            self._pendentes[trem['id']] = trem
+            self._removidos.discard(trem['id'])
+        for trem_id in data['removidos']:
+            self._pendentes.pop(trem_id, None)
+            self._removidos.add(trem_id)
+        self._versao = max(self._versao, data['versao'])
+
+        if self._envio is None or self._envio.done():
+            self._envio = asyncio.ensure_future(self._descarregar())
+
+    async def _descarregar(self):
+        """Envia o estado pendente; o que chegar durante o envio vai no próximo"""
+        while self._pendentes or self._removidos:
+            trens, self._pendentes = list(self._pendentes.values()), {}
+            removidos, self._removidos = sorted(self._removidos), set()
+            await self.send(text_data=json.dumps({
+                'type': 'trens_update',
+                'data': {
+                    'versao': self._versao,
+                    'trens': trens,
+                    'removidos': removidos
+                }
+            }))
+            await asyncio.sleep(self.INTERVALO_MINIMO_ENVIO)
+
+    async def _iniciar_replay(self, pedido):
+        """Reproduz uma janela do histórico ({'inicio', 'fim', 'velocidade'}, epoch ou ISO 8601)"""
+        try:
+            inicio = self._ler_instante(pedido['inicio'])
+            fim = self._ler_instante(pedido['fim'])
+            velocidade = float(pedido.get('velocidade', 1))
+        except (KeyError, TypeError, ValueError):
+            inicio = fim = velocidade = None
+        if (inicio is None or not 0 < fim - inicio <= self.REPLAY_DURACAO_MAXIMA
+                or not 0 < velocidade <= self.REPLAY_VELOCIDADE_MAXIMA):
+            await self.send(text_data=json.dumps({
+                'type': 'replay_erro',
+                'data': {'erro': 'Informe inicio < fim (até 6 h) e velocidade entre 0 e 600'}
+            }))
+            return
+
+        self._parar_replay()
+        self._pendentes, self._removidos = {}, set()
+        self._replay = asyncio.ensure_future(self._reproduzir(inicio, fim, velocidade))
+
+    def _parar_replay(self):
+        if self._replay is not None and not self._replay.done():
+            self._replay.cancel()
+        self._replay = None
+
+    async def _reproduzir(self, inicio, fim, velocidade):
+        """Envia o estado inicial e depois cada ciclo gravado, respeitando o
+        intervalo original entre ciclos dividido por ``velocidade``"""
+        try:
+            snapshot = await database_sync_to_async(replay_service.snapshot_em)(inicio)
+            if snapshot is None:
+                # Janela começa antes das primeiras amostras: parte da frota vazia
+                snapshot = {'trens': [], 'total': 0, 'instante': datetime.fromtimestamp(inicio, tz=timezone.get_current_timezone()).isoformat()}
+            await self.send(text_data=json.dumps({
+                'type': 'replay_inicio',
+                'data': dict(snapshot, velocidade=velocidade)
+            }))
+
+            relogio = asyncio.get_running_loop().time
+            partida = relogio()
+            janela = inicio
+            # Lê a próxima janela do histórico enquanto a atual é reproduzida
+            leitura = asyncio.ensure_future(database_sync_to_async(replay_service.quadros)(
+                janela, min(janela + self.REPLAY_JANELA_LEITURA, fim)))
+            while janela < fim:
+                quadros = await leitura
+                janela = min(janela + self.REPLAY_JANELA_LEITURA, fim)
+                if janela < fim:
+                    leitura = asyncio.ensure_future(database_sync_to_async(replay_service.quadros)(
+                        janela, min(janela + self.REPLAY_JANELA_LEITURA, fim)))
+                for quadro in quadros:
+                    espera = partida + (quadro['t'] - inicio) / velocidade - relogio()
+                    if espera > 0:
+                        await asyncio.sleep(espera)
+                    await self.send(text_data=json.dumps({
+                        'type': 'replay_quadro',
+                        'data': {
+                            'instante': quadro['instante'],
+                            'trens': quadro['trens'],
+                            'removidos': quadro['removidos']
+                        }
+                    }))
+
+            await self.send(text_data=json.dumps({'type': 'replay_fim', 'data': {}}))
+        finally:
+            if self._replay is asyncio.current_task():
+                self._replay = None
+
+    @staticmethod
+    def _ler_instante(valor):
+        """Epoch em segundos a partir de número ou ISO 8601 (sem fuso: horário local)"""
+        try:
+            return float(valor)
+        except ValueError:
+            instante = datetime.fromisoformat(valor)
+        if timezone.is_naive(instante):
+            instante = timezone.make_aware(instante)
+        return instante.timestamp()
+
 class NotificacaoConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.user = self.scope["user"]
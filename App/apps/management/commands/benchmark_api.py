@@ -0,0 +1,498 @@
+"""
+Management command de teste de carga das APIs HTTP e dos WebSockets
+
+Popula um banco temporário numa escala configurável (com semente fixa),
+sobe o servidor ASGI (daphne) com o atualizador de posições rodando, mede
+latência e vazão de clientes concorrentes e compara o relatório (JSON) com
+a linha de base versionada em ``benchmarks/baseline.json``.
+"""
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+import requests
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from apps.models import Linha, Estacao, PreferenciasUsuario
+from apps.management.commands.benchmark_sqlite import percentis
+from cptm_tracker.services.cptm_api import cptm_service
+from cptm_tracker.services.estacoes import estacoes_service
+from cptm_tracker.services.historico_posicoes import historico_posicoes
+from cptm_tracker.services.ingestao import ingerir_posicoes
+from cptm_tracker.services.simulador import SimuladorFrota
+
+BASELINE_PADRAO = os.path.join(settings.BASE_DIR, 'benchmarks', 'baseline.json')
+RESULTADOS_PADRAO = os.path.join(settings.BASE_DIR, 'benchmarks', 'resultados')
+
+# Centro do mapa (Sé) e espaçamento entre estações sintéticas (~2 km)
+CENTRO = (-23.5505, -46.6333)
+ESPACAMENTO_GRAUS = 0.018
+
+# Métricas comparadas com a linha de base: (caminho no relatório, maior é melhor)
+METRICAS_COMPARADAS = (
+    ('p95', False),
+    ('por_segundo', True),
+)
+METRICAS_WEBSOCKET = (
+    ('conexao.p95', False),
+    ('atraso.p95', False),
+    ('mensagens_por_segundo', True),
+)
+
+
+class Command(BaseCommand):
+    help = 'Teste de carga reproduzível de /api/trens/, /api/estacoes/, previsões e WebSockets, com relatório JSON'
+
+    def add_arguments(self, parser):
+        escala = parser.add_argument_group('escala dos dados (banco temporário, semente fixa)')
+        escala.add_argument('--linhas', type=int, default=7)
+        escala.add_argument('--estacoes-por-linha', type=int, default=20)
+        escala.add_argument('--trens', type=int, default=350, help='Total, dividido igualmente entre as linhas')
+        escala.add_argument('--usuarios', type=int, default=200)
+        escala.add_argument('--semente', type=int, default=42)
+
+        carga = parser.add_argument_group('carga')
+        carga.add_argument('--duracao', type=float, default=20.0, help='Segundos de medição')
+        carga.add_argument('--aquecimento', type=float, default=3.0, help='Segundos descartados no início')
+        carga.add_argument('--clientes', type=int, default=8, help='Clientes HTTP consultando em laço')
+        carga.add_argument('--websockets', type=int, default=50, help='Assinantes de ws/trens/')
+        carga.add_argument('--intervalo', type=float, default=2.0, help='Segundos entre ciclos do atualizador')
+        carga.add_argument('--url', help='Servidor já em execução (não popula nem sobe servidor)')
+
+        relatorio = parser.add_argument_group('relatório')
+        relatorio.add_argument('--saida', help='Arquivo JSON do relatório (padrão: benchmarks/resultados/<data>.json)')
+        relatorio.add_argument('--baseline', default=BASELINE_PADRAO, help='Linha de base para comparação')
+        relatorio.add_argument('--tolerancia', type=float, default=0.25,
+                               help='Piora relativa aceita antes de acusar regressão (0.25 = 25%%)')
+        relatorio.add_argument('--salvar-baseline', action='store_true', help='Grava o relatório como nova linha de base')
+
+        # Uso interno: processo do servidor
+        parser.add_argument('--servir', action='store_true', help='(interno) executa o servidor ASGI do benchmark')
+        parser.add_argument('--banco', help='(interno) banco do servidor')
+        parser.add_argument('--porta', type=int, default=0, help='(interno) porta do servidor')
+
+    def handle(self, *args, **options):
+        if options['servir']:
+            return servir(options)
+
+        configuracao = {
+            campo: options[campo] for campo in (
+                'linhas', 'estacoes_por_linha', 'trens', 'usuarios', 'semente',
+                'duracao', 'aquecimento', 'clientes', 'websockets', 'intervalo'
+            )
+        }
+        diretorio = tempfile.mkdtemp(prefix='benchmark_api_')
+        servidor = None
+        try:
+            if options['url']:
+                url = options['url'].rstrip('/')
+                estacoes = list(Estacao.objects.values_list('id', flat=True))
+                linhas = list(Linha.objects.values_list('numero', flat=True))
+            else:
+                estacoes, linhas = self.preparar_banco(diretorio, configuracao)
+                servidor, url = self.iniciar_servidor(diretorio, configuracao)
+            resultado = medir(url, estacoes, linhas, configuracao)
+        finally:
+            if servidor is not None:
+                servidor.terminate()
+                try:
+                    servidor.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    servidor.kill()
+            connections.close_all()
+            shutil.rmtree(diretorio, ignore_errors=True)
+
+        relatorio = {
+            'gerado_em': datetime.now().isoformat(timespec='seconds'),
+            'ambiente': {
+                'python': platform.python_version(),
+                'plataforma': platform.platform(),
+                'cpus': os.cpu_count(),
+            },
+            'configuracao': configuracao,
+            **resultado
+        }
+        self.salvar(relatorio, options)
+        self.comparar(relatorio, options)
+
+    # --- Dados e servidor ----------------------------------------------------
+
+    def preparar_banco(self, diretorio, configuracao):
+        """Cria um banco novo no diretório temporário e o popula na escala pedida"""
+        config = connections.settings['default']
+        connections.close_all()
+        config['NAME'] = os.path.join(diretorio, 'benchmark.sqlite3')
+        historico_posicoes.diretorio = os.path.join(diretorio, 'posicoes')
+        call_command('migrate', verbosity=0)
+
+        inicio = time.perf_counter()
+        estacoes, linhas = popular(configuracao)
+        self.stdout.write(
+            f"Banco populado em {time.perf_counter() - inicio:.1f} s: {len(linhas)} linhas, "
+            f"{len(estacoes)} estações, {configuracao['trens']} trens, {configuracao['usuarios']} usuários"
+        )
+        connections.close_all()
+        return estacoes, linhas
+
+    def iniciar_servidor(self, diretorio, configuracao):
+        """Sobe ``benchmark_api --servir`` num processo à parte e espera ele responder"""
+        with socket.socket() as livre:
+            livre.bind(('127.0.0.1', 0))
+            porta = livre.getsockname()[1]
+
+        ambiente = dict(
+            os.environ,
+            DEBUG='False',
+            CACHE_DIR=os.path.join(diretorio, 'cache'),
+            HISTORICO_POSICOES_DIR=os.path.join(diretorio, 'posicoes'),
+            FROTA_COMPARTILHADA_PATH=os.path.join(diretorio, 'frota.mmap'),
+        )
+        comando = [
+            sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'), 'benchmark_api', '--servir', '--skip-checks',
+            '--banco', os.path.join(diretorio, 'benchmark.sqlite3'), '--porta', str(porta),
+            '--linhas', str(configuracao['linhas']), '--trens', str(configuracao['trens']),
+            '--semente', str(configuracao['semente']), '--intervalo', str(configuracao['intervalo']),
+        ]
+        servidor = subprocess.Popen(comando, env=ambiente, stdout=subprocess.DEVNULL)
+        url = f'http://127.0.0.1:{porta}'
+
+        limite = time.monotonic() + 60
+        while time.monotonic() < limite:
+            if servidor.poll() is not None:
+                raise CommandError(f'O servidor do benchmark terminou com código {servidor.returncode}')
+            try:
+                if requests.get(f'{url}/api/trens/', timeout=2).status_code == 200:
+                    return servidor, url
+            except requests.RequestException:
+                pass
+            time.sleep(0.2)
+        servidor.kill()
+        raise CommandError('O servidor do benchmark não respondeu em 60 s')
+
+    # --- Relatório -----------------------------------------------------------
+
+    def salvar(self, relatorio, options):
+        saida = options['saida'] or os.path.join(
+            RESULTADOS_PADRAO, f"benchmark-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+        os.makedirs(os.path.dirname(os.path.abspath(saida)), exist_ok=True)
+        with open(saida, 'w', encoding='utf-8') as arquivo:
+            json.dump(relatorio, arquivo, indent=2, ensure_ascii=False)
+        self.stdout.write(self.style.SUCCESS(f'Relatório gravado em {saida}'))
+
+        for nome, metricas in relatorio['http'].items():
+            self.stdout.write(
+                f"{nome:>10}: {metricas['total']} requisições ({metricas['por_segundo']:.1f}/s), "
+                f"{metricas['erros']} erros - p50 {metricas['p50']:.1f} ms, p95 {metricas['p95']:.1f} ms, "
+                f"p99 {metricas['p99']:.1f} ms"
+            )
+        ws = relatorio['websocket']
+        self.stdout.write(
+            f"websocket: {ws['conectados']}/{ws['conexoes']} conectados, {ws['mensagens']} mensagens "
+            f"({ws['mensagens_por_segundo']:.1f}/s) - conexão p95 {ws['conexao']['p95']:.1f} ms, "
+            f"atraso p50 {ws['atraso']['p50']:.1f} ms, p95 {ws['atraso']['p95']:.1f} ms"
+        )
+
+        if options['salvar_baseline']:
+            os.makedirs(os.path.dirname(os.path.abspath(options['baseline'])), exist_ok=True)
+            with open(options['baseline'], 'w', encoding='utf-8') as arquivo:
+                json.dump(relatorio, arquivo, indent=2, ensure_ascii=False)
+                arquivo.write('\n')
+            self.stdout.write(self.style.SUCCESS(f"Linha de base atualizada: {options['baseline']}"))
+
+    def comparar(self, relatorio, options):
+        """Compara com a linha de base; piora acima da tolerância é erro (para uso em CI)"""
+        if options['salvar_baseline'] or not os.path.exists(options['baseline']):
+            return
+        with open(options['baseline'], encoding='utf-8') as arquivo:
+            baseline = json.load(arquivo)
+        if baseline.get('configuracao') != relatorio['configuracao']:
+            self.stdout.write(self.style.WARNING(
+                'Configuração diferente da linha de base: a comparação é só indicativa'))
+
+        regressoes = []
+        self.stdout.write(f"\nComparação com {options['baseline']} (tolerância {options['tolerancia']:.0%}):")
+        for nome, metrica, antes, depois, variacao, piorou in diferencas(
+                baseline, relatorio, options['tolerancia']):
+            marca = self.style.ERROR('REGRESSÃO') if piorou else 'ok'
+            self.stdout.write(f"  {nome}.{metrica}: {antes:.1f} -> {depois:.1f} ({variacao:+.0%}) {marca}")
+            if piorou:
+                regressoes.append(f'{nome}.{metrica}')
+        if regressoes:
+            raise CommandError(f"Regressão de desempenho em: {', '.join(regressoes)}")
+
+
+def diferencas(baseline, atual, tolerancia):
+    """(grupo, métrica, antes, depois, variação relativa, piorou?) das métricas comparáveis"""
+    pares = [
+        (nome, metricas, baseline.get('http', {}).get(nome), METRICAS_COMPARADAS)
+        for nome, metricas in atual['http'].items()
+    ]
+    pares.append(('websocket', atual['websocket'], baseline.get('websocket'), METRICAS_WEBSOCKET))
+
+    for nome, metricas, referencia, comparadas in pares:
+        if not referencia:
+            continue
+        for caminho, maior_melhor in comparadas:
+            antes, depois = _valor(referencia, caminho), _valor(metricas, caminho)
+            if antes is None or depois is None or not antes:
+                continue
+            variacao = (depois - antes) / antes
+            piorou = -variacao > tolerancia if maior_melhor else variacao > tolerancia
+            yield nome, caminho, antes, depois, variacao, piorou
+
+
+def _valor(metricas, caminho):
+    for parte in caminho.split('.'):
+        if not isinstance(metricas, dict):
+            return None
+        metricas = metricas.get(parte)
+    return metricas
+
+
+# --- Dados -------------------------------------------------------------------
+
+def popular(configuracao):
+    """Linhas, estações, trens e usuários determinísticos para a semente dada.
+
+    As primeiras linhas usam nomes e estações reais da CPTM; as demais e as
+    estações que faltarem são sintéticas, em raios a partir do centro. Os
+    trens são criados pelo próprio simulador e pela ingestão, como em produção.
+    """
+    aleatorio = random.Random(configuracao['semente'])
+    reais = list(cptm_service.linhas_cptm.items())
+    cores = [cor for cor, _ in Linha.CORES_CHOICES]
+
+    linhas = []
+    nomes_estacoes = {}
+    for i in range(configuracao['linhas']):
+        if i < len(reais):
+            numero, dados = reais[i]
+            linhas.append(Linha(numero=numero, nome=dados['nome'], cor=dados['cor'], codigo=f'LIN{numero}'))
+            nomes_estacoes[numero] = dados['estacoes']
+        else:
+            numero = str(100 + i)
+            linhas.append(Linha(numero=numero, nome=f'Linha {numero}', cor=cores[i % len(cores)],
+                                codigo=f'LIN{numero}'))
+            nomes_estacoes[numero] = []
+    Linha.objects.bulk_create(linhas)
+    linhas = list(Linha.objects.order_by('id'))
+
+    estacoes = []
+    for i, linha in enumerate(linhas):
+        angulo = 2 * math.pi * i / len(linhas)
+        nomes = nomes_estacoes[linha.numero]
+        for ordem in range(configuracao['estacoes_por_linha']):
+            raio = ESPACAMENTO_GRAUS * (ordem + 1)
+            estacoes.append(Estacao(
+                nome=nomes[ordem] if ordem < len(nomes) else f'{linha.nome} {ordem + 1}',
+                linha=linha,
+                latitude=CENTRO[0] + raio * math.sin(angulo) + aleatorio.uniform(-0.002, 0.002),
+                longitude=CENTRO[1] + raio * math.cos(angulo) + aleatorio.uniform(-0.002, 0.002),
+                codigo=f'E{linha.numero}{ordem:04d}'[:10],
+                ordem=ordem + 1,
+                tem_elevador=aleatorio.random() < 0.5,
+                tem_escada_rolante=aleatorio.random() < 0.5,
+                acessivel=aleatorio.random() < 0.7,
+            ))
+    Estacao.objects.bulk_create(estacoes, batch_size=500)
+    estacoes_service.invalidar()
+    ids_estacoes = list(Estacao.objects.values_list('id', flat=True))
+
+    simulador = SimuladorFrota(
+        trens_por_linha=max(1, configuracao['trens'] // max(1, len(linhas))), semente=configuracao['semente'])
+    trens = simulador.avancar(0).trens_por_linha()
+    ingerir_posicoes([(linha, trens.get(linha.numero, [])) for linha in linhas])
+
+    User.objects.bulk_create(
+        [User(username=f'benchmark{i:06d}') for i in range(configuracao['usuarios'])], batch_size=500)
+    PreferenciasUsuario.objects.bulk_create(
+        [PreferenciasUsuario(usuario=usuario) for usuario in User.objects.order_by('id')], batch_size=500)
+    preferencias = list(PreferenciasUsuario.objects.order_by('id'))
+    Favorita = PreferenciasUsuario.estacoes_favoritas.through
+    Favorita.objects.bulk_create([
+        Favorita(preferenciasusuario_id=preferencia.id, estacao_id=estacao_id)
+        for preferencia in preferencias
+        for estacao_id in aleatorio.sample(ids_estacoes, min(len(ids_estacoes), aleatorio.randint(1, 3)))
+    ], batch_size=500)
+
+    return ids_estacoes, [linha.numero for linha in linhas]
+
+
+# --- Servidor ----------------------------------------------------------------
+
+def servir(options):
+    """Servidor ASGI (daphne) com o atualizador de posições no mesmo processo.
+
+    Com o channel layer em memória, só o próprio processo alcança os
+    WebSockets: o atualizador roda numa thread, com o simulador vetorizado,
+    a ingestão pela fila de escrita e a publicação do snapshot e dos deltas.
+    """
+    try:
+        from daphne.cli import CommandLineInterface
+    except ImportError:
+        raise CommandError('O benchmark precisa do daphne: pip install -r test_requirements.txt')
+    from channels.layers import get_channel_layer
+    from cptm_tracker.services.escrita import fila_escrita
+    from cptm_tracker.services.frota import frota_service
+
+    connections.close_all()
+    connections.settings['default']['NAME'] = options['banco']
+    linhas = {linha.numero: linha for linha in Linha.objects.all()}
+    simulador = SimuladorFrota(
+        trens_por_linha=max(1, options['trens'] // max(1, len(linhas))), semente=options['semente'])
+    simulador.avancar(0)
+
+    def atualizar():
+        channel_layer = get_channel_layer()
+        while True:
+            try:
+                trens = simulador.avancar(options['intervalo']).trens_por_linha()
+                fila_escrita.executar(ingerir_posicoes, [
+                    (linhas[numero], dados) for numero, dados in trens.items() if numero in linhas
+                ], chave='posicoes')
+                frota_service.publicar_do_banco()
+                frota_service.transmitir(channel_layer)
+            except Exception as e:
+                print(f"Erro no atualizador do benchmark: {e}")
+            time.sleep(options['intervalo'])
+
+    threading.Thread(target=atualizar, name='benchmark-atualizador', daemon=True).start()
+    CommandLineInterface().run([
+        '-b', '127.0.0.1', '-p', str(options['porta']), '-v', '0', 'cptm_tracker.asgi:application'
+    ])
+
+
+# --- Carga -------------------------------------------------------------------
+
+def medir(url, estacoes, linhas, configuracao):
+    """Clientes HTTP (threads) e o enxame de WebSockets (asyncio) ao mesmo tempo"""
+    inicio_medicao = time.monotonic() + configuracao['aquecimento']
+    fim = inicio_medicao + configuracao['duracao']
+    resultados = []
+    websocket = {}
+
+    clientes = [
+        threading.Thread(target=lambda semente: resultados.append(consultar(
+            url, estacoes, random.Random(semente), inicio_medicao, fim)), args=(configuracao['semente'] + i,))
+        for i in range(configuracao['clientes'])
+    ]
+    enxame = threading.Thread(target=lambda: websocket.update(asyncio.run(assinar(
+        url, linhas, configuracao['websockets'], random.Random(configuracao['semente']), inicio_medicao, fim))))
+    for thread in clientes + [enxame]:
+        thread.start()
+    for thread in clientes + [enxame]:
+        thread.join()
+
+    amostras = {'trens': [], 'estacoes': [], 'previsao': []}
+    erros = {nome: 0 for nome in amostras}
+    for latencias, falhas in resultados:
+        for nome in amostras:
+            amostras[nome].extend(latencias[nome])
+            erros[nome] += falhas[nome]
+
+    duracao = configuracao['duracao']
+    return {
+        'http': {
+            nome: dict(percentis(latencias), total=len(latencias), por_segundo=len(latencias) / duracao,
+                       erros=erros[nome])
+            for nome, latencias in amostras.items()
+        },
+        'websocket': websocket
+    }
+
+
+def consultar(url, estacoes, aleatorio, inicio_medicao, fim):
+    """Um cliente HTTP: alterna entre a frota, as estações e a previsão de uma estação sorteada.
+
+    Retorna (latências, erros) por rota, só do período de medição.
+    """
+    sessao = requests.Session()
+    rotas = (
+        ('trens', lambda: '/api/trens/'),
+        ('estacoes', lambda: '/api/estacoes/'),
+        ('previsao', lambda: f'/api/estacao/{aleatorio.choice(estacoes)}/previsao/'),
+    )
+    amostras = {nome: [] for nome, _ in rotas}
+    erros = {nome: 0 for nome, _ in rotas}
+    i = aleatorio.randrange(len(rotas))
+    while True:
+        agora = time.monotonic()
+        if agora >= fim:
+            break
+        nome, caminho = rotas[i % len(rotas)]
+        i += 1
+        inicio = time.perf_counter()
+        try:
+            resposta = sessao.get(url + caminho(), timeout=30)
+            falhou = resposta.status_code >= 400
+        except requests.RequestException:
+            falhou = True
+        decorrido = time.perf_counter() - inicio
+        if agora < inicio_medicao:
+            continue
+        if falhou:
+            erros[nome] += 1
+        else:
+            amostras[nome].append(decorrido)
+    return amostras, erros
+
+
+async def assinar(url, linhas, quantidade, aleatorio, inicio_medicao, fim):
+    """Enxame de assinantes de ws/trens/, cada um inscrito numa linha sorteada.
+
+    Mede o tempo de conexão e o atraso de cada lote recebido: agora menos a
+    ``ultima_atualizacao`` mais recente dos trens do lote (mesmo relógio,
+    servidor local).
+    """
+    import websockets
+
+    endereco = url.replace('http', 'ws', 1) + '/ws/trens/'
+    conexoes, atrasos = [], []
+    contagem = {'conectados': 0, 'falhas': 0, 'mensagens': 0, 'bytes': 0}
+
+    async def assinante(linha):
+        inicio = time.perf_counter()
+        try:
+            async with websockets.connect(endereco, origin=url, open_timeout=30) as ws:
+                conexoes.append(time.perf_counter() - inicio)
+                contagem['conectados'] += 1
+                await ws.send(json.dumps({'type': 'subscribe_linha', 'linha_id': linha}))
+                while time.monotonic() < fim:
+                    try:
+                        texto = await asyncio.wait_for(ws.recv(), timeout=fim - time.monotonic())
+                    except asyncio.TimeoutError:
+                        break
+                    if time.monotonic() < inicio_medicao:
+                        continue
+                    mensagem = json.loads(texto)
+                    contagem['mensagens'] += 1
+                    contagem['bytes'] += len(texto)
+                    trens = mensagem.get('data', {}).get('trens') or []
+                    if mensagem.get('type') == 'trens_update' and trens:
+                        recente = max(datetime.fromisoformat(trem['ultima_atualizacao']) for trem in trens)
+                        atrasos.append(time.time() - recente.timestamp())
+        except (OSError, asyncio.TimeoutError, websockets.WebSocketException):
+            contagem['falhas'] += 1
+
+    await asyncio.gather(*(assinante(aleatorio.choice(linhas)) for _ in range(quantidade)))
+    duracao = fim - inicio_medicao
+    return dict(
+        contagem,
+        conexoes=quantidade,
+        mensagens_por_segundo=contagem['mensagens'] / duracao,
+        conexao=percentis(conexoes),
+        atraso=percentis(atrasos),
+    )
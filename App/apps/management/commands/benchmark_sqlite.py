@@ -0,0 +1,158 @@
+"""
+Management command que mede a latência de leitura com o atualizador de
+posições gravando sem pausa, numa cópia do banco
+"""
+import json
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection, connections, OperationalError
+from apps.models import Linha, Trem
+from cptm_tracker.services.cptm_api import cptm_service
+from cptm_tracker.services.escrita import fila_escrita
+from cptm_tracker.services.historico_posicoes import historico_posicoes
+from cptm_tracker.services.ingestao import ingerir_posicoes
+
+
+def percentis(amostras):
+    """p50/p95/p99/máximo em milissegundos"""
+    if len(amostras) < 2:
+        valor = amostras[0] * 1000 if amostras else 0.0
+        return {'p50': valor, 'p95': valor, 'p99': valor, 'max': valor}
+    cortes = statistics.quantiles(amostras, n=100)
+    return {
+        'p50': cortes[49] * 1000,
+        'p95': cortes[94] * 1000,
+        'p99': cortes[98] * 1000,
+        'max': max(amostras) * 1000
+    }
+
+
+class Command(BaseCommand):
+    help = 'Mede a latência de leitura com o atualizador de posições gravando continuamente (numa cópia do banco)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--duracao', type=float, default=10.0, help='Segundos de medição')
+        parser.add_argument('--leitores', type=int, default=4, help='Threads de leitura')
+        parser.add_argument(
+            '--modo', choices=['otimizado', 'padrao'], default='otimizado',
+            help='otimizado: configuração de settings (WAL, PRAGMAs); padrao: SQLite sem ajustes'
+        )
+        parser.add_argument('--json', action='store_true', help='Imprime o resultado em JSON')
+
+    def handle(self, *args, **options):
+        diretorio = tempfile.mkdtemp(prefix='benchmark_sqlite_')
+        diretorio_historico = historico_posicoes.diretorio
+        try:
+            self.preparar_banco(diretorio, options['modo'])
+            historico_posicoes.diretorio = os.path.join(diretorio, 'posicoes')
+            resultado = self.medir(options['duracao'], options['leitores'])
+        finally:
+            historico_posicoes.diretorio = diretorio_historico
+            connections.close_all()
+            shutil.rmtree(diretorio, ignore_errors=True)
+
+        resultado['modo'] = options['modo']
+        if options['json']:
+            self.stdout.write(json.dumps(resultado, indent=2))
+            return
+
+        leitura, escrita = resultado['leitura'], resultado['escrita']
+        self.stdout.write(self.style.SUCCESS(f"Modo {resultado['modo']} ({resultado['journal_mode']})"))
+        self.stdout.write(
+            f"Leituras: {leitura['total']} ({leitura['por_segundo']:.0f}/s), {leitura['erros']} erros - "
+            f"p50 {leitura['p50']:.1f} ms, p95 {leitura['p95']:.1f} ms, "
+            f"p99 {leitura['p99']:.1f} ms, máx {leitura['max']:.1f} ms"
+        )
+        self.stdout.write(
+            f"Escritas: {escrita['total']} ciclos ({escrita['por_segundo']:.1f}/s), {escrita['erros']} erros - "
+            f"p50 {escrita['p50']:.1f} ms, p99 {escrita['p99']:.1f} ms"
+        )
+
+    def preparar_banco(self, diretorio, modo):
+        """Copia o banco (API de backup, consistente mesmo em WAL) e aponta a conexão para a cópia"""
+        copia = os.path.join(diretorio, 'benchmark.sqlite3')
+        config = connections.settings['default']
+        origem = sqlite3.connect(str(config['NAME']))
+        destino = sqlite3.connect(copia)
+        origem.backup(destino)
+        destino.execute('PRAGMA journal_mode=WAL' if modo == 'otimizado' else 'PRAGMA journal_mode=DELETE')
+        destino.close()
+        origem.close()
+
+        connections.close_all()
+        config['NAME'] = copia
+        if modo == 'padrao':
+            config['OPTIONS'] = {}
+            config['CONN_MAX_AGE'] = 0
+
+    def medir(self, duracao, leitores):
+        """Escritor e leitores em processos separados (fork), como o worker do
+        Celery e os processos web, para medir a disputa pelo banco e não pelo GIL"""
+        journal_mode = connection.cursor().execute('PRAGMA journal_mode').fetchone()[0]
+        connections.close_all()
+
+        contexto = multiprocessing.get_context('fork')
+        parar = contexto.Event()
+        resultados = contexto.Queue()
+        processos = [contexto.Process(target=escrever, args=(parar, resultados))]
+        processos += [contexto.Process(target=ler, args=(parar, resultados)) for _ in range(leitores)]
+        inicio = time.perf_counter()
+        for processo in processos:
+            processo.start()
+        time.sleep(duracao)
+        parar.set()
+
+        latencias = {'leitura': [], 'escrita': []}
+        erros = {'leitura': 0, 'escrita': 0}
+        for _ in processos:
+            tipo, amostras, falhas = resultados.get()
+            latencias[tipo].extend(amostras)
+            erros[tipo] += falhas
+        for processo in processos:
+            processo.join()
+        decorrido = time.perf_counter() - inicio
+
+        return {
+            'journal_mode': journal_mode,
+            'duracao': decorrido,
+            'leitores': leitores,
+            'leitura': dict(percentis(latencias['leitura']), total=len(latencias['leitura']),
+                            por_segundo=len(latencias['leitura']) / decorrido, erros=erros['leitura']),
+            'escrita': dict(percentis(latencias['escrita']), total=len(latencias['escrita']),
+                            por_segundo=len(latencias['escrita']) / decorrido, erros=erros['escrita']),
+        }
+
+
+def escrever(parar, resultados):
+    """Ciclos do atualizador de posições, sem pausa, pela fila de escrita"""
+    linhas = list(Linha.objects.filter(ativa=True))
+    latencias, erros = [], 0
+    while not parar.is_set():
+        trens_por_linha = [(linha, cptm_service.simular_posicao_trens(linha.numero)) for linha in linhas]
+        inicio = time.perf_counter()
+        try:
+            fila_escrita.executar(ingerir_posicoes, trens_por_linha)
+            latencias.append(time.perf_counter() - inicio)
+        except OperationalError:
+            erros += 1
+    resultados.put(('escrita', latencias, erros))
+
+
+def ler(parar, resultados):
+    """Mesmas leituras do snapshot da frota e do dashboard, em laço"""
+    latencias, erros = [], 0
+    while not parar.is_set():
+        inicio = time.perf_counter()
+        try:
+            list(Trem.objects.select_related('linha', 'estacao_atual', 'proxima_estacao'))
+            Trem.objects.filter(status='operacional').count()
+            latencias.append(time.perf_counter() - inicio)
+        except OperationalError:
+            erros += 1
+    resultados.put(('leitura', latencias, erros))
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.6 on 2026-10-18 08:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apps', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EnderecoGeocodificado',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chave', models.CharField(max_length=255, unique=True)),
+                ('endereco', models.CharField(max_length=500)),
+                ('encontrado', models.BooleanField(default=True)),
+                ('latitude', models.FloatField(blank=True, null=True)),
+                ('longitude', models.FloatField(blank=True, null=True)),
+                ('endereco_formatado', models.CharField(blank=True, max_length=500)),
+                ('fonte', models.CharField(blank=True, max_length=20)),
+                ('atualizado_em', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Endereço Geocodificado',
+                'verbose_name_plural': 'Endereços Geocodificados',
+            },
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.2.6 on 2026-10-18 08:24
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apps', '0002_enderecogeocodificado'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='condiciaoclimatica',
+            index=models.Index(fields=['atualizada_em'], name='clima_atualizada_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='enderecogeocodificado',
+            index=models.Index(fields=['atualizado_em'], name='geocodificado_atualizado_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='historicotrem',
+            index=models.Index(fields=['chegada'], name='historico_chegada_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='manutencao',
+            index=models.Index(fields=['status', 'linha'], name='manutencao_status_linha_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notificacaousuario',
+            index=models.Index(fields=['usuario', 'lida', '-criada_em'], name='notificacao_usuario_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notificacaousuario',
+            index=models.Index(fields=['criada_em'], name='notificacao_criada_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trem',
+            index=models.Index(fields=['status', 'linha'], name='trem_status_linha_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trem',
+            index=models.Index(fields=['previsao_chegada'], name='trem_previsao_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trem',
+            index=models.Index(fields=['proxima_estacao', 'status'], name='trem_proxima_status_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.6 on 2026-10-18 09:02
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apps', '0003_indices_consultas'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='manutencao',
+            name='manutencao_status_linha_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='notificacaousuario',
+            name='notificacao_usuario_idx',
+        ),
+        migrations.AddIndex(
+            model_name='manutencao',
+            index=models.Index(fields=['status', 'linha', '-inicio_programado'], name='manutencao_status_inicio_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notificacaousuario',
+            index=models.Index(fields=['usuario', '-criada_em', 'lida'], name='notificacao_usuario_data_idx'),
+        ),
+    ]
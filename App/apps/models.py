@@ -84,6 +84,14 @@ class Trem(models.Model):
         verbose_name = 'Trem'
         verbose_name_plural = 'Trens'
         ordering = ['linha', 'identificador']
+        indexes = [
+            # Contagens por status (geral e por linha)
+            models.Index(fields=['status', 'linha'], name='trem_status_linha_idx'),
+            # Verificação de chegadas: janela de previsão
+            models.Index(fields=['previsao_chegada'], name='trem_previsao_idx'),
+            # Trens a caminho de uma estação, por status
+            models.Index(fields=['proxima_estacao', 'status'], name='trem_proxima_status_idx'),
+        ]
 
     def __str__(self):
         return f"Trem {self.identificador} - {self.linha.nome}"
@@ -100,6 +108,10 @@ class HistoricoTrem(models.Model):
         verbose_name = 'Histórico do Trem'
         verbose_name_plural = 'Históricos dos Trens'
         ordering = ['-chegada']
+        indexes = [
+            # Tabela de ETA e retenção: passagens por período
+            models.Index(fields=['chegada'], name='historico_chegada_idx'),
+        ]
 
 class NotificacaoUsuario(models.Model):
     TIPO_CHOICES = [
@@ -125,6 +137,13 @@ class NotificacaoUsuario(models.Model):
         verbose_name = 'Notificação'
         verbose_name_plural = 'Notificações'
         ordering = ['-criada_em']
+        indexes = [
+            # Lista de notificações do usuário (todas ou não lidas), mais recentes primeiro:
+            # 'lida' por último para o ORDER BY seguir o índice também sem o filtro
+            models.Index(fields=['usuario', '-criada_em', 'lida'], name='notificacao_usuario_data_idx'),
+            # Retenção
+            models.Index(fields=['criada_em'], name='notificacao_criada_idx'),
+        ]
 
 class PreferenciasUsuario(models.Model):
     usuario = models.OneToOneField(User, on_delete=models.CASCADE, related_name='preferencias')
@@ -161,6 +180,9 @@ class CondiciaoClimatica(models.Model):
         verbose_name = 'Condição Climática'
         verbose_name_plural = 'Condições Climáticas'
         ordering = ['-atualizada_em']
+        indexes = [
+            models.Index(fields=['atualizada_em'], name='clima_atualizada_idx'),
+        ]
 
 class Manutencao(models.Model):
     TIPO_CHOICES = [
@@ -193,6 +215,10 @@ class Manutencao(models.Model):
         verbose_name = 'Manutenção'
         verbose_name_plural = 'Manutenções'
         ordering = ['-inicio_programado']
+        indexes = [
+            # Manutenções em andamento (geral e por linha, já na ordem de exibição)
+            models.Index(fields=['status', 'linha', '-inicio_programado'], name='manutencao_status_inicio_idx'),
+        ]
 
 class Rota(models.Model):
     usuario = models.ForeignKey(User, on_delete=models.CASCADE, related_name='rotas')
@@ -206,3 +232,24 @@ class Rota(models.Model):
         verbose_name = 'Rota'
         verbose_name_plural = 'Rotas'
         unique_together = [['usuario', 'nome']]
+
+class EnderecoGeocodificado(models.Model):
+    chave = models.CharField(max_length=255, unique=True)  # Endereço normalizado
+    endereco = models.CharField(max_length=500)
+    encontrado = models.BooleanField(default=True)  # False = cache negativo
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
+    endereco_formatado = models.CharField(max_length=500, blank=True)
+    fonte = models.CharField(max_length=20, blank=True)
+    atualizado_em = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'Endereço Geocodificado'
+        verbose_name_plural = 'Endereços Geocodificados'
+        indexes = [
+            # Retenção
+            models.Index(fields=['atualizado_em'], name='geocodificado_atualizado_idx'),
+        ]
+
+    def __str__(self):
+        return self.endereco
@@ -0,0 +1,175 @@
+"""
+Respostas condicionais (ETag / If-None-Match) para as APIs de leitura
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse as JsonResponseDjango
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags
+from cptm_tracker.instrumentacao import medir
+
+
+class VersoesDados:
+    """Contadores de versão por conjunto de dados ('estacoes', 'manutencoes'...).
+
+    São incrementados pelos signals dos modelos e compartilhados entre
+    processos pelo cache; cada processo guarda o último valor lido por até
+    ``intervalo_sincronizacao`` segundos para não consultar o cache a cada
+    requisição.
+    """
+
+    CHAVE = 'versao:{}'
+
+    def __init__(self, intervalo_sincronizacao=1.0):
+        self.intervalo_sincronizacao = intervalo_sincronizacao
+        self._lock = threading.Lock()
+        self._locais = {}
+
+    def obter(self, nome):
+        """Versão atual de um conjunto de dados"""
+        agora = time.monotonic()
+        local = self._locais.get(nome)
+        if local is not None and agora - local[1] < self.intervalo_sincronizacao:
+            return local[0]
+
+        chave = self.CHAVE.format(nome)
+        versao = cache.get(chave)
+        if versao is None:
+            # Semente baseada no relógio: após limpar o cache, nunca repete versões antigas
+            cache.add(chave, int(time.time()), None)
+            versao = cache.get(chave)
+        with self._lock:
+            self._locais[nome] = (versao, agora)
+        return versao
+
+    def incrementar(self, nome):
+        """Invalida o conjunto de dados, gerando uma nova versão"""
+        chave = self.CHAVE.format(nome)
+        cache.add(chave, int(time.time()), None)
+        try:
+            versao = cache.incr(chave)
+        except ValueError:
+            versao = int(time.time())
+            cache.set(chave, versao, None)
+        with self._lock:
+            self._locais[nome] = (versao, time.monotonic())
+        return versao
+
+
+class JsonResponse(JsonResponseDjango):
+    """JsonResponse que soma o tempo de serialização na instrumentação da requisição"""
+
+    def __init__(self, *args, **kwargs):
+        with medir('serializacao'):
+            super().__init__(*args, **kwargs)
+
+
+def responder_condicional(request, corpo, etag, max_age, content_type='application/json'):
+    """Responde 304 se o cliente já tem o corpo identificado por ``etag``"""
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags_cliente = [e[2:] if e.startswith('W/') else e for e in parse_etags(if_none_match)]
+        if '*' in etags_cliente or etag in etags_cliente:
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            patch_cache_control(response, public=True, max_age=max_age)
+            return response
+
+    response = HttpResponse(corpo, content_type=content_type)
+    response['ETag'] = etag
+    patch_cache_control(response, public=True, max_age=max_age)
+    return response
+
+
+class RespostasCondicionais:
+    """Guarda o corpo de cada resposta junto com o hash do conteúdo (ETag).
+
+    A chave inclui as versões dos dados de que a resposta depende, então uma
+    entrada nunca fica desatualizada: quando os dados mudam, a chave muda.
+    """
+
+    LIMITE_LOCAL = 512
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # LRU local: chave -> entrada; a expiração viaja na própria entrada
+        self._locais = OrderedDict()
+
+    def obter(self, chave):
+        with self._lock:
+            entrada = self._locais.get(chave)
+            if entrada is not None:
+                if self._expirada(entrada):
+                    del self._locais[chave]
+                    entrada = None
+                else:
+                    self._locais.move_to_end(chave)
+        if entrada is None:
+            entrada = cache.get(chave)
+            if entrada is not None and not self._expirada(entrada):
+                self._guardar_local(chave, entrada)
+        return entrada
+
+    def guardar(self, chave, corpo, content_type, timeout):
+        entrada = {
+            'etag': '"%s"' % hashlib.blake2b(corpo, digest_size=16).hexdigest(),
+            'corpo': corpo,
+            'content_type': content_type,
+            # Instante absoluto: a cópia local de outro processo expira junto com o cache
+            'expira_em': None if timeout is None else time.time() + timeout
+        }
+        cache.set(chave, entrada, timeout)
+        self._guardar_local(chave, entrada)
+        return entrada
+
+    @staticmethod
+    def _expirada(entrada):
+        expira_em = entrada.get('expira_em')
+        return expira_em is not None and expira_em <= time.time()
+
+    def _guardar_local(self, chave, entrada):
+        with self._lock:
+            self._locais[chave] = entrada
+            self._locais.move_to_end(chave)
+            while len(self._locais) > self.LIMITE_LOCAL:
+                self._locais.popitem(last=False)
+
+
+def resposta_condicional(max_age, versoes, timeout=300):
+    """Decorator para views GET cacheáveis com validação por ETag.
+
+    ``versoes(request, *args, **kwargs)`` deve devolver, sem acessar o banco,
+    a tupla de versões/parâmetros que identifica o conteúdo da resposta.
+    Respostas diferentes de 200 não são guardadas.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(request, *args, **kwargs)
+
+            partes = versoes(request, *args, **kwargs)
+            chave = 'resposta:{}:{}'.format(view.__name__, ':'.join(str(p) for p in partes))
+            entrada = respostas_condicionais.obter(chave)
+            if entrada is None:
+                response = view(request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+                entrada = respostas_condicionais.guardar(
+                    chave, response.content, response['Content-Type'], timeout
+                )
+
+            return responder_condicional(
+                request, entrada['corpo'], entrada['etag'], max_age, entrada['content_type']
+            )
+        return wrapper
+    return decorator
+
+
+# Instâncias globais
+versoes_dados = VersoesDados()
+respostas_condicionais = RespostasCondicionais()
@@ -0,0 +1,51 @@
+"""
+Signals que invalidam as versões de dados (respostas condicionais, registro de
+estações e índice de assinantes)
+"""
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from .models import Linha, Estacao, Manutencao, PreferenciasUsuario
+from .respostas import versoes_dados
+from cptm_tracker.services.estacoes import estacoes_service
+from cptm_tracker.notifications.assinantes import assinantes_service
+
+
+@receiver(post_save, sender=Linha)
+@receiver(post_delete, sender=Linha)
+@receiver(post_save, sender=Estacao)
+@receiver(post_delete, sender=Estacao)
+@receiver(m2m_changed, sender=Estacao.baldeacao.through)
+def invalidar_estacoes(sender, **kwargs):
+    # m2m_changed dispara antes e depois da alteração; só a segunda conta
+    if kwargs.get('action') not in (None, 'post_add', 'post_remove', 'post_clear'):
+        return
+    versoes_dados.incrementar('estacoes')
+    estacoes_service.invalidar()
+
+
+@receiver(post_save, sender=Manutencao)
+@receiver(post_delete, sender=Manutencao)
+def invalidar_manutencoes(sender, **kwargs):
+    versoes_dados.incrementar('manutencoes')
+
+
+@receiver(post_save, sender=PreferenciasUsuario)
+def atualizar_assinante(sender, instance, **kwargs):
+    assinantes_service.atualizar_preferencias(instance)
+
+
+@receiver(post_delete, sender=PreferenciasUsuario)
+def remover_assinante(sender, instance, **kwargs):
+    assinantes_service.remover_usuario(instance.usuario_id)
+
+
+@receiver(m2m_changed, sender=PreferenciasUsuario.estacoes_favoritas.through)
+@receiver(m2m_changed, sender=PreferenciasUsuario.linhas_favoritas.through)
+def atualizar_favoritas(sender, instance, action, reverse, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        # Alteração feita pelo lado da Estacao/Linha: afeta vários usuários
+        assinantes_service.invalidar()
+    else:
+        assinantes_service.atualizar_preferencias(instance)
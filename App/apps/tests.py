@@ -0,0 +1,796 @@
+"""
+Regressão dos planos de consulta (as consultas quentes não podem cair em
+varredura completa de tabela, EXPLAIN QUERY PLAN do SQLite) e do despacho de
+push contra um servidor HTTP local no lugar do OneSignal
+"""
+import json
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from .models import Linha, Estacao, Trem, HistoricoTrem, NotificacaoUsuario, CondiciaoClimatica, Manutencao, PreferenciasUsuario
+from cptm_tracker.cache import CacheEmCamadas
+from .respostas import RespostasCondicionais, versoes_dados
+from cptm_tracker.notifications.assinantes import assinantes_service
+from cptm_tracker.notifications.despacho import DespachantePush
+from cptm_tracker.notifications.push import notificacao_service
+from cptm_tracker.services.frota import FrotaService
+from cptm_tracker.services.historico_posicoes import ArmazemPosicoes, Amostras, MARCA_CONSOLIDADA, RESOLUCOES
+from cptm_tracker.services.estacoes import RegistroEstacoes
+from cptm_tracker.services.rotas import GrafoRede
+from cptm_tracker.services.replay import ReplayService, ARQUIVO_INDICE
+from cptm_tracker.services.retencao import POLITICAS, PoliticaRetencao, aplicar_politica
+
+# "SCAN tabela" sem índice; "SCAN tabela USING [COVERING] INDEX" percorre o índice na ordem pedida
+VARREDURA_COMPLETA = re.compile(r'^SCAN (\w+)$')
+# ORDER BY/GROUP BY que o índice não cobre vira uma ordenação em árvore temporária
+ORDENACAO_TEMPORARIA = re.compile(r'^USE TEMP B-TREE FOR ')
+
+
+class PlanosConsultaTest(TestCase):
+    """Cada teste executa uma consulta quente e confere o plano de todas as
+    consultas emitidas. Os planos não dependem dos dados, então as tabelas
+    ficam vazias."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.usuario = User.objects.create(username='planos')
+        cls.linha = Linha.objects.create(numero='7', nome='Linha 7-Rubi', cor='#CA016B')
+
+    def assertSemVarreduraCompleta(self, consulta, permitir_ordenacao=False):
+        """``permitir_ordenacao`` aceita a árvore temporária do ORDER BY em
+        consultas de poucas linhas cuja ordenação nenhum índice cobre (coluna de
+        outra tabela do JOIN ou depois de um filtro por intervalo)"""
+        with CaptureQueriesContext(connection) as capturadas:
+            consulta()
+        self.assertTrue(capturadas.captured_queries, 'nenhuma consulta executada')
+        for capturada in capturadas.captured_queries:
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN QUERY PLAN ' + capturada['sql'])
+                plano = [linha[-1] for linha in cursor.fetchall()]
+            varreduras = [passo for passo in plano
+                          if VARREDURA_COMPLETA.match(passo)
+                          or (not permitir_ordenacao and ORDENACAO_TEMPORARIA.match(passo))]
+            self.assertFalse(varreduras, f"{capturada['sql']}\n" + '\n'.join(plano))
+
+    def test_trens_por_status(self):
+        self.assertSemVarreduraCompleta(lambda: Trem.objects.filter(status='operacional').count())
+
+    def test_trens_da_linha_por_status(self):
+        self.assertSemVarreduraCompleta(lambda: Trem.objects.filter(linha=self.linha, status='atrasado').count())
+
+    def test_trens_chegando(self):
+        agora = timezone.now()
+        self.assertSemVarreduraCompleta(lambda: list(Trem.objects.filter(
+            previsao_chegada__gte=agora,
+            previsao_chegada__lte=agora + timedelta(minutes=5),
+            proxima_estacao_id__in=[1, 2, 3]
+        ).select_related('linha', 'proxima_estacao')), permitir_ordenacao=True)
+
+    def test_trens_a_caminho_da_estacao(self):
+        self.assertSemVarreduraCompleta(
+            lambda: list(Trem.objects.filter(proxima_estacao_id=1, status='operacional')), permitir_ordenacao=True)
+
+    def test_notificacoes_do_usuario(self):
+        self.assertSemVarreduraCompleta(
+            lambda: list(notificacao_service.obter_notificacoes_usuario(self.usuario)))
+
+    def test_notificacoes_nao_lidas(self):
+        self.assertSemVarreduraCompleta(
+            lambda: list(notificacao_service.obter_notificacoes_usuario(self.usuario, apenas_nao_lidas=True)))
+        self.assertSemVarreduraCompleta(
+            lambda: NotificacaoUsuario.objects.filter(usuario=self.usuario, lida=False).count())
+
+    def test_manutencoes_em_andamento(self):
+        agora = timezone.now()
+        self.assertSemVarreduraCompleta(lambda: list(Manutencao.objects.filter(
+            status='em_andamento', inicio_real__lte=agora, fim_programado__gte=agora
+        ).select_related('linha', 'estacao_inicio', 'estacao_fim')), permitir_ordenacao=True)
+        self.assertSemVarreduraCompleta(
+            lambda: list(Manutencao.objects.filter(linha=self.linha, status='em_andamento')))
+
+    def test_clima_recente(self):
+        limite = timezone.now() - timedelta(days=7)
+        self.assertSemVarreduraCompleta(lambda: list(CondiciaoClimatica.objects.filter(atualizada_em__gte=limite)))
+
+    def test_historico_para_eta(self):
+        inicio = timezone.now() - timedelta(days=28)
+        self.assertSemVarreduraCompleta(lambda: list(HistoricoTrem.objects.filter(chegada__gte=inicio).values_list(
+            'trem_id', 'estacao_id', 'chegada')))
+
+    def test_retencao(self):
+        for politica in POLITICAS:
+            with self.subTest(modelo=politica.modelo):
+                self.assertSemVarreduraCompleta(lambda: aplicar_politica(politica))
+
+
+class ServidorStub:
+    """Servidor HTTP local que responde com a sequência de (status, corpo)
+    configurada (repetindo a última) e guarda cada requisição recebida"""
+
+    def __init__(self, respostas):
+        self.respostas = list(respostas)
+        self.recebidas = []  # (instante, corpo JSON)
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                corpo = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                with stub._lock:
+                    stub.recebidas.append((time.monotonic(), corpo))
+                    status, resposta = stub.respostas[min(len(stub.recebidas), len(stub.respostas)) - 1]
+                dados = json.dumps(resposta).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(dados)))
+                self.end_headers()
+                self.wfile.write(dados)
+
+            def log_message(self, *args):
+                pass
+
+        self._lock = threading.Lock()
+        self._servidor = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}/api/v1/notifications'.format(self._servidor.server_port)
+
+    def __enter__(self):
+        threading.Thread(target=self._servidor.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._servidor.shutdown()
+        self._servidor.server_close()
+
+
+class DespachantePushTest(SimpleTestCase):
+    """Lotes, repetição com backoff e invalidação de tokens do DespachantePush"""
+
+    def despachante(self, stub, **opcoes):
+        opcoes.setdefault('espera_inicial', 0.05)
+        return DespachantePush('app', 'chave', url=stub.url, **opcoes)
+
+    def test_lotes_por_conteudo(self):
+        with ServidorStub([(200, {'id': 'x'})]) as stub:
+            despachante = self.despachante(stub, tamanho_lote=3, janela=0.2)
+            self.assertTrue(despachante.enviar([1, 2, 3, 4], 'Atraso', 'Linha 7'))
+            self.assertTrue(despachante.enviar([4, 5, 6, 7], 'Atraso', 'Linha 7'))
+            self.assertTrue(despachante.aguardar(5))
+
+        ids = sorted(corpo['include_external_user_ids'] for _, corpo in stub.recebidas)
+        self.assertEqual(ids, [['1', '2', '3'], ['4', '5', '6'], ['7']])
+        metricas = despachante.metricas()
+        self.assertEqual(metricas['lotes_enviados'], 3)
+        self.assertEqual(metricas['destinatarios_entregues'], 7)
+        self.assertEqual(metricas['pendentes'], 0)
+
+    def test_repete_com_backoff_em_5xx_e_429(self):
+        with ServidorStub([(503, {}), (429, {}), (200, {'id': 'x'})]) as stub, \
+                mock.patch('cptm_tracker.notifications.despacho.random.uniform', return_value=1.0):
+            despachante = self.despachante(stub)
+            despachante.enviar([1], 'Atraso', 'Linha 7')
+            self.assertTrue(despachante.aguardar(5))
+
+        instantes = [instante for instante, _ in stub.recebidas]
+        self.assertEqual(len(instantes), 3)
+        # Espera dobra a cada tentativa: 0,05 s e depois 0,1 s
+        self.assertGreaterEqual(instantes[1] - instantes[0], 0.05)
+        self.assertGreaterEqual(instantes[2] - instantes[1], 0.1)
+        metricas = despachante.metricas()
+        self.assertEqual(metricas['repeticoes'], 2)
+        self.assertEqual(metricas['lotes_enviados'], 1)
+
+    def test_desiste_apos_as_tentativas(self):
+        with ServidorStub([(500, {})]) as stub:
+            despachante = self.despachante(stub, tentativas=3, espera_inicial=0.01)
+            despachante.enviar([1, 2], 'Atraso', 'Linha 7')
+            self.assertTrue(despachante.aguardar(5))
+
+        self.assertEqual(len(stub.recebidas), 3)
+        metricas = despachante.metricas()
+        self.assertEqual(metricas['lotes_falhos'], 1)
+        self.assertEqual(metricas['destinatarios_falhos'], 2)
+
+    def test_nao_repete_erro_do_cliente(self):
+        with ServidorStub([(400, {'errors': ['app_id inválido']})]) as stub:
+            despachante = self.despachante(stub)
+            despachante.enviar([1], 'Atraso', 'Linha 7')
+            self.assertTrue(despachante.aguardar(5))
+
+        self.assertEqual(len(stub.recebidas), 1)
+        self.assertEqual(despachante.metricas()['lotes_falhos'], 1)
+
+    def test_invalida_destinatarios_recusados(self):
+        invalidados = []
+        resposta = {'id': 'x', 'recipients': 2, 'errors': {'invalid_external_user_ids': ['2']}}
+        with ServidorStub([(200, resposta)]) as stub:
+            despachante = self.despachante(stub, ao_invalidar=invalidados.extend)
+            despachante.enviar([1, 2, 3], 'Atraso', 'Linha 7')
+            self.assertTrue(despachante.aguardar(5))
+
+        self.assertEqual(invalidados, ['2'])
+        metricas = despachante.metricas()
+        self.assertEqual(metricas['destinatarios_entregues'], 2)
+        self.assertEqual(metricas['destinatarios_invalidos'], 1)
+
+
+class InvalidacaoTokensTest(TestCase):
+    def test_remove_token_dos_recusados(self):
+        recusado, valido = User.objects.create(username='recusado'), User.objects.create(username='valido')
+        PreferenciasUsuario.objects.create(usuario=recusado, token_dispositivo='a')
+        PreferenciasUsuario.objects.create(usuario=valido, token_dispositivo='b')
+
+        notificacao_service.invalidar_tokens([str(recusado.id)])
+
+        tokens = dict(PreferenciasUsuario.objects.values_list('usuario__username', 'token_dispositivo'))
+        self.assertEqual(tokens, {'recusado': '', 'valido': 'b'})
+
+
+class EstacoesProximasViewTest(TestCase):
+    """Validação dos parâmetros de /api/estacoes/proximas/"""
+
+    def test_rejeita_valores_nao_finitos(self):
+        for parametros in ('lat=-23.5&lng=-46.6&raio=inf', 'lat=-23.5&lng=-46.6&raio=nan',
+                           'lat=nan&lng=-46.6', 'lat=-23.5&lng=inf', 'lat=-23.5&lng=-46.6&raio=-inf'):
+            with self.subTest(parametros=parametros):
+                response = self.client.get('/api/estacoes/proximas/?' + parametros)
+                self.assertEqual(response.status_code, 400)
+
+    def test_rejeita_raio_acima_do_maximo(self):
+        response = self.client.get('/api/estacoes/proximas/?lat=-23.5&lng=-46.6&raio=1e9')
+        self.assertEqual(response.status_code, 400)
+
+    def test_aceita_parametros_validos(self):
+        response = self.client.get('/api/estacoes/proximas/?lat=-23.5&lng=-46.6&raio=5000&limite=3')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['raio'], 5000)
+
+
+class DeltaFrotaTest(TestCase):
+    """Contrato do feed de deltas (/api/trens/?since=): alterados e removidos
+    acumulados entre versões, ou o snapshot completo para ressincronizar"""
+
+    def setUp(self):
+        cache.clear()
+        self.linha = Linha.objects.create(numero='7', nome='Linha 7-Rubi', cor='#CA016B')
+        self.trens = {
+            nome: Trem.objects.create(identificador=nome, linha=self.linha, latitude_atual=-23.5,
+                                      longitude_atual=-46.6 + i / 100)
+            for i, nome in enumerate(('T701', 'T702', 'T703'))
+        }
+        self.frota = FrotaService()
+
+    def publicar(self):
+        return self.frota.publicar_do_banco()
+
+    def corpo(self, resposta):
+        return json.loads(resposta['corpo'])
+
+    def test_acumula_alterados_e_removidos(self):
+        inicial = self.publicar()
+        Trem.objects.filter(pk=self.trens['T701'].pk).update(velocidade=60)
+        self.publicar()
+        removido = self.trens['T702'].pk
+        self.trens['T702'].delete()
+        self.publicar()
+        novo = Trem.objects.create(identificador='T704', linha=self.linha, latitude_atual=-23.4, longitude_atual=-46.5)
+        Trem.objects.filter(pk=self.trens['T701'].pk).update(velocidade=70)
+        versao = self.publicar()
+
+        corpo = self.corpo(self.frota.obter_delta(inicial))
+        self.assertTrue(corpo['delta'])
+        self.assertEqual((corpo['desde'], corpo['versao']), (inicial, versao))
+        self.assertEqual(sorted(trem['identificador'] for trem in corpo['trens']), ['T701', 'T704'])
+        self.assertEqual(corpo['removidos'], [removido])
+        self.assertEqual(corpo['total'], 3)
+        self.assertEqual({trem['id']: trem['velocidade'] for trem in corpo['trens']}[self.trens['T701'].pk], 70)
+        self.assertIn(novo.pk, [trem['id'] for trem in corpo['trens']])
+
+    def test_removido_e_recriado_conta_como_alterado(self):
+        inicial = self.publicar()
+        trem_id = self.trens['T703'].pk
+        self.trens['T703'].delete()
+        self.publicar()
+        Trem.objects.create(pk=trem_id, identificador='T703', linha=self.linha, latitude_atual=-23.5, longitude_atual=-46.6)
+        self.publicar()
+
+        corpo = self.corpo(self.frota.obter_delta(inicial))
+        self.assertEqual([t['id'] for t in corpo['trens']], [trem_id])
+        self.assertEqual(corpo['removidos'], [])
+
+    def test_fora_da_janela_devolve_snapshot_completo(self):
+        self.frota.JANELA_DELTAS = 2
+        inicial = self.publicar()
+        for _ in range(3):
+            self.publicar()
+
+        corpo = self.corpo(self.frota.obter_delta(inicial))
+        self.assertIs(corpo['delta'], False)
+        self.assertEqual(len(corpo['trens']), 3)
+
+    def test_versao_futura_devolve_snapshot_completo(self):
+        versao = self.publicar()
+        corpo = self.corpo(self.frota.obter_delta(versao + 10))
+        self.assertIs(corpo['delta'], False)
+        self.assertEqual(corpo['versao'], versao)
+
+    def test_delta_ausente_devolve_snapshot_completo(self):
+        inicial = self.publicar()
+        versao = self.publicar()
+        self.publicar()
+        cache.delete(self.frota._chave_delta(versao))
+        self.frota._deltas.clear()
+
+        self.assertIs(self.corpo(self.frota.obter_delta(inicial))['delta'], False)
+
+    def test_since_invalido(self):
+        for valor in ('abc', '1.5', ''):
+            with self.subTest(since=valor):
+                self.assertEqual(self.client.get('/api/trens/', {'since': valor}).status_code, 400)
+
+
+class RespostasCondicionaisTest(TestCase):
+    """ETag/304 das APIs de leitura e as versões de dados que mudam a ETag"""
+
+    def setUp(self):
+        cache.clear()
+        self.linha = Linha.objects.create(numero='7', nome='Linha 7-Rubi', cor='#CA016B')
+        self.estacoes = [
+            Estacao.objects.create(nome=nome, linha=self.linha, codigo=nome[:3].upper(),
+                                   latitude=-23.5, longitude=-46.6, ordem=ordem)
+            for ordem, nome in enumerate(('Luz', 'Barra Funda', 'Lapa'), start=1)
+        ]
+
+    def etag(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response['ETag']
+
+    def test_if_none_match_acerto_e_erro(self):
+        etag = self.etag('/api/estacoes/')
+
+        response = self.client.get('/api/estacoes/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(self.client.get('/api/estacoes/', HTTP_IF_NONE_MATCH='W/' + etag).status_code, 304)
+
+        response = self.client.get('/api/estacoes/', HTTP_IF_NONE_MATCH='"outra"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['total'], 3)
+
+    def test_estacao_alterada_muda_versao_e_etag(self):
+        etag = self.etag('/api/estacoes/')
+        versao = versoes_dados.obter('estacoes')
+
+        self.estacoes[0].tem_elevador = True
+        self.estacoes[0].save()
+
+        self.assertGreater(versoes_dados.obter('estacoes'), versao)
+        self.assertEqual(self.client.get('/api/estacoes/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        self.assertNotEqual(self.etag('/api/estacoes/'), etag)
+
+    def test_baldeacao_incrementa_uma_vez_por_alteracao(self):
+        versao = versoes_dados.obter('estacoes')
+        self.estacoes[0].baldeacao.add(self.estacoes[2])
+        self.assertEqual(versoes_dados.obter('estacoes'), versao + 1)
+        self.estacoes[0].baldeacao.clear()
+        self.assertEqual(versoes_dados.obter('estacoes'), versao + 2)
+
+    def test_manutencao_muda_versao_e_etag_da_linha(self):
+        etag = self.etag('/api/linha/7/')
+        versao = versoes_dados.obter('manutencoes')
+
+        agora = timezone.now()
+        manutencao = Manutencao.objects.create(
+            linha=self.linha, estacao_inicio=self.estacoes[0], estacao_fim=self.estacoes[2],
+            tipo='preventiva', status='em_andamento', descricao='Troca de dormentes',
+            inicio_programado=agora - timedelta(hours=1), fim_programado=agora + timedelta(hours=1)
+        )
+        self.assertEqual(versoes_dados.obter('manutencoes'), versao + 1)
+        self.assertEqual(self.client.get('/api/linha/7/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        manutencao.delete()
+        self.assertEqual(versoes_dados.obter('manutencoes'), versao + 2)
+
+    def test_memo_local_lru_com_expiracao(self):
+        respostas = RespostasCondicionais()
+        respostas.LIMITE_LOCAL = 2
+        respostas.guardar('a', b'{}', 'application/json', 60)
+        respostas.guardar('b', b'{}', 'application/json', 60)
+        respostas.obter('a')
+        respostas.guardar('c', b'{}', 'application/json', 60)
+        self.assertEqual(list(respostas._locais), ['a', 'c'])
+
+        respostas.guardar('d', b'{}', 'application/json', 60)
+        with mock.patch('apps.respostas.time.time', return_value=time.time() + 61):
+            self.assertIsNone(respostas.obter('d'))
+        self.assertNotIn('d', respostas._locais)
+
+
+class RetencaoTest(TestCase):
+    """Só os registros mais antigos que o prazo da política são removidos"""
+
+    def setUp(self):
+        self.usuario = User.objects.create(username='retencao')
+        self.agora = timezone.now()
+
+    def notificacoes(self, quantidade, dias):
+        criadas = [NotificacaoUsuario.objects.create(usuario=self.usuario, tipo='geral', titulo='t', mensagem='m')
+                   for _ in range(quantidade)]
+        NotificacaoUsuario.objects.filter(pk__in=[n.pk for n in criadas]).update(
+            criada_em=self.agora - timedelta(days=dias))
+        return {n.pk for n in criadas}
+
+    def test_remove_apenas_vencidos_em_lotes(self):
+        vencidas = self.notificacoes(5, 31)
+        frescas = self.notificacoes(3, 29)
+        politica = PoliticaRetencao('apps.NotificacaoUsuario', 'criada_em', 30, tamanho_lote=2, pausa=0)
+
+        resultado = aplicar_politica(politica, agora=self.agora)
+
+        self.assertEqual(resultado['removidos'], 5)
+        self.assertEqual(resultado['lotes'], 3)
+        restantes = set(NotificacaoUsuario.objects.values_list('pk', flat=True))
+        self.assertEqual(restantes, frescas)
+        self.assertFalse(restantes & vencidas)
+
+    def test_sem_vencidos_nao_remove_nada(self):
+        frescas = self.notificacoes(2, 1)
+        resultado = aplicar_politica(POLITICAS[0], agora=self.agora)
+        self.assertEqual((resultado['removidos'], resultado['lotes']), (0, 0))
+        self.assertEqual(set(NotificacaoUsuario.objects.values_list('pk', flat=True)), frescas)
+
+    def test_historico_de_viagens_nao_tem_politica_padrao(self):
+        # HistoricoTrem alimenta as medianas de ETA; não é podado pela tarefa diária
+        self.assertNotIn('apps.HistoricoTrem', [politica.modelo for politica in POLITICAS])
+
+
+def epoch(*data):
+    return datetime(*data, tzinfo=dt_timezone.utc).timestamp()
+
+
+class HistoricoPosicoesTest(SimpleTestCase):
+    """Consolidação bruto → 1min → 15min e retenção das partições"""
+
+    def setUp(self):
+        temporario = tempfile.TemporaryDirectory()
+        self.addCleanup(temporario.cleanup)
+        self.armazem = ArmazemPosicoes(temporario.name)
+
+    def gravar(self, resolucao, *tempos, velocidade=10.0):
+        for t in tempos:
+            amostras = Amostras()
+            amostras.acrescentar(t=t, trem=1, linha=1, estacao=0, proxima=0, direcao=0,
+                                 latitude=-23.5, longitude=-46.6, velocidade=velocidade, status=0, lotacao=0)
+            self.armazem._acrescentar(resolucao, self.armazem.particao(resolucao, t), amostras)
+
+    def test_consolida_em_cascata_com_media(self):
+        self.gravar('bruto', epoch(2026, 3, 10, 10, 0, 10), epoch(2026, 3, 10, 10, 0, 40), velocidade=20.0)
+        self.gravar('bruto', epoch(2026, 3, 10, 10, 0, 50), velocidade=50.0)
+
+        resumo = self.armazem.consolidar(epoch(2026, 3, 11, 0, 30))
+
+        self.assertEqual((resumo['1min'], resumo['15min']), (1, 1))
+        por_minuto = self.armazem.ler_particao('1min', '20260310')
+        self.assertEqual(list(por_minuto.colunas['t']), [epoch(2026, 3, 10, 10, 0)])
+        self.assertEqual(list(por_minuto.colunas['velocidade']), [30.0])
+        self.assertEqual(len(self.armazem.ler_particao('15min', '202603')), 1)
+        self.assertTrue(self.armazem.consolidada('bruto', '2026031010'))
+        self.assertTrue(self.armazem.consolidada('1min', '20260310'))
+
+        # Uma segunda passada não duplica nada
+        self.assertEqual(self.armazem.consolidar(epoch(2026, 3, 11, 0, 45))['15min'], 0)
+        self.assertEqual(len(self.armazem.ler_particao('15min', '202603')), 1)
+
+    def test_dia_so_fecha_com_todas_as_horas_consolidadas(self):
+        self.gravar('bruto', epoch(2026, 3, 10, 10, 5), epoch(2026, 3, 10, 11, 5))
+        self.armazem._consolidar_nivel(RESOLUCOES[0], RESOLUCOES[1], epoch(2026, 3, 10, 11, 30))
+        self.assertFalse(self.armazem.consolidada('bruto', '2026031011'))
+
+        # O dia acabou, mas a hora 11 ainda não chegou à partição de 1 minuto
+        pendentes = self.armazem._consolidar_nivel(RESOLUCOES[1], RESOLUCOES[2], epoch(2026, 3, 11, 0, 30), 'bruto')
+        self.assertEqual(pendentes, 0)
+        self.assertFalse(self.armazem.consolidada('1min', '20260310'))
+
+        self.armazem.consolidar(epoch(2026, 3, 11, 0, 30))
+        self.assertTrue(self.armazem.consolidada('1min', '20260310'))
+        self.assertEqual(list(self.armazem.ler_particao('15min', '202603').colunas['t']),
+                         [epoch(2026, 3, 10, 10, 0), epoch(2026, 3, 10, 11, 0)])
+
+    def test_retencao_preserva_particoes_nao_consolidadas(self):
+        self.gravar('bruto', epoch(2026, 3, 1, 8, 5), epoch(2026, 3, 1, 9, 5), epoch(2026, 3, 10, 9, 5))
+        self.armazem._gravar_marca(
+            os.path.join(self.armazem.diretorio, 'bruto', '2026030108', MARCA_CONSOLIDADA), '1')
+        self.gravar('15min', epoch(2025, 1, 1, 0, 0))
+
+        removidas = self.armazem.aplicar_retencao(epoch(2026, 3, 10, 12, 0))
+
+        self.assertEqual(removidas, 2)
+        self.assertEqual(self.armazem.particoes('bruto'), ['2026030109', '2026031009'])
+        self.assertEqual(self.armazem.particoes('15min'), [])
+
+
+class ReplayTest(TestCase):
+    """Frota reconstruída do histórico bruto (snapshot_em, quadros) e ?at= da API"""
+
+    BASE = epoch(2026, 3, 10, 10, 0)
+
+    def setUp(self):
+        temporario = tempfile.TemporaryDirectory()
+        self.addCleanup(temporario.cleanup)
+        self.armazem = ArmazemPosicoes(temporario.name)
+        self.replay = ReplayService(self.armazem)
+        linha = Linha.objects.create(numero='7', nome='Linha 7-Rubi', cor='#CA016B')
+        self.t1 = Trem.objects.create(identificador='T1', linha=linha)
+        self.t2 = Trem.objects.create(identificador='T2', linha=linha)
+
+    def gravar(self, segundos, **velocidades):
+        """Um ciclo em BASE + ``segundos``: velocidade por trem (T1=..., T2=...)"""
+        amostras = Amostras()
+        for nome, velocidade in velocidades.items():
+            amostras.acrescentar(t=self.BASE + segundos, trem=getattr(self, nome.lower()).pk, linha=1,
+                                 estacao=0, proxima=0, direcao=0, latitude=-23.5, longitude=-46.6,
+                                 velocidade=velocidade, status=0, lotacao=0)
+        self.armazem._acrescentar('bruto', self.armazem.particao('bruto', self.BASE), amostras)
+
+    def velocidades(self, snapshot):
+        return {trem['identificador']: trem['velocidade'] for trem in snapshot['trens']}
+
+    def test_snapshot_em(self):
+        self.gravar(10, T1=10.0, T2=20.0)
+        self.gravar(70, T1=30.0, T2=20.0)
+        self.gravar(200, T1=40.0)
+
+        self.assertIsNone(self.replay.snapshot_em(self.BASE + 5))
+        self.assertEqual(self.velocidades(self.replay.snapshot_em(self.BASE + 80)), {'T1': 30.0, 'T2': 20.0})
+        snapshot = self.replay.snapshot_em(self.BASE + 200)
+        self.assertEqual(snapshot['resolucao'], 'bruto')
+        # T2 não tem amostra há mais de DEFASAGEM_MAXIMA
+        self.assertEqual(self.velocidades(snapshot), {'T1': 40.0})
+        self.assertIsNone(self.replay.snapshot_em(self.BASE - 86400))
+
+    def test_quadros_trazem_so_alterados_e_removidos(self):
+        self.gravar(10, T1=10.0, T2=20.0)
+        self.gravar(70, T1=30.0, T2=20.0)
+        self.gravar(200, T1=30.0)
+
+        quadros = self.replay.quadros(self.BASE, self.BASE + 200)
+
+        self.assertEqual([quadro['t'] - self.BASE for quadro in quadros], [10, 70, 200])
+        self.assertEqual(self.velocidades(quadros[0]), {'T1': 10.0, 'T2': 20.0})
+        self.assertEqual(self.velocidades(quadros[1]), {'T1': 30.0})
+        self.assertEqual((quadros[2]['trens'], quadros[2]['removidos']), ([], [self.t2.pk]))
+
+    def test_particao_aberta_le_so_o_que_cresceu(self):
+        self.gravar(10, T1=10.0, T2=20.0)
+        self.replay.snapshot_em(self.BASE + 10)
+        self.gravar(20, T1=15.0, T2=25.0)
+
+        with mock.patch.object(self.armazem, 'ler_particao', wraps=self.armazem.ler_particao) as ler:
+            snapshot = self.replay.snapshot_em(self.BASE + 20)
+        ler.assert_called_once_with('bruto', self.armazem.particao('bruto', self.BASE), desde=2)
+        self.assertEqual(self.velocidades(snapshot), {'T1': 15.0, 'T2': 25.0})
+
+    def test_indice_da_particao_fechada_gravado_e_relido(self):
+        self.gravar(10, T1=10.0, T2=20.0)
+        self.gravar(90, T1=30.0)
+        particao = self.armazem.particao('bruto', self.BASE)
+        caminho = os.path.join(self.armazem.diretorio, 'bruto', particao)
+        self.armazem._gravar_marca(os.path.join(caminho, MARCA_CONSOLIDADA), '3')
+
+        self.replay.snapshot_em(self.BASE + 90)
+        self.assertTrue(os.path.exists(os.path.join(caminho, ARQUIVO_INDICE)))
+        self.assertFalse([nome for nome in os.listdir(caminho) if nome.endswith('.tmp')])
+
+        # Outro processo relê o índice do disco
+        snapshot = ReplayService(self.armazem).snapshot_em(self.BASE + 90)
+        self.assertEqual(self.velocidades(snapshot), {'T1': 30.0, 'T2': 20.0})
+
+    def test_at_invalido(self):
+        futuro = (timezone.now() + timedelta(hours=1)).isoformat()
+        for valor in ('ontem', 'nan', 'inf', '1e300', futuro):
+            with self.subTest(at=valor):
+                self.assertEqual(self.client.get('/api/trens/', {'at': valor}).status_code, 400)
+
+    def test_at_sem_historico(self):
+        self.assertEqual(self.client.get('/api/trens/', {'at': '2020-01-01T00:00:00'}).status_code, 404)
+
+
+def _incrementar_em_outro_processo(cache_compartilhado, vezes):
+    for _ in range(vezes):
+        cache_compartilhado.incr('contador')
+
+
+class CacheEmCamadasTest(SimpleTestCase):
+    """Camada local LRU + arquivos compartilhados, invalidação por geração entre
+    instâncias/processos, add/incr atômicos e expiração"""
+
+    def setUp(self):
+        temporario = tempfile.TemporaryDirectory()
+        self.addCleanup(temporario.cleanup)
+        self.diretorio = temporario.name
+
+    def novo(self, **opcoes):
+        return CacheEmCamadas(self.diretorio, {'OPTIONS': dict({'MAX_ENTRIES': 100}, **opcoes)})
+
+    def test_lru_local_com_reserva_nos_arquivos(self):
+        cache_local = self.novo(MAX_ENTRIES=2)
+        for chave in ('a', 'b', 'c'):
+            cache_local.set(chave, chave.upper())
+        self.assertEqual(list(cache_local._local), [cache_local.make_key('b'), cache_local.make_key('c')])
+        self.assertEqual(cache_local.metricas['descartes_local'], 1)
+
+        # Descartada da camada local, a chave continua na compartilhada
+        self.assertEqual(cache_local.get('a'), 'A')
+        self.assertEqual(cache_local.metricas['acertos_compartilhado'], 1)
+        self.assertEqual(cache_local.get('a'), 'A')
+        self.assertEqual(cache_local.metricas['acertos_local'], 1)
+
+    def test_escrita_de_outra_instancia_invalida_copia_local(self):
+        escritor, leitor = self.novo(), self.novo()
+        escritor.set('estado', 1)
+        self.assertEqual(leitor.get('estado'), 1)
+
+        escritor.set('estado', 2)
+        self.assertEqual(leitor.get('estado'), 2)
+        self.assertEqual(leitor.metricas['invalidacoes_local'], 1)
+
+        escritor.delete('estado')
+        self.assertIsNone(leitor.get('estado'))
+
+        escritor.set('outra', 'x')
+        self.assertEqual(leitor.get('outra'), 'x')
+        escritor.clear()
+        self.assertIsNone(leitor.get('outra'))
+
+    def test_incr_atomico_entre_processos(self):
+        compartilhado = self.novo()
+        compartilhado.set('contador', 0)
+        contexto = multiprocessing.get_context('fork')
+        processos = [contexto.Process(target=_incrementar_em_outro_processo, args=(compartilhado, 50))
+                     for _ in range(4)]
+        for processo in processos:
+            processo.start()
+        _incrementar_em_outro_processo(compartilhado, 50)
+        for processo in processos:
+            processo.join()
+            self.assertEqual(processo.exitcode, 0)
+        self.assertEqual(self.novo().get('contador'), 250)
+        self.assertEqual(compartilhado.get('contador'), 250)
+
+    def test_add_atomico_entre_threads(self):
+        instancias = [self.novo() for _ in range(8)]
+        resultados = []
+        barreira = threading.Barrier(len(instancias))
+
+        def adicionar(instancia, valor):
+            barreira.wait()
+            resultados.append((instancia.add('trava', valor), valor))
+
+        threads = [threading.Thread(target=adicionar, args=(instancia, i)) for i, instancia in enumerate(instancias)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        vencedores = [valor for adicionado, valor in resultados if adicionado]
+        self.assertEqual(len(vencedores), 1)
+        self.assertEqual(self.novo().get('trava'), vencedores[0])
+
+    def test_expiracao(self):
+        cache_local, outro = self.novo(), self.novo()
+        cache_local.set('curta', 'v', timeout=10)
+        cache_local.set('eterna', 'v', timeout=None)
+        self.assertEqual(outro.get('curta'), 'v')
+
+        with mock.patch('cptm_tracker.cache.time.time', return_value=time.time() + 11):
+            self.assertIsNone(cache_local.get('curta'))
+            self.assertIsNone(outro.get('curta'))
+            self.assertEqual(cache_local.get('eterna'), 'v')
+            self.assertTrue(cache_local.add('curta', 'nova'))
+        self.assertEqual(outro.get('curta'), 'nova')
+
+        cache_local.set('eterna', 'v', timeout=0)
+        self.assertIsNone(outro.get('eterna'))
+        with self.assertRaises(ValueError):
+            cache_local.incr('eterna')
+
+
+class AssinantesTest(TestCase):
+    """Alterações de preferências não mexem no índice que outra thread já obteve"""
+
+    def setUp(self):
+        cache.clear()
+        assinantes_service.invalidar()
+        linha = Linha.objects.create(numero='7', nome='Linha 7-Rubi', cor='#CA016B')
+        self.luz, self.lapa = [
+            Estacao.objects.create(nome=nome, linha=linha, codigo=nome.upper(), latitude=-23.5, longitude=-46.6,
+                                   ordem=ordem) for ordem, nome in enumerate(('Luz', 'Lapa'), start=1)
+        ]
+        self.usuario = User.objects.create(username='assinante')
+        self.preferencias = PreferenciasUsuario.objects.create(usuario=self.usuario)
+        self.preferencias.estacoes_favoritas.add(self.luz)
+
+    def test_alteracao_vai_para_um_novo_indice(self):
+        anterior = assinantes_service.obter()
+        estacoes = iter(anterior.por_estacao.items())
+        self.assertEqual(anterior.chegada(self.luz.pk), {self.usuario.pk})
+
+        self.preferencias.estacoes_favoritas.set([self.lapa])
+
+        atual = assinantes_service.obter()
+        self.assertIsNot(atual, anterior)
+        self.assertEqual(atual.chegada(self.luz.pk), frozenset())
+        self.assertEqual(atual.chegada(self.lapa.pk), {self.usuario.pk})
+        # O índice antigo segue intacto e iterável
+        self.assertEqual(anterior.chegada(self.luz.pk), {self.usuario.pk})
+        self.assertEqual(dict(estacoes), {self.luz.pk: {self.usuario.pk}})
+
+
+class PlanejadorRotasTest(TestCase):
+    """Itinerários do GrafoRede numa rede pequena: a linha 7 vai direto de
+    Origem a Destino por um desvio longo; pelas linhas 8, 9 e 10 o caminho é
+    curto, mas com duas baldeações (Troca e Ponte)"""
+
+    @classmethod
+    def setUpTestData(cls):
+        linhas = {
+            numero: Linha.objects.create(numero=numero, nome=f'Linha {numero}', cor='#000000', codigo=f'L{numero}')
+            for numero in ('7', '8', '9', '10', '11')
+        }
+        trajetos = {
+            '7': [('Origem', -23.50, -46.60), ('Norte', -23.30, -46.60), ('Nordeste', -23.30, -46.40),
+                  ('Destino', -23.50, -46.40)],
+            '8': [('Origem', -23.50, -46.60), ('Meio', -23.50, -46.55), ('Troca', -23.50, -46.50)],
+            '9': [('Troca', -23.50, -46.50), ('Ponte', -23.50, -46.45)],
+            '10': [('Ponte', -23.50, -46.45), ('Destino', -23.50, -46.40)],
+            '11': [('Ilha', -24.00, -47.00)],
+        }
+        for numero, estacoes in trajetos.items():
+            for ordem, (nome, latitude, longitude) in enumerate(estacoes, start=1):
+                Estacao.objects.create(nome=nome, linha=linhas[numero], codigo=f'{numero}-{ordem}',
+                                       latitude=latitude, longitude=longitude, ordem=ordem)
+
+    def setUp(self):
+        self.grafo = GrafoRede(RegistroEstacoes.carregar())
+
+    def test_menor_tempo_com_duas_baldeacoes(self):
+        itinerario = self.grafo.planejar('Origem', 'Destino')
+        self.assertEqual(itinerario['baldeacoes'], 2)
+        self.assertEqual([trecho['linha'] for trecho in itinerario['trechos']], ['8', '9', '10'])
+        self.assertEqual([(trecho['embarque'], trecho['desembarque']) for trecho in itinerario['trechos']],
+                         [('Origem', 'Troca'), ('Troca', 'Ponte'), ('Ponte', 'Destino')])
+        self.assertEqual(itinerario['trechos'][0]['paradas'], ['Origem', 'Meio', 'Troca'])
+
+    def test_menos_baldeacoes_aceita_viagem_mais_longa(self):
+        por_tempo = self.grafo.planejar('Origem', 'Destino', criterio='tempo')
+        por_baldeacoes = self.grafo.planejar('Origem', 'Destino', criterio='baldeacoes')
+        self.assertEqual(por_baldeacoes['baldeacoes'], 0)
+        self.assertEqual([trecho['linha'] for trecho in por_baldeacoes['trechos']], ['7'])
+        self.assertGreater(por_baldeacoes['duracao_min'], por_tempo['duracao_min'])
+
+    def test_estacao_desconhecida_ou_inalcancavel(self):
+        self.assertIsNone(self.grafo.planejar('Atlântida', 'Destino'))
+        self.assertIsNone(self.grafo.planejar('Origem', 'Ilha'))
+        self.assertIsNone(self.grafo.planejar('Origem', 'Ilha'))  # agora vindo do memo
+
+    def test_itinerario_memorizado_nao_e_compartilhado(self):
+        primeiro = self.grafo.planejar('Origem', 'Destino')
+        primeiro['trechos'][0]['paradas'].clear()
+        primeiro['estacoes'].pop()
+        primeiro['baldeacoes'] = 99
+
+        segundo = self.grafo.planejar('Origem', 'Destino')
+        self.assertEqual(segundo['baldeacoes'], 2)
+        self.assertEqual(segundo['trechos'][0]['paradas'], ['Origem', 'Meio', 'Troca'])
+        self.assertEqual(segundo['estacoes'][-1].nome, 'Destino')
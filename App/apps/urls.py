@@ -11,10 +11,14 @@ urlpatterns = [
     
     # APIs REST
     path('api/trens/', views.api_trens, name='api_trens'),
+    path('api/trens/posicoes/', views.api_posicoes_trens, name='api_posicoes_trens'),
+    path('api/trens/<str:identificador>/trajetoria/', views.api_trajetoria_trem, name='api_trajetoria_trem'),
     path('api/estacoes/', views.api_estacoes, name='api_estacoes'),
+    path('api/estacoes/proximas/', views.api_estacoes_proximas, name='api_estacoes_proximas'),
     path('api/linha/<str:linha_numero>/', views.api_status_linha, name='api_status_linha'),
     path('api/estacao/<int:estacao_id>/previsao/', views.api_previsao_estacao, name='api_previsao_estacao'),
     path('api/clima/', views.api_clima, name='api_clima'),
     path('api/notificacoes/', views.api_notificacoes, name='api_notificacoes'),
     path('api/rota/', views.api_rota, name='api_rota'),
+    path('api/geocodificar/', views.api_geocodificar, name='api_geocodificar'),
 ]
@@ -1,34 +1,44 @@
 from django.shortcuts import render, get_object_or_404
-from django.http import JsonResponse
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.models import User
 from django.conf import settings
-from .models import Linha, Estacao, Trem, NotificacaoUsuario, PreferenciasUsuario, CondiciaoClimatica, Manutencao
-from cptm_tracker.services.cptm_api import cptm_service
+from django.utils import timezone
+from .models import Linha, Trem, NotificacaoUsuario, PreferenciasUsuario, CondiciaoClimatica, Manutencao
 from cptm_tracker.services.google_maps import maps_service  
+from cptm_tracker.services.frota import frota_service
+from cptm_tracker.services.frota_compartilhada import estado_frota, CAMPOS as CAMPOS_FROTA
+from cptm_tracker.services.estacoes import estacoes_service
+from cptm_tracker.services.rotas import rotas_service, CRITERIOS
+from cptm_tracker.services.eta import eta_service
+from cptm_tracker.services.historico_posicoes import historico_posicoes, STATUS, LOTACAO
+from cptm_tracker.services.replay import replay_service
+from cptm_tracker.instrumentacao import medir
+from .respostas import resposta_condicional, responder_condicional, versoes_dados, JsonResponse
 from cptm_tracker.weather.weather_api import clima_service
 from cptm_tracker.notifications.push import notificacao_service
 import json
+import math
+import time
 from datetime import datetime, timedelta
 
 def mapa(request):
     """Página principal do mapa com trens em tempo real"""
     linhas = Linha.objects.prefetch_related('estacoes', 'trens').all()
-    estacoes = Estacao.objects.all()
+    registro = estacoes_service.obter()
     trens = Trem.objects.select_related('linha', 'estacao_atual').all()
     
     # Preparar dados das estações para o mapa
     estacoes_data = []
-    for estacao in estacoes:
+    for estacao in registro:
         estacoes_data.append({
             'id': estacao.id,
             'nome': estacao.nome,
             'latitude': estacao.latitude,
             'longitude': estacao.longitude,
-            'linha': estacao.linha.numero,
-            'linha_nome': estacao.linha.nome,
-            'linha_cor': estacao.linha.cor,
+            'linha': estacao.linha_numero,
+            'linha_nome': estacao.linha_nome,
+            'linha_cor': estacao.linha_cor,
             'acessivel': estacao.acessivel,
             'tem_elevador': estacao.tem_elevador,
             'tem_escada_rolante': estacao.tem_escada_rolante
@@ -54,8 +64,8 @@ def mapa(request):
             'previsao_chegada': trem.previsao_chegada.isoformat() if trem.previsao_chegada else None
         })
     
-    # Buscar condições climáticas
-    clima_atual = clima_service.obter_clima_atual()
+    # Buscar condições climáticas (sem esperar o provedor; o front-end busca /api/clima/)
+    clima_atual = clima_service.obter_clima_atual(aguardar=False)
     
     # Verificar manutenções ativas
     manutencoes_ativas = Manutencao.objects.filter(
@@ -71,51 +81,155 @@ def mapa(request):
         'clima_json': json.dumps(clima_atual),
         'manutencoes_ativas': manutencoes_ativas,
         'google_maps_api_key': settings.GOOGLE_MAPS_API_KEY,
-        'total_estacoes': estacoes.count(),
+        'total_estacoes': len(registro),
         'total_trens': trens.count(),
         'trens_operacionais': trens.filter(status='operacional').count(),
+        # Só com um channel layer entre processos o push do atualizador chega aos WebSockets
+        'push_compartilhado': settings.CHANNEL_LAYERS['default']['BACKEND'] != 'channels.layers.InMemoryChannelLayer',
     }
     
     return render(request, 'mapa.html', context)
 
 def api_trens(request):
-    """API REST para dados dos trens em tempo real"""
-    trens = Trem.objects.select_related('linha', 'estacao_atual', 'proxima_estacao').all()
-    
-    data = []
-    for trem in trens:
-        data.append({
-            'id': trem.id,
-            'identificador': trem.identificador,
-            'linha': {
-                'numero': trem.linha.numero,
-                'nome': trem.linha.nome,
-                'cor': trem.linha.cor
-            },
-            'lotacao': trem.lotacao,
-            'status': trem.status,
-            'velocidade': trem.velocidade,
-            'direcao': trem.direcao,
-            'ultima_atualizacao': trem.ultima_atualizacao.isoformat(),
-            'estacao_atual': {
-                'nome': trem.estacao_atual.nome,
-                'latitude': trem.estacao_atual.latitude,
-                'longitude': trem.estacao_atual.longitude
-            } if trem.estacao_atual else None,
-            'proxima_estacao': {
-                'nome': trem.proxima_estacao.nome,
-                'latitude': trem.proxima_estacao.latitude,
-                'longitude': trem.proxima_estacao.longitude
-            } if trem.proxima_estacao else None,
-            'posicao_atual': {
-                'latitude': trem.latitude_atual,
-                'longitude': trem.longitude_atual
-            } if trem.latitude_atual and trem.longitude_atual else None,
-            'previsao_chegada': trem.previsao_chegada.isoformat() if trem.previsao_chegada else None
-        })
-    
-    return JsonResponse({'trens': data, 'total': len(data), 'timestamp': datetime.now().isoformat()})
+    """API REST para dados dos trens em tempo real (servida do snapshot da frota)
+
+    Com ``?since=<versao>`` retorna apenas os trens alterados e removidos
+    desde aquela versão, ou o snapshot completo (``"delta": false``) se ela
+    for antiga demais ou desconhecida. Com ``?at=<instante>`` (ISO 8601 ou epoch) retorna a frota reconstruída
+    do histórico de posições naquele instante (médias de 1 ou 15 minutos
+    depois da retenção do histórico bruto; 404 se não houver dados).
+    """
+    if 'at' in request.GET:
+        instante = _ler_instante(request.GET['at'])
+        if instante is None:
+            return JsonResponse({'erro': 'Parâmetro at deve ser um instante ISO 8601 ou epoch'}, status=400)
+        if instante > timezone.now():
+            return JsonResponse({'erro': 'Parâmetro at não pode estar no futuro'}, status=400)
+        snapshot = replay_service.snapshot_em(instante)
+        if snapshot is None:
+            return JsonResponse({'erro': 'Não há histórico de posições para esse instante'}, status=404)
+        return JsonResponse(snapshot)
+
+    desde = request.GET.get('since')
+    if desde is not None:
+        try:
+            snapshot = frota_service.obter_delta(int(desde))
+        except ValueError:
+            return JsonResponse({'erro': 'Parâmetro since deve ser um número inteiro'}, status=400)
+    else:
+        snapshot = frota_service.obter()
+    response = responder_condicional(request, snapshot['corpo'], snapshot['etag'], max_age=5)
+    response['X-Frota-Versao'] = snapshot['versao']
+    return response
+
+def api_posicoes_trens(request):
+    """Posições atuais da frota em formato compacto, lidas do estado compartilhado (mmap)
+
+    Cada trem é uma lista na ordem de ``campos``; não toca banco nem cache.
+    """
+    estado = estado_frota.ler()
+    if estado is None:
+        return JsonResponse({'erro': 'Estado da frota ainda não publicado'}, status=503)
+
+    estacoes = estacoes_service.obter().estacoes
+    tz = timezone.get_current_timezone()
+
+    def estacao(indice):
+        return estacoes[indice].id if 0 <= indice < len(estacoes) else None
+
+    trens = [
+        [
+            trem_id, linha_id, round(latitude, 6), round(longitude, 6), round(velocidade, 1),
+            STATUS[status], LOTACAO[lotacao], estacao(atual), estacao(proxima),
+            estacoes[direcao].nome if 0 <= direcao < len(estacoes) else None,
+            datetime.fromtimestamp(atualizacao, tz=tz).isoformat(),
+            None if math.isnan(previsao) else datetime.fromtimestamp(previsao, tz=tz).isoformat()
+        ]
+        for (trem_id, linha_id, latitude, longitude, velocidade, status, lotacao,
+             atual, proxima, direcao, atualizacao, previsao) in estado['trens']
+    ]
+    with medir('serializacao'):
+        corpo = json.dumps({
+            'versao': estado['versao'],
+            'campos': CAMPOS_FROTA,
+            'trens': trens,
+            'total': len(trens)
+        }, separators=(',', ':')).encode('utf-8')
+    response = responder_condicional(request, corpo, '"posicoes-{}"'.format(estado['versao']), max_age=5)
+    response['X-Frota-Versao'] = estado['versao']
+    return response
+
+def _ler_instante(valor):
+    """Instante (datetime com fuso) a partir de ISO 8601 ou epoch em segundos"""
+    try:
+        epoch = float(valor)
+    except ValueError:
+        epoch = None
+    if epoch is not None:
+        # nan, inf e epochs fora do intervalo de datetime são inválidos (não erro 500)
+        try:
+            return datetime.fromtimestamp(epoch, tz=timezone.get_current_timezone())
+        except (ValueError, OverflowError, OSError):
+            return None
+    try:
+        instante = datetime.fromisoformat(valor)
+    except ValueError:
+        return None
+    return timezone.make_aware(instante) if timezone.is_naive(instante) else instante
+
+def api_trajetoria_trem(request, identificador):
+    """Trajetória de um trem entre ?inicio= e ?fim= (ISO 8601 ou epoch; padrão: última hora)
+
+    A resolução (bruto, 1min ou 15min) é a mais fina ainda retida para o
+    início do intervalo, ou a indicada em ``?resolucao=``.
+    """
+    trem = get_object_or_404(Trem, identificador=identificador)
+    fim = _ler_instante(request.GET['fim']) if 'fim' in request.GET else timezone.now()
+    inicio = _ler_instante(request.GET['inicio']) if 'inicio' in request.GET else (fim - timedelta(hours=1) if fim else None)
+    if inicio is None or fim is None:
+        return JsonResponse({'erro': 'Parâmetros inicio e fim devem ser instantes ISO 8601 ou epoch'}, status=400)
+    resolucao = request.GET.get('resolucao')
+    if resolucao not in (None, 'bruto', '1min', '15min') or inicio > fim:
+        return JsonResponse({'erro': 'Intervalo ou resolução inválidos'}, status=400)
 
+    resolucao, amostras = historico_posicoes.consultar(trem.id, inicio, fim, resolucao)
+    colunas = amostras.colunas
+    posicoes = [
+        {
+            'timestamp': datetime.fromtimestamp(colunas['t'][i], tz=timezone.get_current_timezone()).isoformat(),
+            'latitude': round(colunas['latitude'][i], 6),
+            'longitude': round(colunas['longitude'][i], 6),
+            'velocidade': round(colunas['velocidade'][i], 1),
+            'estacao_atual_id': colunas['estacao'][i] or None,
+            'proxima_estacao_id': colunas['proxima'][i] or None,
+            'status': STATUS[colunas['status'][i]],
+            'lotacao': LOTACAO[colunas['lotacao'][i]]
+        }
+        for i in range(len(amostras))
+    ]
+
+    return JsonResponse({
+        'trem': trem.identificador,
+        'inicio': inicio.isoformat(),
+        'fim': fim.isoformat(),
+        'resolucao': resolucao,
+        'posicoes': posicoes,
+        'total': len(posicoes)
+    })
+
+def _versoes_status_linha(request, linha_numero):
+    return (linha_numero, frota_service.obter()['versao'],
+            versoes_dados.obter('estacoes'), versoes_dados.obter('manutencoes'))
+
+def _versoes_previsao_estacao(request, estacao_id):
+    # Os minutos até a chegada mudam com o relógio: a resposta vale no máximo 1 minuto
+    return (estacao_id, frota_service.obter()['versao'], versoes_dados.obter('estacoes'),
+            versoes_dados.obter('eta'), int(time.time() // 60))
+
+def _versoes_estacoes(request):
+    return (versoes_dados.obter('estacoes'),)
+
+@resposta_condicional(max_age=15, versoes=_versoes_status_linha)
 def api_status_linha(request, linha_numero):
     """API para status específico de uma linha"""
     try:
@@ -124,8 +238,8 @@ def api_status_linha(request, linha_numero):
         # Buscar trens da linha
         trens = Trem.objects.filter(linha=linha).select_related('estacao_atual', 'proxima_estacao')
         
-        # Buscar estações da linha
-        estacoes = Estacao.objects.filter(linha=linha).order_by('ordem')
+        # Estações da linha vêm do registro em memória
+        estacoes = estacoes_service.obter().da_linha(linha.numero)
         
         # Buscar manutenções ativas
         manutencoes = Manutencao.objects.filter(
@@ -148,7 +262,7 @@ def api_status_linha(request, linha_numero):
                 'total_trens': trens.count(),
                 'trens_operacionais': trens_operacionais,
                 'trens_atrasados': trens_atrasados,
-                'total_estacoes': estacoes.count(),
+                'total_estacoes': len(estacoes),
                 'manutencoes_ativas': manutencoes.count()
             },
             'trens': [
@@ -192,43 +306,25 @@ def api_status_linha(request, linha_numero):
     except Exception as e:
         return JsonResponse({'erro': str(e)}, status=400)
 
+@resposta_condicional(max_age=30, versoes=_versoes_previsao_estacao)
 def api_previsao_estacao(request, estacao_id):
     """API para previsão de chegada em uma estação específica"""
     try:
-        estacao = get_object_or_404(Estacao, id=estacao_id)
-        
-        # Buscar trens que têm esta estação como próxima parada
-        trens_chegando = Trem.objects.filter(
-            proxima_estacao=estacao,
-            status='operacional'
-        ).select_related('linha').order_by('previsao_chegada')
+        estacao = estacoes_service.obter().por_id(estacao_id)
+        if estacao is None:
+            return JsonResponse({'erro': 'Estação não encontrada'}, status=404)
         
-        previsoes = []
-        for trem in trens_chegando:
-            if trem.previsao_chegada:
-                minutos_chegada = int((trem.previsao_chegada - datetime.now()).total_seconds() / 60)
-                if minutos_chegada >= 0:  # Apenas previsões futuras
-                    previsoes.append({
-                        'trem_identificador': trem.identificador,
-                        'linha': {
-                            'numero': trem.linha.numero,
-                            'nome': trem.linha.nome,
-                            'cor': trem.linha.cor
-                        },
-                        'minutos_chegada': minutos_chegada,
-                        'previsao_exata': trem.previsao_chegada.isoformat(),
-                        'lotacao': trem.lotacao,
-                        'direcao': trem.direcao
-                    })
+        # Previsões a partir do snapshot da frota e da tabela de tempos por trecho
+        previsoes = eta_service.previsoes_estacao(estacao.id, frota_service.trens_atuais())
         
         data = {
             'estacao': {
                 'id': estacao.id,
                 'nome': estacao.nome,
-                'linha': estacao.linha.nome,
+                'linha': estacao.linha_nome,
                 'acessivel': estacao.acessivel
             },
-            'previsoes': previsoes[:5],  # Máximo 5 próximos trens
+            'previsoes': previsoes,  # Máximo 5 próximos trens
             'timestamp': datetime.now().isoformat()
         }
         
@@ -248,6 +344,8 @@ def api_clima(request):
             clima_data = clima_service.obter_clima_atual(float(lat), float(lng))
         else:
             clima_data = clima_service.obter_clima_atual()
+        if clima_data is None:
+            return JsonResponse({'erro': 'Dados de clima indisponíveis no momento'}, status=503)
         
         # Verificar impactos na operação
         impactos = clima_service.verificar_impacto_operacao(clima_data)
@@ -307,37 +405,44 @@ def api_rota(request):
         if not origem or not destino:
             return JsonResponse({'erro': 'Origem e destino são obrigatórios'}, status=400)
         
-        # Buscar estações
-        try:
-            estacao_origem = Estacao.objects.get(nome=origem)
-            estacao_destino = Estacao.objects.get(nome=destino)
-        except Estacao.DoesNotExist:
+        # Buscar estações no registro em memória
+        registro = estacoes_service.obter()
+        estacao_origem = registro.por_nome(origem)
+        estacao_destino = registro.por_nome(destino)
+        if estacao_origem is None or estacao_destino is None:
             return JsonResponse({'erro': 'Estação não encontrada'}, status=404)
         
-        # Calcular rota
-        rota = maps_service.calcular_rota_entre_estacoes(origem, destino)
+        criterio = request.GET.get('criterio', 'tempo')
+        if criterio not in CRITERIOS:
+            return JsonResponse({'erro': 'Critério inválido'}, status=400)
         
-        # Verificar se precisa de baldeação
-        precisa_baldeacao = estacao_origem.linha != estacao_destino.linha
-        estacoes_baldeacao = []
+        # Calcular rota no grafo da rede (sem chamadas externas)
+        itinerario = rotas_service.planejar(origem, destino, criterio)
+        if itinerario is None:
+            return JsonResponse({'erro': 'Não há rota entre as estações'}, status=404)
+        rota = rotas_service.rota_compativel(itinerario)
         
-        if precisa_baldeacao:
-            # Encontrar estações de baldeação
-            estacoes_baldeacao = Estacao.objects.filter(
-                baldeacao__linha=estacao_destino.linha,
-                linha=estacao_origem.linha
-            ).distinct()
+        # Estações do itinerário onde o passageiro troca de linha
+        trechos = itinerario['trechos']
+        if trechos:
+            estacao_origem = registro.por_nome(origem, linha=trechos[0]['linha'])
+            estacao_destino = registro.por_nome(destino, linha=trechos[-1]['linha'])
+        precisa_baldeacao = itinerario['baldeacoes'] > 0
+        estacoes_baldeacao = [
+            (registro.por_nome(anterior['desembarque'], linha=anterior['linha']), seguinte)
+            for anterior, seguinte in zip(trechos, trechos[1:])
+        ]
         
         data = {
             'origem': {
                 'nome': estacao_origem.nome,
-                'linha': estacao_origem.linha.nome,
+                'linha': estacao_origem.linha_nome,
                 'latitude': estacao_origem.latitude,
                 'longitude': estacao_origem.longitude
             },
             'destino': {
                 'nome': estacao_destino.nome,
-                'linha': estacao_destino.linha.nome,
+                'linha': estacao_destino.linha_nome,
                 'latitude': estacao_destino.latitude,
                 'longitude': estacao_destino.longitude
             },
@@ -346,11 +451,18 @@ def api_rota(request):
             'estacoes_baldeacao': [
                 {
                     'nome': est.nome,
-                    'linha_origem': est.linha.nome,
-                    'linhas_baldeacao': [bal.linha.nome for bal in est.baldeacao.all()]
+                    'linha_origem': est.linha_nome,
+                    'linhas_baldeacao': [seguinte['linha_nome']]
                 }
-                for est in estacoes_baldeacao
+                for est, seguinte in estacoes_baldeacao
             ],
+            'itinerario': {
+                'criterio': criterio,
+                'duracao_min': itinerario['duracao_min'],
+                'distancia_km': itinerario['distancia_km'],
+                'baldeacoes': itinerario['baldeacoes'],
+                'trechos': trechos
+            },
             'timestamp': datetime.now().isoformat()
         }
         
@@ -363,7 +475,7 @@ def dashboard(request):
     """Dashboard administrativo"""
     # Estatísticas gerais
     total_linhas = Linha.objects.count()
-    total_estacoes = Estacao.objects.count()
+    total_estacoes = len(estacoes_service.obter())
     total_trens = Trem.objects.count()
     trens_operacionais = Trem.objects.filter(status='operacional').count()
     
@@ -387,12 +499,11 @@ def dashboard(request):
     
     return render(request, 'dashboard.html', context)
 
+@resposta_condicional(max_age=300, versoes=_versoes_estacoes, timeout=None)
 def api_estacoes(request):
     """API REST para listar todas as estações"""
-    estacoes = Estacao.objects.select_related('linha').all().order_by('linha__numero', 'ordem')
-    
     data = []
-    for estacao in estacoes:
+    for estacao in estacoes_service.obter():
         data.append({
             'id': estacao.id,
             'nome': estacao.nome,
@@ -404,10 +515,75 @@ def api_estacoes(request):
             'tem_escada_rolante': estacao.tem_escada_rolante,
             'acessivel': estacao.acessivel,
             'linha': {
-                'numero': estacao.linha.numero,
-                'nome': estacao.linha.nome,
-                'cor': estacao.linha.cor
+                'numero': estacao.linha_numero,
+                'nome': estacao.linha_nome,
+                'cor': estacao.linha_cor
             }
         })
     
     return JsonResponse({'estacoes': data, 'total': len(data), 'timestamp': datetime.now().isoformat()})
+
+# Maior raio aceito em /api/estacoes/proximas/ (cobre toda a rede da CPTM)
+RAIO_MAXIMO_METROS = 100000
+
+def api_estacoes_proximas(request):
+    """API para estações próximas a uma coordenada (?lat=&lng=&raio=<metros>&limite=)"""
+    try:
+        latitude = float(request.GET['lat'])
+        longitude = float(request.GET['lng'])
+        raio = float(request.GET.get('raio', 2000))
+        limite = int(request.GET['limite']) if 'limite' in request.GET else None
+    except (KeyError, ValueError):
+        return JsonResponse({'erro': 'Parâmetros lat e lng são obrigatórios; raio e limite devem ser numéricos'}, status=400)
+
+    # nan/inf passariam pelas comparações (ou quebrariam a grade espacial): rejeita antes
+    if not all(map(math.isfinite, (latitude, longitude, raio))):
+        return JsonResponse({'erro': 'Parâmetros lat, lng e raio devem ser números finitos'}, status=400)
+    if (not (-90 <= latitude <= 90 and -180 <= longitude <= 180) or not 0 < raio <= RAIO_MAXIMO_METROS
+            or (limite is not None and limite <= 0)):
+        return JsonResponse({'erro': 'Parâmetros fora do intervalo válido'}, status=400)
+
+    proximas = estacoes_service.obter().proximas(latitude, longitude, raio_km=raio / 1000, limite=limite)
+    data = [
+        {
+            'id': estacao.id,
+            'nome': estacao.nome,
+            'latitude': estacao.latitude,
+            'longitude': estacao.longitude,
+            'distancia_metros': round(distancia * 1000),
+            'acessivel': estacao.acessivel,
+            'linha': {
+                'numero': estacao.linha_numero,
+                'nome': estacao.linha_nome,
+                'cor': estacao.linha_cor
+            }
+        }
+        for distancia, estacao in proximas
+    ]
+
+    return JsonResponse({'estacoes': data, 'total': len(data), 'raio': raio, 'timestamp': datetime.now().isoformat()})
+
+def api_geocodificar(request):
+    """API de geocodificação em lote (?endereco=...&endereco=..., até 50).
+
+    Os endereços em cache são respondidos na hora; dos demais, só alguns são
+    consultados por requisição, com prazo total curto. Os que não ficarem
+    prontos vêm em ``pendentes`` e podem ser pedidos de novo em seguida.
+    """
+    enderecos = [e.strip() for e in request.GET.getlist('endereco') if e.strip()]
+    if not enderecos:
+        return JsonResponse({'erro': 'Informe ao menos um endereço'}, status=400)
+    if len(enderecos) > 50:
+        return JsonResponse({'erro': 'Máximo de 50 endereços por requisição'}, status=400)
+
+    resultados, pendentes = maps_service.geocodificar_enderecos(enderecos)
+    pendentes = set(pendentes)
+    return JsonResponse({
+        'resultados': [
+            {'endereco': endereco, 'resultado': resultados[endereco]}
+            for endereco in enderecos if endereco not in pendentes
+        ],
+        'pendentes': [endereco for endereco in enderecos if endereco in pendentes],
+        'total': len(enderecos),
+        'timestamp': datetime.now().isoformat()
+    })
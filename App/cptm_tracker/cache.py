@@ -0,0 +1,348 @@
+"""
+Backend de cache em camadas: LRU em memória por processo na frente de um
+armazenamento em arquivos compartilhado entre processos
+"""
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from hashlib import md5
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+from django.core.files import locks
+from cptm_tracker.instrumentacao import registrar_cache
+
+# Cabeçalho dos arquivos do armazenamento compartilhado: expiração (epoch; 0 = nunca)
+CABECALHO = struct.Struct('<d')
+GERACAO = struct.Struct('<Q')
+
+
+class CacheEmCamadas(BaseCache):
+    """Cache com duas camadas e invalidação por geração.
+
+    - Local: OrderedDict LRU por processo, com o valor serializado, a
+      expiração e a geração de quando foi lido; limitada por ``MAX_ENTRIES``
+      e ``TAMANHO_MAXIMO_LOCAL`` (bytes).
+    - Compartilhada: um arquivo por chave em ``LOCATION``, gravado de forma
+      atômica (arquivo temporário + rename), visível a todos os workers.
+
+    Uma tabela de gerações em ``LOCATION/geracoes`` (mmap) tem um contador por
+    faixa de chaves (hash da chave), incrementado a cada escrita. A cópia
+    local só vale enquanto a geração da faixa não mudar, então um acerto
+    local custa uma leitura de memória, sem syscall, e uma escrita em
+    qualquer processo invalida as cópias dos demais. O slot 0 é a época
+    global, incrementada por ``clear()``.
+
+    Escritas (set/add/incr/delete) são serializadas entre processos por um
+    lock de arquivo, o que torna ``add`` e ``incr`` atômicos.
+    """
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        opcoes = params.get('OPTIONS', {})
+        self._diretorio = os.path.abspath(location)
+        self._tamanho_maximo_local = int(opcoes.get('TAMANHO_MAXIMO_LOCAL', 64 * 1024 * 1024))
+        self._max_entradas_compartilhadas = int(opcoes.get('MAX_ENTRIES_COMPARTILHADO', 20000))
+        self._faixas = int(opcoes.get('FAIXAS', 4096))
+        self._intervalo_limpeza = int(opcoes.get('INTERVALO_LIMPEZA', 500))
+
+        self._lock = threading.Lock()
+        self._lock_escrita = threading.Lock()
+        self._lock_limpeza = threading.Lock()
+        self._local = OrderedDict()  # chave -> (geracao, expira_em, dados)
+        self._bytes_local = 0
+        self._geracoes = None
+        self._arquivo_lock = None
+        self._pid = None
+        self._escritas_desde_limpeza = 0
+        self.metricas = {
+            'acertos_local': 0, 'acertos_compartilhado': 0, 'falhas': 0,
+            'escritas': 0, 'invalidacoes_local': 0, 'descartes_local': 0,
+        }
+
+    # --- API do Django ---------------------------------------------------------
+
+    def get(self, key, default=None, version=None):
+        inicio = time.perf_counter()
+        chave = self.make_and_validate_key(key, version=version)
+        geracao = self._geracao(chave)
+        agora = time.time()
+        with self._lock:
+            entrada = self._local.get(chave)
+            if entrada is not None:
+                if entrada[0] == geracao and (entrada[1] is None or entrada[1] > agora):
+                    self._local.move_to_end(chave)
+                    self.metricas['acertos_local'] += 1
+                    valor = pickle.loads(entrada[2])
+                    registrar_cache(True, time.perf_counter() - inicio)
+                    return valor
+                self._remover_local(chave)
+                self.metricas['invalidacoes_local'] += 1
+
+        lido = self._ler(chave, agora)
+        if lido is None:
+            with self._lock:
+                self.metricas['falhas'] += 1
+            registrar_cache(False, time.perf_counter() - inicio)
+            return default
+        expira_em, dados = lido
+        with self._lock:
+            self.metricas['acertos_compartilhado'] += 1
+            self._guardar_local(chave, geracao, expira_em, dados)
+        valor = pickle.loads(dados)
+        registrar_cache(True, time.perf_counter() - inicio)
+        return valor
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        chave = self.make_and_validate_key(key, version=version)
+        dados = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._escrita():
+            self._gravar(chave, self.get_backend_timeout(timeout), dados)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        chave = self.make_and_validate_key(key, version=version)
+        dados = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._escrita():
+            if self._ler(chave, time.time()) is not None:
+                return False
+            self._gravar(chave, self.get_backend_timeout(timeout), dados)
+            return True
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        chave = self.make_and_validate_key(key, version=version)
+        with self._escrita():
+            lido = self._ler(chave, time.time())
+            if lido is None:
+                return False
+            self._gravar(chave, self.get_backend_timeout(timeout), lido[1])
+            return True
+
+    def incr(self, key, delta=1, version=None):
+        chave = self.make_and_validate_key(key, version=version)
+        with self._escrita():
+            lido = self._ler(chave, time.time())
+            if lido is None:
+                raise ValueError("Key '%s' not found" % key)
+            valor = pickle.loads(lido[1]) + delta
+            self._gravar(chave, lido[0], pickle.dumps(valor, pickle.HIGHEST_PROTOCOL))
+            return valor
+
+    def delete(self, key, version=None):
+        chave = self.make_and_validate_key(key, version=version)
+        with self._escrita():
+            try:
+                os.remove(self._arquivo(chave))
+                removido = True
+            except FileNotFoundError:
+                removido = False
+            self._incrementar_geracao(self._faixa(chave))
+            with self._lock:
+                self._remover_local(chave)
+            return removido
+
+    def has_key(self, key, version=None):
+        return self.get(key, _AUSENTE, version=version) is not _AUSENTE
+
+    def clear(self):
+        with self._escrita():
+            for nome in self._arquivos_cache():
+                try:
+                    os.remove(os.path.join(self._diretorio, nome))
+                except FileNotFoundError:
+                    pass
+            self._incrementar_geracao(0)
+            with self._lock:
+                self._local.clear()
+                self._bytes_local = 0
+
+    def close(self, **kwargs):
+        # Chamado ao fim de cada requisição: mantém a camada local e o mmap abertos
+        pass
+
+    def estatisticas(self):
+        """Contadores de acertos/falhas deste processo e ocupação da camada local"""
+        with self._lock:
+            consultas = self.metricas['acertos_local'] + self.metricas['acertos_compartilhado'] + self.metricas['falhas']
+            return dict(
+                self.metricas,
+                entradas_local=len(self._local),
+                bytes_local=self._bytes_local,
+                taxa_acerto=(consultas - self.metricas['falhas']) / consultas if consultas else 0.0,
+            )
+
+    # --- Camada local --------------------------------------------------------
+
+    def _guardar_local(self, chave, geracao, expira_em, dados):
+        if len(dados) > self._tamanho_maximo_local // 4:
+            return  # valores muito grandes ficam só na camada compartilhada
+        self._remover_local(chave)
+        self._local[chave] = (geracao, expira_em, dados)
+        self._bytes_local += len(dados)
+        while len(self._local) > self._max_entries or self._bytes_local > self._tamanho_maximo_local:
+            _, (_, _, antigos) = self._local.popitem(last=False)
+            self._bytes_local -= len(antigos)
+            self.metricas['descartes_local'] += 1
+
+    def _remover_local(self, chave):
+        entrada = self._local.pop(chave, None)
+        if entrada is not None:
+            self._bytes_local -= len(entrada[2])
+
+    # --- Camada compartilhada ------------------------------------------------
+
+    def _ler(self, chave, agora):
+        """(expira_em, dados) do arquivo da chave, ou None se ausente/expirado"""
+        try:
+            with open(self._arquivo(chave), 'rb') as arquivo:
+                conteudo = arquivo.read()
+        except FileNotFoundError:
+            return None
+        if len(conteudo) < CABECALHO.size:
+            return None
+        expira_em = CABECALHO.unpack_from(conteudo)[0] or None
+        if expira_em is not None and expira_em <= agora:
+            return None
+        try:
+            return expira_em, zlib.decompress(conteudo[CABECALHO.size:])
+        except zlib.error:
+            return None  # arquivo truncado ou corrompido: trata como ausente
+
+    def _gravar(self, chave, expira_em, dados):
+        """Grava a chave (dentro do lock de escrita) e invalida as cópias locais"""
+        if expira_em is not None and expira_em <= time.time():
+            # timeout <= 0: equivale a remover
+            try:
+                os.remove(self._arquivo(chave))
+            except FileNotFoundError:
+                pass
+        else:
+            descritor, temporario = tempfile.mkstemp(dir=self._diretorio, suffix='.tmp')
+            try:
+                with os.fdopen(descritor, 'wb') as arquivo:
+                    arquivo.write(CABECALHO.pack(expira_em or 0))
+                    arquivo.write(zlib.compress(dados, 1))
+                os.replace(temporario, self._arquivo(chave))
+            except BaseException:
+                os.remove(temporario)
+                raise
+
+        geracao = self._incrementar_geracao(self._faixa(chave))
+        with self._lock:
+            self.metricas['escritas'] += 1
+            if expira_em is not None and expira_em <= time.time():
+                self._remover_local(chave)
+            else:
+                self._guardar_local(chave, geracao, expira_em, dados)
+
+        self._escritas_desde_limpeza += 1
+        if self._escritas_desde_limpeza >= self._intervalo_limpeza:
+            self._escritas_desde_limpeza = 0
+            # Fora do lock de escrita: a varredura pode passar por milhares de arquivos
+            threading.Thread(target=self._limpar, daemon=True).start()
+
+    def _limpar(self):
+        """Remove arquivos expirados e, acima do limite, os menos recentemente gravados.
+
+        Roda sem o lock de escrita; cada remoção é um ``os.remove`` isolado, e
+        uma chave regravada no meio da varredura no máximo volta a faltar.
+        """
+        if not self._lock_limpeza.acquire(blocking=False):
+            return  # já há uma varredura em andamento neste processo
+        try:
+            self._varrer()
+        finally:
+            self._lock_limpeza.release()
+
+    def _varrer(self):
+        agora = time.time()
+        vivos = []
+        for nome in self._arquivos_cache():
+            caminho = os.path.join(self._diretorio, nome)
+            try:
+                with open(caminho, 'rb') as arquivo:
+                    cabecalho = arquivo.read(CABECALHO.size)
+                expira_em = CABECALHO.unpack(cabecalho)[0] if len(cabecalho) == CABECALHO.size else 0
+                if expira_em and expira_em <= agora:
+                    os.remove(caminho)
+                else:
+                    vivos.append((os.path.getmtime(caminho), caminho))
+            except (FileNotFoundError, struct.error):
+                continue
+        if len(vivos) > self._max_entradas_compartilhadas:
+            vivos.sort()
+            for _, caminho in vivos[:len(vivos) - self._max_entradas_compartilhadas]:
+                try:
+                    os.remove(caminho)
+                except FileNotFoundError:
+                    pass
+
+    def _arquivos_cache(self):
+        try:
+            return [nome for nome in os.listdir(self._diretorio) if nome.endswith('.cache')]
+        except FileNotFoundError:
+            return []
+
+    def _arquivo(self, chave):
+        return os.path.join(self._diretorio, md5(chave.encode(), usedforsecurity=False).hexdigest() + '.cache')
+
+    # --- Gerações (mmap) e lock entre processos ------------------------------
+
+    def _abrir(self):
+        """Abre (ou reabre após um fork) o mmap de gerações e o arquivo de lock"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            os.makedirs(self._diretorio, exist_ok=True)
+            tamanho = (self._faixas + 1) * GERACAO.size
+            caminho = os.path.join(self._diretorio, 'geracoes')
+            with open(caminho, 'a+b') as arquivo:
+                if os.path.getsize(caminho) < tamanho:
+                    arquivo.truncate(tamanho)
+                self._geracoes = mmap.mmap(arquivo.fileno(), tamanho)
+            # O lock de arquivo é por descritor aberto: cada processo abre o seu
+            self._arquivo_lock = open(os.path.join(self._diretorio, 'lock'), 'a+b')
+            self._pid = os.getpid()
+
+    def _faixa(self, chave):
+        return 1 + zlib.crc32(chave.encode()) % self._faixas
+
+    def _geracao(self, chave):
+        """(época global, geração da faixa da chave)"""
+        self._abrir()
+        return (GERACAO.unpack_from(self._geracoes, 0)[0],
+                GERACAO.unpack_from(self._geracoes, self._faixa(chave) * GERACAO.size)[0])
+
+    def _incrementar_geracao(self, faixa):
+        """Incrementa a geração (dentro do lock de escrita) e retorna a nova (época, faixa)"""
+        posicao = faixa * GERACAO.size
+        GERACAO.pack_into(self._geracoes, posicao, GERACAO.unpack_from(self._geracoes, posicao)[0] + 1)
+        return (GERACAO.unpack_from(self._geracoes, 0)[0], GERACAO.unpack_from(self._geracoes, posicao)[0])
+
+    def _escrita(self):
+        self._abrir()
+        return _LockEscrita(self._lock_escrita, self._arquivo_lock)
+
+
+class _LockEscrita:
+    """Lock de escrita do processo + lock exclusivo do arquivo entre processos"""
+
+    def __init__(self, lock, arquivo):
+        self._lock_thread = lock
+        self._arquivo = arquivo
+
+    def __enter__(self):
+        self._lock_thread.acquire()
+        locks.lock(self._arquivo, locks.LOCK_EX)
+
+    def __exit__(self, *exc):
+        locks.unlock(self._arquivo)
+        self._lock_thread.release()
+
+
+_AUSENTE = object()
@@ -0,0 +1,166 @@
+"""
+Instrumentação por requisição: consultas SQL, cache, chamadas HTTP externas e
+serialização, expostas no header Server-Timing e numa linha de log estruturada
+"""
+import json
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager, ExitStack
+from contextvars import ContextVar
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger('cptm_tracker.instrumentacao')
+
+_medicao_atual = ContextVar('medicao_atual', default=None)
+
+# Listas de parâmetros de tamanho variável (IN (%s, %s, ...)) contam como o mesmo padrão
+_LISTA_PARAMETROS = re.compile(r'\((?:%s, )+%s\)')
+
+
+class Medicao:
+    """Contadores de uma requisição (ou de qualquer bloco medido com ``medir_bloco``)"""
+
+    def __init__(self, detectar_n_mais_1=False):
+        self.inicio = time.perf_counter()
+        self.consultas = 0
+        self.tempo_db = 0.0
+        self.cache_acertos = 0
+        self.cache_falhas = 0
+        self.tempo_cache = 0.0
+        self.tempos = {}    # categoria ('externo', 'serializacao'...) -> segundos
+        self.chamadas = {}  # categoria -> quantidade
+        self.padroes_sql = Counter() if detectar_n_mais_1 else None
+
+    def consulta(self, execute, sql, params, many, context):
+        """execute_wrapper do Django: conta e cronometra cada consulta"""
+        inicio = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.consultas += 1
+            self.tempo_db += time.perf_counter() - inicio
+            if self.padroes_sql is not None:
+                self.padroes_sql[_LISTA_PARAMETROS.sub('(%s)', sql)] += 1
+
+    def n_mais_1(self, limiar):
+        """Padrões de SQL repetidos ``limiar`` vezes ou mais: [(sql, vezes)]"""
+        if not self.padroes_sql:
+            return []
+        return [(sql, vezes) for sql, vezes in self.padroes_sql.most_common() if vezes >= limiar]
+
+    def duracao(self):
+        return time.perf_counter() - self.inicio
+
+    def server_timing(self, n_mais_1=()):
+        """Valor do header Server-Timing (durações em ms)"""
+        partes = [
+            f'db;dur={self.tempo_db * 1000:.1f};desc="{self.consultas} consultas"',
+            f'cache;dur={self.tempo_cache * 1000:.1f};desc="{self.cache_acertos} acertos, {self.cache_falhas} falhas"',
+        ]
+        for categoria, segundos in self.tempos.items():
+            partes.append(f'{categoria};dur={segundos * 1000:.1f};desc="{self.chamadas[categoria]} chamadas"')
+        if n_mais_1:
+            partes.append(f'n1;desc="consultas repetidas: {len(n_mais_1)}"')
+        partes.append(f'total;dur={self.duracao() * 1000:.1f}')
+        return ', '.join(partes)
+
+    def como_dict(self):
+        dados = {
+            'duracao_ms': round(self.duracao() * 1000, 2),
+            'consultas': self.consultas,
+            'db_ms': round(self.tempo_db * 1000, 2),
+            'cache_acertos': self.cache_acertos,
+            'cache_falhas': self.cache_falhas,
+            'cache_ms': round(self.tempo_cache * 1000, 2),
+        }
+        for categoria, segundos in self.tempos.items():
+            dados[f'{categoria}_ms'] = round(segundos * 1000, 2)
+            dados[f'{categoria}_chamadas'] = self.chamadas[categoria]
+        return dados
+
+
+@contextmanager
+def medir_bloco(detectar_n_mais_1=False):
+    """Ativa uma Medicao para o bloco (e as threads/tarefas que herdam o contexto).
+
+    As consultas são contadas em todas as conexões configuradas, mesmo com
+    DEBUG=False. Em medições aninhadas, cache e ``medir`` vão só para a interna.
+    """
+    medicao = Medicao(detectar_n_mais_1)
+    token = _medicao_atual.set(medicao)
+    try:
+        with ExitStack() as pilha:
+            for conexao in connections.all():
+                pilha.enter_context(conexao.execute_wrapper(medicao.consulta))
+            yield medicao
+    finally:
+        _medicao_atual.reset(token)
+
+
+@contextmanager
+def medir(categoria):
+    """Soma o tempo do bloco em ``categoria`` na medição ativa (sem medição, não faz nada)"""
+    medicao = _medicao_atual.get()
+    if medicao is None:
+        yield
+        return
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        medicao.tempos[categoria] = medicao.tempos.get(categoria, 0.0) + time.perf_counter() - inicio
+        medicao.chamadas[categoria] = medicao.chamadas.get(categoria, 0) + 1
+
+
+def registrar_cache(acerto, segundos):
+    """Chamado pelo backend de cache a cada leitura"""
+    medicao = _medicao_atual.get()
+    if medicao is None:
+        return
+    if acerto:
+        medicao.cache_acertos += 1
+    else:
+        medicao.cache_falhas += 1
+    medicao.tempo_cache += segundos
+
+
+class InstrumentacaoMiddleware:
+    """Mede cada requisição e publica o resultado.
+
+    - ``Server-Timing``: db, cache, externo, serializacao e total, visíveis
+      na aba de rede do navegador (INSTRUMENTACAO_HEADER; padrão: DEBUG).
+    - Log ``cptm_tracker.instrumentacao``: uma linha JSON por requisição
+      mais lenta que INSTRUMENTACAO_LOG_MS (0 = todas; None, o padrão = desligado).
+    - INSTRUMENTACAO_N_MAIS_1 (padrão: DEBUG): a mesma consulta repetida
+      INSTRUMENTACAO_LIMIAR_N_MAIS_1 vezes na requisição gera um warning com
+      o SQL — o sintoma de um laço que consulta o banco a cada item.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.header = getattr(settings, 'INSTRUMENTACAO_HEADER', settings.DEBUG)
+        self.log_ms = getattr(settings, 'INSTRUMENTACAO_LOG_MS', None)
+        self.detectar_n_mais_1 = getattr(settings, 'INSTRUMENTACAO_N_MAIS_1', settings.DEBUG)
+        self.limiar_n_mais_1 = getattr(settings, 'INSTRUMENTACAO_LIMIAR_N_MAIS_1', 5)
+
+    def __call__(self, request):
+        with medir_bloco(self.detectar_n_mais_1) as medicao:
+            response = self.get_response(request)
+        n_mais_1 = medicao.n_mais_1(self.limiar_n_mais_1) if self.detectar_n_mais_1 else []
+
+        if self.header:
+            response['Server-Timing'] = medicao.server_timing(n_mais_1)
+
+        for sql, vezes in n_mais_1:
+            logger.warning('Possível N+1 em %s %s: %d execuções de %s', request.method, request.path, vezes, sql)
+
+        if self.log_ms is not None and medicao.duracao() * 1000 >= self.log_ms:
+            registro = {'metodo': request.method, 'caminho': request.path, 'status': response.status_code}
+            registro.update(medicao.como_dict())
+            if n_mais_1:
+                registro['n_mais_1'] = len(n_mais_1)
+            logger.info(json.dumps(registro, ensure_ascii=False))
+        return response
@@ -0,0 +1,141 @@
+"""
+Índice em memória dos usuários inscritos em alertas por estação e por linha
+"""
+import threading
+
+
+class IndiceAssinantes:
+    """Estação -> usuários com ``notificar_chegada`` e linha -> usuários com
+    ``notificar_atraso``, montados a partir das favoritas de PreferenciasUsuario.
+
+    Um índice já publicado pelo AssinantesService não é mais alterado (outras
+    threads podem estar iterando os conjuntos); as alterações vão numa cópia.
+    """
+
+    def __init__(self, por_estacao, por_linha):
+        self.por_estacao = por_estacao
+        self.por_linha = por_linha
+
+    @classmethod
+    def carregar(cls):
+        """Monta o índice com três consultas (preferências e as duas M2M)"""
+        from apps.models import PreferenciasUsuario
+
+        preferencias = {
+            pref_id: (usuario_id, chegada, atraso)
+            for pref_id, usuario_id, chegada, atraso in PreferenciasUsuario.objects.values_list(
+                'id', 'usuario_id', 'notificar_chegada', 'notificar_atraso')
+        }
+
+        por_estacao = {}
+        for pref_id, estacao_id in PreferenciasUsuario.estacoes_favoritas.through.objects.values_list(
+                'preferenciasusuario_id', 'estacao_id'):
+            usuario_id, chegada, _ = preferencias[pref_id]
+            if chegada:
+                por_estacao.setdefault(estacao_id, set()).add(usuario_id)
+
+        por_linha = {}
+        for pref_id, linha_id in PreferenciasUsuario.linhas_favoritas.through.objects.values_list(
+                'preferenciasusuario_id', 'linha_id'):
+            usuario_id, _, atraso = preferencias[pref_id]
+            if atraso:
+                por_linha.setdefault(linha_id, set()).add(usuario_id)
+
+        return cls(por_estacao, por_linha)
+
+    def copia(self):
+        return IndiceAssinantes(
+            {chave: set(usuarios) for chave, usuarios in self.por_estacao.items()},
+            {chave: set(usuarios) for chave, usuarios in self.por_linha.items()},
+        )
+
+    def chegada(self, estacao_id):
+        """Usuários a avisar sobre chegadas nesta estação"""
+        return frozenset(self.por_estacao.get(estacao_id, ()))
+
+    def atraso(self, linha_id):
+        """Usuários a avisar sobre atrasos nesta linha"""
+        return frozenset(self.por_linha.get(linha_id, ()))
+
+    def estacoes_com_assinantes(self):
+        return [estacao_id for estacao_id, usuarios in self.por_estacao.items() if usuarios]
+
+    def atualizar_usuario(self, usuario_id, estacao_ids, linha_ids):
+        """Substitui as inscrições de um usuário (já filtradas pelos flags)"""
+        for indice, novas in ((self.por_estacao, estacao_ids), (self.por_linha, linha_ids)):
+            for chave, usuarios in indice.items():
+                if chave not in novas:
+                    usuarios.discard(usuario_id)
+            for chave in novas:
+                indice.setdefault(chave, set()).add(usuario_id)
+
+    def remover_usuario(self, usuario_id):
+        self.atualizar_usuario(usuario_id, (), ())
+
+
+class AssinantesService:
+    """Mantém o índice de assinantes do processo.
+
+    Alterações feitas neste processo (signals de PreferenciasUsuario e das M2M
+    de favoritas) são aplicadas numa cópia do índice, que substitui o atual de
+    uma vez; a versão 'assinantes' avisa os demais processos, que recarregam o
+    índice no próximo acesso.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._indice = None
+        self._versao = None
+
+    def obter(self):
+        """Índice atual, recarregando do banco se outro processo o alterou"""
+        from apps.respostas import versoes_dados
+
+        versao = versoes_dados.obter('assinantes')
+        indice = self._indice
+        if indice is not None and self._versao == versao:
+            return indice
+
+        with self._lock:
+            if self._indice is None or self._versao != versao:
+                self._indice = IndiceAssinantes.carregar()
+                self._versao = versao
+            return self._indice
+
+    def atualizar_preferencias(self, preferencias):
+        """Reaplica as inscrições de um usuário após salvar suas preferências"""
+        estacao_ids = set(preferencias.estacoes_favoritas.values_list('id', flat=True)) \
+            if preferencias.notificar_chegada else set()
+        linha_ids = set(preferencias.linhas_favoritas.values_list('id', flat=True)) \
+            if preferencias.notificar_atraso else set()
+        self._alterar(lambda indice: indice.atualizar_usuario(preferencias.usuario_id, estacao_ids, linha_ids))
+
+    def remover_usuario(self, usuario_id):
+        self._alterar(lambda indice: indice.remover_usuario(usuario_id))
+
+    def invalidar(self):
+        """Força a recarga do índice em todos os processos"""
+        from apps.respostas import versoes_dados
+
+        versoes_dados.incrementar('assinantes')
+        with self._lock:
+            self._indice = None
+
+    def _alterar(self, alteracao):
+        from apps.respostas import versoes_dados
+
+        with self._lock:
+            versao = versoes_dados.incrementar('assinantes')
+            if self._indice is not None and self._versao is not None and versao == self._versao + 1:
+                # Quem já obteve o índice atual continua iterando-o sem ver a alteração
+                novo = self._indice.copia()
+                alteracao(novo)
+                self._indice = novo
+                self._versao = versao
+            else:
+                # Outro processo também alterou: recarrega no próximo acesso
+                self._indice = None
+
+
+# Instância global do serviço
+assinantes_service = AssinantesService()
@@ -0,0 +1,225 @@
+"""
+Despacho assíncrono de push notifications (OneSignal) em lotes
+"""
+import json
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+
+ONESIGNAL_URL = 'https://onesignal.com/api/v1/notifications'
+
+# Limite do OneSignal para include_external_user_ids por requisição
+LIMITE_DESTINATARIOS = 2000
+
+
+class DespachantePush:
+    """Fila limitada de mensagens push entregue por um pool de threads.
+
+    ``enviar`` só enfileira e retorna imediatamente. Uma thread coletora
+    junta, durante ``janela`` segundos, as mensagens com o mesmo conteúdo e
+    as divide em lotes de até ``tamanho_lote`` destinatários, cada lote uma
+    única chamada à API. As chamadas usam uma sessão HTTP com pool de
+    conexões e são repetidas com backoff exponencial em erros de rede, 429 e
+    5xx. Destinatários que o provedor recusa por não terem dispositivo
+    inscrito são repassados a ``ao_invalidar(usuario_ids)``.
+    """
+
+    def __init__(self, app_id, api_key, url=ONESIGNAL_URL, tamanho_lote=LIMITE_DESTINATARIOS,
+                 trabalhadores=4, capacidade=10000, tentativas=4, espera_inicial=0.5,
+                 janela=0.05, timeout=10, ao_invalidar=None):
+        self.app_id = app_id
+        self.api_key = api_key
+        self.url = url
+        self.ao_invalidar = ao_invalidar
+        self.tamanho_lote = tamanho_lote
+        self.trabalhadores = trabalhadores
+        self.tentativas = tentativas
+        self.espera_inicial = espera_inicial
+        self.janela = janela
+        self.timeout = timeout
+
+        self._fila = queue.Queue(maxsize=capacidade)
+        self._lock = threading.Lock()
+        self._coletor = None
+        self._executor = None
+        self._sessao = None
+        self._em_voo = 0
+        self._ocioso = threading.Condition(self._lock)
+        self._metricas = {
+            'enfileiradas': 0,
+            'descartadas': 0,
+            'lotes_enviados': 0,
+            'lotes_falhos': 0,
+            'destinatarios_entregues': 0,
+            'destinatarios_falhos': 0,
+            'destinatarios_invalidos': 0,
+            'repeticoes': 0,
+            'latencia_total_ms': 0.0
+        }
+
+    @property
+    def habilitado(self):
+        return bool(self.app_id and self.api_key)
+
+    def enviar(self, usuario_ids, titulo, mensagem, dados=None):
+        """Enfileira uma mensagem para os usuários; False se a fila estiver cheia"""
+        usuario_ids = [str(usuario_id) for usuario_id in usuario_ids]
+        if not usuario_ids or not self.habilitado:
+            return False
+        self._iniciar()
+        with self._lock:
+            # Contabiliza antes do put para ``aguardar`` nunca ver a fila vazia com trabalho pendente
+            self._em_voo += 1
+        try:
+            self._fila.put_nowait((titulo, mensagem, dados or {}, usuario_ids))
+        except queue.Full:
+            with self._lock:
+                self._em_voo -= 1
+                self._metricas['descartadas'] += len(usuario_ids)
+                self._ocioso.notify_all()
+            return False
+        with self._lock:
+            self._metricas['enfileiradas'] += len(usuario_ids)
+        return True
+
+    def metricas(self):
+        """Cópia dos contadores de entrega"""
+        with self._lock:
+            metricas = dict(self._metricas)
+            metricas['pendentes'] = self._em_voo
+        lotes = metricas['lotes_enviados'] + metricas['lotes_falhos']
+        metricas['latencia_media_ms'] = metricas['latencia_total_ms'] / lotes if lotes else 0.0
+        return metricas
+
+    def aguardar(self, timeout=None):
+        """Bloqueia até todas as mensagens enfileiradas terem sido processadas"""
+        limite = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while self._em_voo:
+                restante = None if limite is None else limite - time.monotonic()
+                if restante is not None and restante <= 0:
+                    return False
+                self._ocioso.wait(restante)
+        return True
+
+    def _iniciar(self):
+        if self._coletor is not None and self._coletor.is_alive():
+            return
+        with self._lock:
+            if self._coletor is not None and self._coletor.is_alive():
+                return
+            if self._sessao is None:
+                self._sessao = requests.Session()
+                adaptador = HTTPAdapter(pool_connections=1, pool_maxsize=self.trabalhadores)
+                self._sessao.mount('https://', adaptador)
+                self._sessao.mount('http://', adaptador)
+                self._executor = ThreadPoolExecutor(self.trabalhadores, thread_name_prefix='push')
+            self._coletor = threading.Thread(target=self._coletar, name='push-coletor', daemon=True)
+            self._coletor.start()
+
+    def _coletar(self):
+        while True:
+            itens = [self._fila.get()]
+            limite = time.monotonic() + self.janela
+            while True:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    break
+                try:
+                    itens.append(self._fila.get(timeout=restante))
+                except queue.Empty:
+                    break
+
+            # Mesmo conteúdo -> um único conjunto de destinatários
+            grupos = {}
+            for titulo, mensagem, dados, usuario_ids in itens:
+                chave = (titulo, mensagem, json.dumps(dados, sort_keys=True))
+                grupos.setdefault(chave, {'dados': dados, 'ids': {}})['ids'].update(dict.fromkeys(usuario_ids))
+
+            lotes = []
+            for (titulo, mensagem, _), grupo in grupos.items():
+                ids = list(grupo['ids'])
+                for i in range(0, len(ids), self.tamanho_lote):
+                    lotes.append((titulo, mensagem, grupo['dados'], ids[i:i + self.tamanho_lote]))
+
+            with self._lock:
+                # Itens da fila viram lotes: a contagem pendente passa a ser por lote
+                self._em_voo += len(lotes) - len(itens)
+                self._ocioso.notify_all()
+            for lote in lotes:
+                self._executor.submit(self._entregar, *lote)
+
+    def _entregar(self, titulo, mensagem, dados, usuario_ids):
+        payload = {
+            'app_id': self.app_id,
+            'include_external_user_ids': usuario_ids,
+            'headings': {'pt': titulo},
+            'contents': {'pt': mensagem},
+            'data': dados
+        }
+        headers = {
+            'Authorization': f'Basic {self.api_key}',
+            'Content-Type': 'application/json'
+        }
+
+        inicio = time.perf_counter()
+        entregue = False
+        invalidos = []
+        try:
+            for tentativa in range(self.tentativas):
+                espera = self.espera_inicial * (2 ** tentativa) * random.uniform(0.5, 1.5)
+                try:
+                    response = self._sessao.post(self.url, json=payload, headers=headers, timeout=self.timeout)
+                except requests.RequestException as e:
+                    print(f"Erro ao enviar push notification (tentativa {tentativa + 1}): {e}")
+                else:
+                    if response.status_code == 200:
+                        entregue = True
+                        invalidos = self._destinatarios_invalidos(response)
+                        break
+                    if response.status_code != 429 and response.status_code < 500:
+                        print(f"Push notification rejeitada: HTTP {response.status_code}")
+                        break
+                    retry_after = response.headers.get('Retry-After')
+                    if retry_after and retry_after.isdigit():
+                        espera = max(espera, float(retry_after))
+
+                if tentativa + 1 < self.tentativas:
+                    with self._lock:
+                        self._metricas['repeticoes'] += 1
+                    time.sleep(espera)
+        finally:
+            with self._lock:
+                self._metricas['latencia_total_ms'] += (time.perf_counter() - inicio) * 1000
+                if entregue:
+                    self._metricas['lotes_enviados'] += 1
+                    self._metricas['destinatarios_entregues'] += len(usuario_ids) - len(invalidos)
+                    self._metricas['destinatarios_invalidos'] += len(invalidos)
+                else:
+                    self._metricas['lotes_falhos'] += 1
+                    self._metricas['destinatarios_falhos'] += len(usuario_ids)
+            if invalidos and self.ao_invalidar:
+                try:
+                    self.ao_invalidar(invalidos)
+                except Exception as e:
+                    print(f"Erro ao invalidar tokens de push: {e}")
+            with self._lock:
+                self._em_voo -= 1
+                self._ocioso.notify_all()
+        return entregue
+
+    @staticmethod
+    def _destinatarios_invalidos(response):
+        """Ids recusados numa resposta 200 ({'errors': {'invalid_external_user_ids': [...]}})"""
+        try:
+            corpo = response.json()
+        except ValueError:
+            return []
+        erros = corpo.get('errors') if isinstance(corpo, dict) else None
+        if not isinstance(erros, dict):
+            return []
+        return [str(usuario_id) for usuario_id in erros.get('invalid_external_user_ids') or []]
@@ -1,131 +1,179 @@
 """
 Sistema de notificações push e alerts
 """
+import asyncio
 import json
-import requests
 from django.conf import settings
+from django.db import transaction
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 from django.contrib.auth.models import User
+from cptm_tracker.notifications.despacho import DespachantePush, ONESIGNAL_URL
+from cptm_tracker.notifications.supressao import FiltroNotificacoes
 from apps.models import NotificacaoUsuario, PreferenciasUsuario, Trem, Estacao
 from datetime import datetime, timedelta
 
+# Destinatários por bulk_create / consulta IN / rodada de group_send
+TAMANHO_LOTE = 500
+
 class NotificacaoService:
     def __init__(self):
         self.channel_layer = get_channel_layer()
         self.onesignal_app_id = getattr(settings, 'ONESIGNAL_APP_ID', None)
         self.onesignal_api_key = getattr(settings, 'ONESIGNAL_API_KEY', None)
+        self.despachante = DespachantePush(
+            self.onesignal_app_id,
+            self.onesignal_api_key,
+            url=getattr(settings, 'ONESIGNAL_API_URL', ONESIGNAL_URL),
+            ao_invalidar=self.invalidar_tokens
+        )
+        self.filtro = FiltroNotificacoes()
 
     def enviar_notificacao_chegada(self, usuario, trem, estacao, minutos_chegada):
         """Envia notificação de chegada de trem"""
-        try:
-            # Cria notificação no banco
-            notificacao = NotificacaoUsuario.objects.create(
-                usuario=usuario,
-                tipo='chegada',
-                titulo=f'Trem chegando na {estacao.nome}',
-                mensagem=f'O trem {trem.identificador} da {trem.linha.nome} chegará na estação {estacao.nome} em {minutos_chegada} minutos.',
-                estacao=estacao,
-                linha=trem.linha
-            )
+        return self.notificar_chegada([usuario.id], trem, estacao, minutos_chegada) > 0
+
+    def enviar_notificacao_atraso(self, usuario, linha, estacao, motivo):
+        """Envia notificação de atraso"""
+        return self.notificar_atraso([usuario.id], linha, estacao, motivo) > 0
 
-            # Envia via WebSocket
-            self._enviar_websocket(usuario.id, {
-                'tipo': 'chegada',
-                'titulo': notificacao.titulo,
-                'mensagem': notificacao.mensagem,
+    def notificar_chegada(self, usuario_ids, trem, estacao, minutos_chegada):
+        """Notifica a chegada de um trem aos usuários informados (exceto os já
+        avisados sobre este trem/estação ou acima do limite de envios)"""
+        try:
+            usuario_ids = self.filtro.filtrar(usuario_ids, 'chegada', trem.id, estacao.id)
+            titulo = f'Trem chegando na {estacao.nome}'
+            mensagem = f'O trem {trem.identificador} da {trem.linha.nome} chegará na estação {estacao.nome} em {minutos_chegada} minutos.'
+            enviados = self._distribuir(usuario_ids, 'chegada', titulo, mensagem, {
                 'trem_id': trem.identificador,
                 'estacao': estacao.nome,
                 'linha': trem.linha.nome,
-                'minutos': minutos_chegada,
-                'timestamp': datetime.now().isoformat()
-            })
-
-            # Envia push notification se habilitado
-            self._enviar_push_notification(usuario, notificacao.titulo, notificacao.mensagem)
-
-            # Marca como enviada
-            notificacao.enviada = True
-            notificacao.save()
-
-            return True
+                'minutos': minutos_chegada
+            }, estacao=estacao, linha=trem.linha)
+            # Só depois da entrega: se ela falhar, a próxima verificação tenta de novo
+            self.filtro.registrar(usuario_ids, 'chegada', trem.id, estacao.id)
+            return enviados
         except Exception as e:
             print(f"Erro ao enviar notificação de chegada: {e}")
-            return False
+            return 0
 
-    def enviar_notificacao_atraso(self, usuario, linha, estacao, motivo):
-        """Envia notificação de atraso"""
+    def notificar_atraso(self, usuario_ids, linha, estacao, motivo):
+        """Notifica um atraso aos usuários informados (com a mesma supressão)"""
         try:
-            notificacao = NotificacaoUsuario.objects.create(
-                usuario=usuario,
-                tipo='atraso',
-                titulo=f'Atraso na {linha.nome}',
-                mensagem=f'Há atrasos na {linha.nome} próximo à estação {estacao.nome}. Motivo: {motivo}',
-                estacao=estacao,
-                linha=linha
-            )
-
-            self._enviar_websocket(usuario.id, {
-                'tipo': 'atraso',
-                'titulo': notificacao.titulo,
-                'mensagem': notificacao.mensagem,
+            usuario_ids = self.filtro.filtrar(usuario_ids, 'atraso', None, estacao.id)
+            titulo = f'Atraso na {linha.nome}'
+            mensagem = f'Há atrasos na {linha.nome} próximo à estação {estacao.nome}. Motivo: {motivo}'
+            enviados = self._distribuir(usuario_ids, 'atraso', titulo, mensagem, {
                 'linha': linha.nome,
                 'estacao': estacao.nome,
-                'motivo': motivo,
+                'motivo': motivo
+            }, estacao=estacao, linha=linha)
+            self.filtro.registrar(usuario_ids, 'atraso', None, estacao.id)
+            return enviados
+        except Exception as e:
+            print(f"Erro ao enviar notificação de atraso: {e}")
+            return 0
+
+    def _distribuir(self, usuario_ids, tipo, titulo, mensagem, dados, estacao=None, linha=None):
+        """Entrega uma mesma notificação a vários usuários.
+
+        Grava todas as linhas com um bulk_create (já marcadas como enviadas),
+        envia as mensagens WebSocket em lotes e enfileira um único push.
+        Retorna o número de destinatários; se a gravação falhar, levanta a
+        exceção (nada foi entregue). Depois dela, a notificação já está na
+        lista do usuário, e falhas de WebSocket ou push só são registradas.
+        """
+        usuario_ids = list(dict.fromkeys(usuario_ids))
+        if not usuario_ids:
+            return 0
+
+        with transaction.atomic():
+            NotificacaoUsuario.objects.bulk_create(
+                [
+                    NotificacaoUsuario(
+                        usuario_id=usuario_id,
+                        tipo=tipo,
+                        titulo=titulo,
+                        mensagem=mensagem,
+                        estacao=estacao,
+                        linha=linha,
+                        enviada=True
+                    )
+                    for usuario_id in usuario_ids
+                ],
+                batch_size=TAMANHO_LOTE
+            )
+
+        try:
+            self._enviar_websocket_em_lote(usuario_ids, {
+                'tipo': tipo,
+                'titulo': titulo,
+                'mensagem': mensagem,
+                **dados,
                 'timestamp': datetime.now().isoformat()
             })
-
-            self._enviar_push_notification(usuario, notificacao.titulo, notificacao.mensagem)
-
-            notificacao.enviada = True
-            notificacao.save()
-            return True
         except Exception as e:
-            print(f"Erro ao enviar notificação de atraso: {e}")
-            return False
+            print(f"Erro ao enviar notificação via WebSocket: {e}")
+        self.enviar_push_em_lote(usuario_ids, titulo, mensagem)
+        return len(usuario_ids)
 
     def _enviar_websocket(self, usuario_id, data):
         """Envia notificação via WebSocket"""
-        if self.channel_layer:
-            async_to_sync(self.channel_layer.group_send)(
-                f"user_{usuario_id}",
-                {
-                    'type': 'notificacao_chegada',
-                    'data': data
-                }
-            )
+        self._enviar_websocket_em_lote([usuario_id], data)
+
+    def _enviar_websocket_em_lote(self, usuario_ids, data):
+        """Envia a mesma notificação aos grupos ``user_<id>``, com um único
+        async_to_sync e até TAMANHO_LOTE group_send concorrentes por vez"""
+        if not self.channel_layer:
+            return
+
+        mensagem = {'type': 'notificacao_chegada', 'data': data}
+
+        async def enviar():
+            for i in range(0, len(usuario_ids), TAMANHO_LOTE):
+                await asyncio.gather(*(
+                    self.channel_layer.group_send(f"user_{usuario_id}", mensagem)
+                    for usuario_id in usuario_ids[i:i + TAMANHO_LOTE]
+                ))
+
+        async_to_sync(enviar)()
 
     def _enviar_push_notification(self, usuario, titulo, mensagem):
-        """Envia notificação push via OneSignal"""
+        """Enfileira notificação push via OneSignal (entregue em segundo plano)"""
+        return self.enviar_push_em_lote([usuario.id], titulo, mensagem)
+
+    def enviar_push_em_lote(self, usuario_ids, titulo, mensagem):
+        """Enfileira a mesma notificação push para vários usuários.
+
+        Só entram usuários com token de dispositivo (uma consulta por lote);
+        o despachante agrupa os destinatários em chamadas de até 2000 ids.
+        """
         try:
-            if not self.onesignal_app_id or not self.onesignal_api_key:
+            if not self.despachante.habilitado:
                 return False
 
-            # Verifica se usuário tem token de dispositivo
-            if hasattr(usuario, 'preferencias') and usuario.preferencias.token_dispositivo:
-                url = 'https://onesignal.com/api/v1/notifications'
-                payload = {
-                    'app_id': self.onesignal_app_id,
-                    'include_external_user_ids': [str(usuario.id)],
-                    'headings': {'pt': titulo},
-                    'contents': {'pt': mensagem},
-                    'data': {
-                        'tipo': 'cptm_notification',
-                        'usuario_id': usuario.id
-                    }
-                }
-                headers = {
-                    'Authorization': f'Basic {self.onesignal_api_key}',
-                    'Content-Type': 'application/json'
-                }
-                
-                response = requests.post(url, json=payload, headers=headers, timeout=10)
-                return response.status_code == 200
+            com_dispositivo = []
+            for i in range(0, len(usuario_ids), TAMANHO_LOTE):
+                com_dispositivo.extend(
+                    PreferenciasUsuario.objects.filter(
+                        usuario_id__in=usuario_ids[i:i + TAMANHO_LOTE]
+                    ).exclude(token_dispositivo='').values_list('usuario_id', flat=True)
+                )
+            return self.despachante.enviar(
+                com_dispositivo, titulo, mensagem, {'tipo': 'cptm_notification'}
+            )
         except Exception as e:
             print(f"Erro ao enviar push notification: {e}")
         
         return False
 
+    def invalidar_tokens(self, usuario_ids):
+        """Remove o token de dispositivo dos usuários que o OneSignal recusou"""
+        for i in range(0, len(usuario_ids), TAMANHO_LOTE):
+            PreferenciasUsuario.objects.filter(
+                usuario_id__in=usuario_ids[i:i + TAMANHO_LOTE]
+            ).update(token_dispositivo='')
+
     def marcar_como_lida(self, notificacao_id, usuario):
         """Marca notificação como lida"""
         try:
@@ -0,0 +1,118 @@
+"""
+Supressão de notificações repetidas e limite de envios por usuário
+"""
+import threading
+import time
+from collections import deque
+from django.core.cache import cache
+
+# Por quanto tempo o mesmo (usuário, trem, estação, tipo) não é notificado de novo
+JANELAS_DEDUPLICACAO = {
+    'chegada': 10 * 60,  # cobre a antecedência de 5 min da verificação de chegadas
+    'atraso': 30 * 60,
+}
+JANELA_PADRAO = 15 * 60
+
+
+class FiltroNotificacoes:
+    """Decide quais destinatários de um evento devem de fato ser notificados.
+
+    Guarda, em memória, o instante de expiração de cada chave
+    (usuário, trem, estação, tipo) já notificada e os horários dos últimos
+    envios de cada usuário (janela deslizante de ``janela_taxa`` segundos com
+    no máximo ``limite_por_usuario`` envios). O estado é salvo no cache a cada
+    ``intervalo_persistencia`` segundos e mesclado com o de outros processos.
+    """
+
+    CHAVE = 'notificacoes:supressao'
+
+    def __init__(self, limite_por_usuario=10, janela_taxa=3600, intervalo_persistencia=60):
+        self.limite_por_usuario = limite_por_usuario
+        self.janela_taxa = janela_taxa
+        self.intervalo_persistencia = intervalo_persistencia
+        self._lock = threading.Lock()
+        self._enviadas = {}  # (usuario_id, trem_id, estacao_id, tipo) -> expira_em
+        self._envios = {}  # usuario_id -> deque de instantes de envio
+        self._carregado = False
+        self._persistido_em = time.time()
+        self.suprimidas = {'duplicadas': 0, 'limite_usuario': 0}
+
+    def filtrar(self, usuario_ids, tipo, trem_id=None, estacao_id=None, agora=None):
+        """Retorna os usuários que podem receber a notificação (sem registrar o envio).
+
+        Depois da entrega, ``registrar`` deve ser chamado só com os que de fato
+        receberam: uma falha no envio não pode suprimir a próxima tentativa.
+        """
+        agora = agora or time.time()
+        permitidos = []
+        with self._lock:
+            self._carregar()
+            for usuario_id in dict.fromkeys(usuario_ids):
+                if self._enviadas.get(self._chave(usuario_id, tipo, trem_id, estacao_id), 0) > agora:
+                    self.suprimidas['duplicadas'] += 1
+                    continue
+
+                envios = self._envios.get(usuario_id)
+                if envios is not None:
+                    while envios and envios[0] <= agora - self.janela_taxa:
+                        envios.popleft()
+                    if len(envios) >= self.limite_por_usuario:
+                        self.suprimidas['limite_usuario'] += 1
+                        continue
+                permitidos.append(usuario_id)
+        return permitidos
+
+    def registrar(self, usuario_ids, tipo, trem_id=None, estacao_id=None, agora=None):
+        """Registra o envio aos usuários que receberam a notificação"""
+        agora = agora or time.time()
+        janela = JANELAS_DEDUPLICACAO.get(tipo, JANELA_PADRAO)
+        with self._lock:
+            self._carregar()
+            for usuario_id in dict.fromkeys(usuario_ids):
+                envios = self._envios.get(usuario_id)
+                if envios is None:
+                    envios = self._envios[usuario_id] = deque(maxlen=self.limite_por_usuario)
+                envios.append(agora)
+                self._enviadas[self._chave(usuario_id, tipo, trem_id, estacao_id)] = agora + janela
+
+            if agora - self._persistido_em >= self.intervalo_persistencia:
+                self._persistir(agora)
+
+    @staticmethod
+    def _chave(usuario_id, tipo, trem_id, estacao_id):
+        return (usuario_id, trem_id or 0, estacao_id or 0, tipo)
+
+    def _carregar(self):
+        if not self._carregado:
+            self._mesclar(cache.get(self.CHAVE))
+            self._carregado = True
+
+    def _persistir(self, agora):
+        """Descarta entradas vencidas e salva o estado mesclado com o do cache"""
+        self._mesclar(cache.get(self.CHAVE), agora)
+        estado = {
+            'enviadas': self._enviadas,
+            'envios': {usuario_id: list(envios) for usuario_id, envios in self._envios.items()}
+        }
+        cache.set(self.CHAVE, estado, max(max(JANELAS_DEDUPLICACAO.values()), self.janela_taxa))
+        self._persistido_em = agora
+
+    def _mesclar(self, estado, agora=None):
+        agora = agora or time.time()
+        if estado:
+            for chave, expira_em in estado['enviadas'].items():
+                if expira_em > self._enviadas.get(chave, 0):
+                    self._enviadas[chave] = expira_em
+            for usuario_id, instantes in estado['envios'].items():
+                atuais = self._envios.get(usuario_id, ())
+                self._envios[usuario_id] = deque(
+                    sorted(set(atuais) | set(instantes))[-self.limite_por_usuario:],
+                    maxlen=self.limite_por_usuario
+                )
+
+        self._enviadas = {chave: expira_em for chave, expira_em in self._enviadas.items() if expira_em > agora}
+        limite = agora - self.janela_taxa
+        self._envios = {
+            usuario_id: envios for usuario_id, envios in self._envios.items()
+            if envios and envios[-1] > limite
+        }
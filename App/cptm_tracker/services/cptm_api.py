@@ -7,6 +7,8 @@ import random
 from datetime import datetime, timedelta
 from django.conf import settings
 import json
+from cptm_tracker.services.estacoes import estacoes_service
+from cptm_tracker.services.simulador import simulador_frota
 
 # Como a CPTM não possui API pública oficial, vamos usar uma simulação baseada em dados reais
 class CPTMAPIService:
@@ -87,8 +89,17 @@ class CPTMAPIService:
         """Simula posições de trens em tempo real para uma linha"""
         if linha not in self.linhas_cptm:
             return []
+
+        # Linhas com estações no registro: simulador vetorizado (movimento contínuo
+        # ao longo do trajeto); a simulação aleatória abaixo é só fallback
+        trens = simulador_frota.trens_da_linha(linha)
+        if trens:
+            return trens
         
-        estacoes = self.linhas_cptm[linha]['estacoes']
+        # Estações da linha vêm do registro (banco); a lista fixa é só fallback
+        estacoes = [estacao.nome for estacao in estacoes_service.obter().da_linha(linha)]
+        if len(estacoes) < 2:
+            estacoes = self.linhas_cptm[linha]['estacoes']
         trens = []
         
         # Simula 8-12 trens por linha
@@ -0,0 +1,79 @@
+"""
+Fila de escrita: serializa as gravações do processo numa única thread
+"""
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from django.db import close_old_connections
+
+
+class FilaEscrita:
+    """Executa funções de escrita uma de cada vez, na ordem de chegada.
+
+    O SQLite admite um único escritor; com todas as gravações do processo
+    passando por aqui, elas não disputam o lock entre si (só com outros
+    processos, que esperam pelo busy_timeout) e cada uma roda numa transação
+    curta na conexão da thread da fila. Trabalhos enviados com a mesma
+    ``chave`` enquanto o anterior ainda não começou são conflacionados: vale o
+    mais recente (ex.: um ciclo de posições atrasado é substituído pelo novo).
+    """
+
+    def __init__(self, capacidade=100):
+        self.capacidade = capacidade
+        self._condicao = threading.Condition()
+        self._pendentes = OrderedDict()  # chave -> (funcao, args, kwargs, Future)
+        self._sequencia = 0
+        self._thread = None
+        self.metricas = {'executadas': 0, 'conflacionadas': 0, 'erros': 0}
+
+    def enviar(self, funcao, *args, chave=None, **kwargs):
+        """Enfileira ``funcao(*args, **kwargs)`` e retorna um Future com o resultado"""
+        with self._condicao:
+            if chave is not None and chave in self._pendentes:
+                futuro = self._pendentes[chave][3]
+                self._pendentes[chave] = (funcao, args, kwargs, futuro)
+                self.metricas['conflacionadas'] += 1
+                return futuro
+
+            while len(self._pendentes) >= self.capacidade:
+                self._condicao.wait()
+            if chave is None:
+                self._sequencia += 1
+                chave = ('_', self._sequencia)
+            futuro = Future()
+            self._pendentes[chave] = (funcao, args, kwargs, futuro)
+            self._iniciar()
+            self._condicao.notify_all()
+            return futuro
+
+    def executar(self, funcao, *args, chave=None, **kwargs):
+        """Enfileira e espera o resultado (exceções da função são repassadas)"""
+        return self.enviar(funcao, *args, chave=chave, **kwargs).result()
+
+    def _iniciar(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._processar, name='fila-escrita', daemon=True)
+            self._thread.start()
+
+    def _processar(self):
+        while True:
+            with self._condicao:
+                while not self._pendentes:
+                    self._condicao.wait()
+                _, (funcao, args, kwargs, futuro) = self._pendentes.popitem(last=False)
+                self._condicao.notify_all()
+
+            if not futuro.set_running_or_notify_cancel():
+                continue
+            # Respeita CONN_MAX_AGE e descarta conexões quebradas entre trabalhos
+            close_old_connections()
+            try:
+                futuro.set_result(funcao(*args, **kwargs))
+                self.metricas['executadas'] += 1
+            except Exception as e:
+                self.metricas['erros'] += 1
+                futuro.set_exception(e)
+
+
+# Instância global do serviço
+fila_escrita = FilaEscrita()
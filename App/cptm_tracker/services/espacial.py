@@ -0,0 +1,126 @@
+"""
+Índice espacial em grade para consultas de proximidade (raio e k vizinhos)
+"""
+import heapq
+import math
+
+RAIO_TERRA_KM = 6371.0088
+# ~1,1 km de lado em latitude; em São Paulo cada célula tem poucas estações
+TAMANHO_CELULA_GRAUS = 0.01
+KM_POR_GRAU = 111.32
+
+
+def distancia_km(lat1, lng1, lat2, lng2):
+    """Distância haversine entre dois pontos, em km"""
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * RAIO_TERRA_KM * math.asin(math.sqrt(a))
+
+
+class IndiceGrade:
+    """Agrupa pontos em células de uma grade regular de latitude/longitude.
+
+    As consultas só visitam as células que podem conter resultados e calculam
+    a distância haversine exata apenas para os pontos dessas células, então o
+    custo depende da densidade local e não do total de pontos indexados
+    (estações, pontos de ônibus etc.).
+    """
+
+    def __init__(self, latitudes, longitudes, tamanho_celula=TAMANHO_CELULA_GRAUS):
+        self.latitudes = latitudes
+        self.longitudes = longitudes
+        self.tamanho_celula = tamanho_celula
+        self.celulas = {}
+        for indice, (lat, lng) in enumerate(zip(latitudes, longitudes)):
+            self.celulas.setdefault(self._celula(lat, lng), []).append(indice)
+
+        if self.celulas:
+            linhas = [i for i, _ in self.celulas]
+            colunas = [j for _, j in self.celulas]
+            self._limites = (min(linhas), max(linhas), min(colunas), max(colunas))
+        else:
+            self._limites = None
+
+    def __len__(self):
+        return len(self.latitudes)
+
+    def _celula(self, lat, lng):
+        return (math.floor(lat / self.tamanho_celula), math.floor(lng / self.tamanho_celula))
+
+    def _distancia(self, indice, lat, lng):
+        return distancia_km(lat, lng, self.latitudes[indice], self.longitudes[indice])
+
+    def no_raio(self, lat, lng, raio_km):
+        """Pares (distancia_km, indice) dentro do raio, do mais próximo ao mais distante"""
+        if self._limites is None:
+            return []
+        delta_lat = raio_km / KM_POR_GRAU
+        delta_lng = raio_km / (KM_POR_GRAU * max(math.cos(math.radians(lat)), 1e-6))
+        i_min, j_min = self._celula(lat - delta_lat, lng - delta_lng)
+        i_max, j_max = self._celula(lat + delta_lat, lng + delta_lng)
+        # Não percorre células fora da área ocupada pela grade
+        i_min, i_max = max(i_min, self._limites[0]), min(i_max, self._limites[1])
+        j_min, j_max = max(j_min, self._limites[2]), min(j_max, self._limites[3])
+
+        resultado = []
+        for i in range(i_min, i_max + 1):
+            for j in range(j_min, j_max + 1):
+                for indice in self.celulas.get((i, j), ()):
+                    distancia = self._distancia(indice, lat, lng)
+                    if distancia <= raio_km:
+                        resultado.append((distancia, indice))
+        resultado.sort()
+        return resultado
+
+    def mais_proximos(self, lat, lng, k, raio_km=None):
+        """Os ``k`` pontos mais próximos (opcionalmente limitados a ``raio_km``).
+
+        Visita anéis de células ao redor do ponto; para quando a menor
+        distância possível até o próximo anel já supera o k-ésimo candidato.
+        """
+        if self._limites is None or k <= 0:
+            return []
+        ci, cj = self._celula(lat, lng)
+        i_min, i_max, j_min, j_max = self._limites
+        # Distância mínima garantida por anel: lado da célula no eixo mais curto
+        lado_km = self.tamanho_celula * KM_POR_GRAU * min(1.0, math.cos(math.radians(lat)))
+        # Anéis antes de alcançar a área ocupada estão vazios (ponto fora da grade)
+        anel_inicial = max(0, i_min - ci, ci - i_max, j_min - cj, cj - j_max)
+        anel_maximo = max(abs(ci - i_min), abs(ci - i_max), abs(cj - j_min), abs(cj - j_max))
+
+        candidatos = []  # heap de (-distancia, indice) com os k melhores
+        for anel in range(anel_inicial, anel_maximo + 1):
+            limite_anel = (anel - 1) * lado_km if anel else 0.0
+            if raio_km is not None and limite_anel > raio_km:
+                break
+            if len(candidatos) == k and limite_anel > -candidatos[0][0]:
+                break
+            for celula in self._anel(ci, cj, anel):
+                for indice in self.celulas.get(celula, ()):
+                    distancia = self._distancia(indice, lat, lng)
+                    if raio_km is not None and distancia > raio_km:
+                        continue
+                    if len(candidatos) < k:
+                        heapq.heappush(candidatos, (-distancia, indice))
+                    elif distancia < -candidatos[0][0]:
+                        heapq.heapreplace(candidatos, (-distancia, indice))
+
+        return sorted((-distancia, indice) for distancia, indice in candidatos)
+
+    def _anel(self, ci, cj, anel):
+        """Células ocupáveis na borda do quadrado de raio ``anel`` centrado em (ci, cj)"""
+        if anel == 0:
+            yield ci, cj
+            return
+        i_min, i_max, j_min, j_max = self._limites
+        colunas = range(max(cj - anel, j_min), min(cj + anel, j_max) + 1)
+        for i in (ci - anel, ci + anel):
+            if i_min <= i <= i_max:
+                for j in colunas:
+                    yield i, j
+        linhas = range(max(ci - anel + 1, i_min), min(ci + anel - 1, i_max) + 1)
+        for j in (cj - anel, cj + anel):
+            if j_min <= j <= j_max:
+                for i in linhas:
+                    yield i, j
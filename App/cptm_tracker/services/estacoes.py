@@ -0,0 +1,180 @@
+"""
+Registro em memória das estações, compartilhado por views, tarefas e serviços
+"""
+import threading
+import unicodedata
+from array import array
+from collections import namedtuple
+from cptm_tracker.services.espacial import IndiceGrade
+
+EstacaoInfo = namedtuple('EstacaoInfo', [
+    'indice', 'id', 'nome', 'codigo', 'linha_id', 'linha_numero', 'linha_nome',
+    'linha_cor', 'latitude', 'longitude', 'ordem', 'tem_elevador',
+    'tem_escada_rolante', 'acessivel', 'baldeacao',
+])
+
+def normalizar_nome(nome):
+    """Normaliza nome de estação: sem acentos, minúsculo, hífens/traços como espaço"""
+    sem_acentos = unicodedata.normalize('NFKD', nome).encode('ascii', 'ignore').decode('ascii')
+    for traco in ('-', '–', '—'):
+        sem_acentos = sem_acentos.replace(traco, ' ')
+    return ' '.join(sem_acentos.lower().split())
+
+
+class RegistroEstacoes:
+    """Snapshot imutável das estações, em arrays, com índices por id, código,
+    nome normalizado e (linha, ordem).
+
+    As estações ficam ordenadas por (linha, ordem); ``indice`` é a posição de
+    cada uma nos arrays ``latitudes``/``longitudes``/``ids``.
+    """
+
+    def __init__(self, estacoes):
+        self.estacoes = tuple(
+            estacao._replace(indice=i) for i, estacao in enumerate(estacoes)
+        )
+        self.ids = array('q', (e.id for e in self.estacoes))
+        self.latitudes = array('d', (e.latitude for e in self.estacoes))
+        self.longitudes = array('d', (e.longitude for e in self.estacoes))
+
+        self._por_id = {}
+        self._por_codigo = {}
+        self._por_nome = {}
+        self._por_linha_ordem = {}
+        self._por_linha = {}
+        for estacao in self.estacoes:
+            self._por_id[estacao.id] = estacao
+            self._por_codigo[estacao.codigo] = estacao
+            self._por_nome.setdefault(normalizar_nome(estacao.nome), []).append(estacao)
+            self._por_linha_ordem[(estacao.linha_numero, estacao.ordem)] = estacao
+            self._por_linha.setdefault(estacao.linha_numero, []).append(estacao)
+
+        self._por_nome = {nome: tuple(lista) for nome, lista in self._por_nome.items()}
+        self._por_linha = {linha: tuple(lista) for linha, lista in self._por_linha.items()}
+        self.indice_espacial = IndiceGrade(self.latitudes, self.longitudes)
+
+    @classmethod
+    def carregar(cls):
+        """Carrega todas as estações do banco (duas consultas)"""
+        from apps.models import Estacao
+
+        baldeacoes = {}
+        for origem_id, destino_id in Estacao.baldeacao.through.objects.values_list(
+                'from_estacao_id', 'to_estacao_id'):
+            baldeacoes.setdefault(origem_id, []).append(destino_id)
+
+        estacoes = [
+            EstacaoInfo(
+                indice=None,
+                id=estacao.id,
+                nome=estacao.nome,
+                codigo=estacao.codigo,
+                linha_id=estacao.linha_id,
+                linha_numero=estacao.linha.numero,
+                linha_nome=estacao.linha.nome,
+                linha_cor=estacao.linha.cor,
+                latitude=estacao.latitude,
+                longitude=estacao.longitude,
+                ordem=estacao.ordem,
+                tem_elevador=estacao.tem_elevador,
+                tem_escada_rolante=estacao.tem_escada_rolante,
+                acessivel=estacao.acessivel,
+                baldeacao=tuple(sorted(baldeacoes.get(estacao.id, ()))),
+            )
+            for estacao in Estacao.objects.select_related('linha').order_by('linha__numero', 'ordem')
+        ]
+        return cls(estacoes)
+
+    def __len__(self):
+        return len(self.estacoes)
+
+    def __iter__(self):
+        return iter(self.estacoes)
+
+    def por_id(self, estacao_id):
+        return self._por_id.get(estacao_id)
+
+    def por_codigo(self, codigo):
+        return self._por_codigo.get(codigo)
+
+    def por_nome(self, nome, linha=None):
+        """Estação pelo nome; com ``linha``, prefere a estação daquela linha"""
+        candidatas = self._por_nome.get(normalizar_nome(nome), ())
+        if not candidatas:
+            return None
+        if linha is not None:
+            for estacao in candidatas:
+                if estacao.linha_numero == str(linha):
+                    return estacao
+        return candidatas[0]
+
+    def todas_por_nome(self, nome):
+        """Todas as estações com esse nome (uma por linha que passa por ela)"""
+        return self._por_nome.get(normalizar_nome(nome), ())
+
+    def por_linha_ordem(self, linha, ordem):
+        return self._por_linha_ordem.get((str(linha), ordem))
+
+    def da_linha(self, linha):
+        """Estações de uma linha, na ordem do percurso"""
+        return self._por_linha.get(str(linha), ())
+
+    def linhas(self):
+        return tuple(self._por_linha)
+
+    def proximas(self, latitude, longitude, raio_km=None, limite=None):
+        """Estações mais próximas de um ponto, como pares (distancia_km, EstacaoInfo).
+
+        Com ``limite``, devolve as ``limite`` mais próximas (dentro de
+        ``raio_km``, se informado); sem ele, todas as que estão no raio.
+        """
+        if limite is not None:
+            pares = self.indice_espacial.mais_proximos(latitude, longitude, limite, raio_km)
+        else:
+            pares = self.indice_espacial.no_raio(latitude, longitude, raio_km)
+        return [(distancia, self.estacoes[indice]) for distancia, indice in pares]
+
+    def coordenadas(self, nome):
+        """Coordenadas de uma estação no formato {'lat', 'lng'}"""
+        estacao = self.por_nome(nome)
+        if estacao is None:
+            return None
+        return {'lat': estacao.latitude, 'lng': estacao.longitude}
+
+
+class EstacoesService:
+    """Mantém o registro de estações do processo.
+
+    O registro é carregado uma única vez e recarregado quando a versão
+    'estacoes' muda (signals de Linha/Estacao), inclusive se a alteração
+    foi feita por outro processo.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._registro = None
+        self._versao = None
+
+    def obter(self):
+        """Registro atual, recarregando do banco se as estações mudaram"""
+        from apps.respostas import versoes_dados
+
+        versao = versoes_dados.obter('estacoes')
+        registro = self._registro
+        if registro is not None and self._versao == versao:
+            return registro
+
+        with self._lock:
+            if self._registro is None or self._versao != versao:
+                self._registro = RegistroEstacoes.carregar()
+                self._versao = versao
+            return self._registro
+
+    def invalidar(self):
+        """Descarta o registro deste processo (recarregado no próximo acesso)"""
+        with self._lock:
+            self._registro = None
+
+
+# Instância global do serviço
+estacoes_service = EstacoesService()
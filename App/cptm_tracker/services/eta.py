@@ -0,0 +1,249 @@
+"""
+Previsão de chegada (ETA) a partir do histórico de passagens pelas estações
+"""
+import math
+import statistics
+import threading
+from array import array
+from datetime import datetime, timedelta
+from django.core.cache import cache
+from django.db.models import DurationField, ExpressionWrapper, F, Value
+from django.utils import timezone
+from cptm_tracker.services.espacial import distancia_km
+from cptm_tracker.services.estacoes import estacoes_service
+from cptm_tracker.services.rotas import VELOCIDADE_MEDIA_KMH, TEMPO_PARADA_MIN
+
+HORAS_SEMANA = 7 * 24
+
+# Histórico considerado no cálculo da tabela
+DIAS_HISTORICO = 28
+
+# Trechos mais longos que isso são descartados (trem parado/recolhido, dado inconsistente)
+TEMPO_MAXIMO_TRECHO = 60 * 60
+
+
+def hora_da_semana(momento):
+    """Índice 0..167 (segunda 00h = 0) no fuso local"""
+    local = timezone.localtime(momento)
+    return local.weekday() * 24 + local.hour
+
+
+class TabelaETA:
+    """Mediana do tempo entre chegadas consecutivas, por trecho e hora da semana.
+
+    ``segmentos[(origem_id, destino_id)]`` é um array de 168 floats (segundos;
+    NaN quando não há amostras naquela hora) e ``gerais`` guarda a mediana
+    do trecho em todas as horas, usada como primeiro fallback. Sem histórico,
+    o tempo é estimado pela distância entre as estações.
+    """
+
+    def __init__(self, segmentos=None, gerais=None, amostras=0):
+        self.segmentos = segmentos or {}
+        self.gerais = gerais or {}
+        self.amostras = amostras
+
+    @classmethod
+    def calcular(cls, dias=DIAS_HISTORICO):
+        """Monta a tabela a partir das passagens dos últimos ``dias`` dias"""
+        from apps.models import HistoricoTrem
+
+        inicio = timezone.now() - timedelta(days=dias)
+        passagens = HistoricoTrem.objects.filter(chegada__gte=inicio).order_by(
+            'trem_id', 'chegada').values_list('trem_id', 'estacao_id', 'chegada')
+
+        por_hora = {}
+        por_trecho = {}
+        amostras = 0
+        anterior = None
+        for trem_id, estacao_id, chegada in passagens.iterator(chunk_size=2000):
+            if anterior is not None and anterior[0] == trem_id and anterior[1] != estacao_id:
+                segundos = (chegada - anterior[2]).total_seconds()
+                if 0 < segundos <= TEMPO_MAXIMO_TRECHO:
+                    trecho = (anterior[1], estacao_id)
+                    por_hora.setdefault(trecho, {}).setdefault(hora_da_semana(anterior[2]), []).append(segundos)
+                    por_trecho.setdefault(trecho, []).append(segundos)
+                    amostras += 1
+            anterior = (trem_id, estacao_id, chegada)
+
+        segmentos = {}
+        for trecho, horas in por_hora.items():
+            medianas = array('f', [math.nan]) * HORAS_SEMANA
+            for hora, tempos in horas.items():
+                medianas[hora] = statistics.median(tempos)
+            segmentos[trecho] = medianas
+        gerais = {trecho: statistics.median(tempos) for trecho, tempos in por_trecho.items()}
+        return cls(segmentos, gerais, amostras)
+
+    def tempo_trecho(self, origem_id, destino_id, momento):
+        """Tempo previsto (segundos) entre a chegada em ``origem`` e em ``destino``"""
+        trecho = (origem_id, destino_id)
+        medianas = self.segmentos.get(trecho)
+        if medianas is not None:
+            valor = medianas[hora_da_semana(momento)]
+            if not math.isnan(valor):
+                return valor
+        geral = self.gerais.get(trecho)
+        if geral is not None:
+            return geral
+        return self._estimativa_fisica(origem_id, destino_id)
+
+    @staticmethod
+    def _estimativa_fisica(origem_id, destino_id):
+        registro = estacoes_service.obter()
+        origem, destino = registro.por_id(origem_id), registro.por_id(destino_id)
+        if origem is None or destino is None:
+            return 2 * 60
+        km = distancia_km(origem.latitude, origem.longitude, destino.latitude, destino.longitude)
+        return (km / VELOCIDADE_MEDIA_KMH * 60 + TEMPO_PARADA_MIN) * 60
+
+    def para_cache(self):
+        return {
+            'segmentos': {trecho: medianas.tobytes() for trecho, medianas in self.segmentos.items()},
+            'gerais': self.gerais,
+            'amostras': self.amostras
+        }
+
+    @classmethod
+    def do_cache(cls, dados):
+        segmentos = {}
+        for trecho, bruto in dados['segmentos'].items():
+            medianas = array('f')
+            medianas.frombytes(bruto)
+            segmentos[trecho] = medianas
+        return cls(segmentos, dados['gerais'], dados['amostras'])
+
+
+class EtaService:
+    """Registra passagens, mantém a tabela de tempos e calcula previsões.
+
+    A tabela é recalculada por uma tarefa periódica e publicada no cache;
+    cada processo a recarrega quando a versão 'eta' muda.
+    """
+
+    CHAVE_TABELA = 'eta:tabela'
+
+    # Previsão vencida e o trem ainda não chegou: considera chegada iminente
+    ATRASO_MINIMO = timedelta(seconds=30)
+
+    # Chegada registrada como atrasada quando passa da previsão por mais que isso
+    TOLERANCIA_ATRASO = timedelta(minutes=2)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tabela = None
+        self._versao = None
+
+    def obter_tabela(self):
+        from apps.respostas import versoes_dados
+
+        versao = versoes_dados.obter('eta')
+        tabela = self._tabela
+        if tabela is not None and self._versao == versao:
+            return tabela
+
+        with self._lock:
+            if self._tabela is None or self._versao != versao:
+                dados = cache.get(self.CHAVE_TABELA)
+                self._tabela = TabelaETA.do_cache(dados) if dados else TabelaETA()
+                self._versao = versao
+            return self._tabela
+
+    def recalcular(self, dias=DIAS_HISTORICO):
+        """Recalcula a tabela a partir do histórico e a publica para todos os processos"""
+        from apps.respostas import versoes_dados
+
+        tabela = TabelaETA.calcular(dias)
+        cache.set(self.CHAVE_TABELA, tabela.para_cache(), None)
+        versao = versoes_dados.incrementar('eta')
+        with self._lock:
+            self._tabela = tabela
+            self._versao = versao
+        return tabela
+
+    def prever_chegada(self, estacao_atual_id, proxima_estacao_id, chegou_em):
+        """Horário previsto de chegada à próxima estação"""
+        segundos = self.obter_tabela().tempo_trecho(estacao_atual_id, proxima_estacao_id, chegou_em)
+        return chegou_em + timedelta(seconds=segundos)
+
+    def registrar_passagens(self, passagens, agora):
+        """Grava as chegadas do ciclo e fecha (``partida``) a passagem anterior.
+
+        ``passagens`` é uma lista de (trem_id, estacao_id, atrasado) de trens
+        que chegaram a uma nova estação. Duas consultas por ciclo.
+        """
+        from apps.models import HistoricoTrem
+
+        if not passagens:
+            return 0
+        trem_ids = [trem_id for trem_id, _, _ in passagens]
+        for i in range(0, len(trem_ids), 500):
+            HistoricoTrem.objects.filter(
+                trem_id__in=trem_ids[i:i + 500], partida__isnull=True
+            ).update(
+                partida=agora,
+                tempo_parada=ExpressionWrapper(Value(agora) - F('chegada'), output_field=DurationField())
+            )
+        HistoricoTrem.objects.bulk_create(
+            [HistoricoTrem(trem_id=trem_id, estacao_id=estacao_id, chegada=agora, atrasado=atrasado)
+             for trem_id, estacao_id, atrasado in passagens],
+            batch_size=500
+        )
+        return len(passagens)
+
+    def previsoes_estacao(self, estacao_id, trens, agora=None, limite=5):
+        """Próximas chegadas a uma estação, sem consultar o banco.
+
+        ``trens`` são os trens serializados do snapshot da frota. Além dos trens
+        cuja próxima parada é a estação, considera os que vêm na mesma linha em
+        direção a ela, somando as medianas dos trechos intermediários.
+        """
+        agora = agora or timezone.now()
+        registro = estacoes_service.obter()
+        estacao = registro.por_id(estacao_id)
+        if estacao is None:
+            return []
+        tabela = self.obter_tabela()
+        da_linha = registro.da_linha(estacao.linha_numero)
+        posicao = {e.id: i for i, e in enumerate(da_linha)}
+        alvo = posicao[estacao.id]
+
+        previsoes = []
+        for trem in trens:
+            if trem['linha']['numero'] != estacao.linha_numero or trem['status'] != 'operacional':
+                continue
+            if not trem['proxima_estacao'] or not trem['previsao_chegada']:
+                continue
+            proxima = registro.por_nome(trem['proxima_estacao']['nome'], linha=estacao.linha_numero)
+            atual = registro.por_nome(trem['estacao_atual']['nome'], linha=estacao.linha_numero) \
+                if trem['estacao_atual'] else None
+            if proxima is None or proxima.id not in posicao:
+                continue
+
+            i_proxima = posicao[proxima.id]
+            if atual is not None and atual.id in posicao and atual.id != proxima.id:
+                passo = 1 if i_proxima > posicao[atual.id] else -1
+            else:
+                passo = 1 if da_linha[-1].nome == trem['direcao'] else -1
+            if (alvo - i_proxima) * passo < 0:
+                continue  # a estação já ficou para trás
+
+            chegada = max(datetime.fromisoformat(trem['previsao_chegada']), agora + self.ATRASO_MINIMO)
+            for i in range(i_proxima, alvo, passo):
+                chegada += timedelta(seconds=tabela.tempo_trecho(da_linha[i].id, da_linha[i + passo].id, chegada))
+
+            previsoes.append((chegada, {
+                'trem_identificador': trem['identificador'],
+                'linha': trem['linha'],
+                'minutos_chegada': int((chegada - agora).total_seconds() // 60),
+                'previsao_exata': chegada.isoformat(),
+                'paradas_ate_estacao': abs(alvo - i_proxima),
+                'lotacao': trem['lotacao'],
+                'direcao': trem['direcao']
+            }))
+
+        previsoes.sort(key=lambda par: par[0])
+        return [previsao for _, previsao in previsoes[:limite]]
+
+
+# Instância global do serviço
+eta_service = EtaService()
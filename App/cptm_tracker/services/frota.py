@@ -0,0 +1,322 @@
+"""
+Snapshot da frota em tempo real, publicado pelo atualizador de posições
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files import locks
+from asgiref.sync import async_to_sync
+from cptm_tracker.services.frota_compartilhada import estado_frota
+
+
+def serializar_trem(trem):
+    """Converte um trem no formato público da API /api/trens/"""
+    return {
+        'id': trem.id,
+        'identificador': trem.identificador,
+        'linha': {
+            'numero': trem.linha.numero,
+            'nome': trem.linha.nome,
+            'cor': trem.linha.cor
+        },
+        'lotacao': trem.lotacao,
+        'status': trem.status,
+        'velocidade': trem.velocidade,
+        'direcao': trem.direcao,
+        'ultima_atualizacao': trem.ultima_atualizacao.isoformat(),
+        'estacao_atual': {
+            'nome': trem.estacao_atual.nome,
+            'latitude': trem.estacao_atual.latitude,
+            'longitude': trem.estacao_atual.longitude
+        } if trem.estacao_atual else None,
+        'proxima_estacao': {
+            'nome': trem.proxima_estacao.nome,
+            'latitude': trem.proxima_estacao.latitude,
+            'longitude': trem.proxima_estacao.longitude
+        } if trem.proxima_estacao else None,
+        'posicao_atual': {
+            'latitude': trem.latitude_atual,
+            'longitude': trem.longitude_atual
+        } if trem.latitude_atual and trem.longitude_atual else None,
+        'previsao_chegada': trem.previsao_chegada.isoformat() if trem.previsao_chegada else None
+    }
+
+
+class FrotaService:
+    """Mantém o JSON da frota pronto para ser servido sem acessar o banco.
+
+    A cada ciclo o atualizador publica um snapshot versionado no cache
+    compartilhado; cada processo web guarda uma cópia em memória e só consulta
+    o cache, no máximo, uma vez por ``intervalo_sincronizacao`` segundos.
+    """
+
+    CHAVE_SNAPSHOT = 'frota:snapshot'
+    CHAVE_VERSAO = 'frota:versao'
+    CHAVE_DELTA = 'frota:delta:{}'
+
+    # Quantos ciclos de delta ficam disponíveis antes de exigir ressincronização
+    JANELA_DELTAS = 30
+
+    def __init__(self, intervalo_sincronizacao=1.0, caminho_trava=None):
+        self.intervalo_sincronizacao = intervalo_sincronizacao
+        self.caminho_trava = str(caminho_trava or os.path.join(settings.DADOS_DIR, 'frota.lock'))
+        self._lock = threading.Lock()
+        self._lock_publicacao = threading.Lock()
+        self._snapshot = None
+        self._sincronizado_em = 0.0
+        self._deltas = {}
+        self._respostas_delta = {}
+        self._ultimo_ciclo = None
+
+    def publicar(self, trens):
+        """Serializa a frota uma única vez e publica o snapshot e o delta do ciclo.
+
+        Ler a base, incrementar a versão e gravar delta, snapshot e mmap é
+        uma sequência só, sob trava de arquivo: com dois publicadores
+        (simulador e Celery) o delta da versão ``v`` sempre parte de ``v - 1``
+        e um publicador lento não sobrescreve um snapshot mais novo.
+        """
+        dados = [serializar_trem(trem) for trem in trens]
+        estado = {trem['id']: trem for trem in dados}
+
+        with self._trava_publicacao():
+            versao_base, anterior = self._estado_publicado()
+            versao = self._proxima_versao()
+
+            # Delta do ciclo: trens novos ou com algum campo alterado, e remoções
+            base = anterior or {}
+            alterados = [
+                trem_id for trem_id, trem in estado.items()
+                if self._assinatura(trem) != self._assinatura(base.get(trem_id))
+            ]
+            removidos = [trem_id for trem_id in base if trem_id not in estado]
+            if anterior is not None:
+                cache.set(self._chave_delta(versao),
+                          {'base': versao_base, 'alterados': alterados, 'removidos': removidos},
+                          self.JANELA_DELTAS * 60)
+
+            corpo = json.dumps({
+                'delta': False,
+                'trens': dados,
+                'total': len(dados),
+                'versao': versao,
+                'timestamp': datetime.now().isoformat()
+            }, separators=(',', ':')).encode('utf-8')
+
+            snapshot = {'versao': versao, 'corpo': corpo, 'etag': '"frota-{}"'.format(versao)}
+            cache.set(self.CHAVE_SNAPSHOT, snapshot, None)
+            # Depois do cache: quem vir a versão nova no mmap já encontra o snapshot
+            try:
+                estado_frota.publicar(trens, versao)
+            except OSError as e:
+                print(f"Erro ao publicar estado compartilhado da frota: {e}")
+        with self._lock:
+            snapshot['estado'] = estado
+            self._snapshot = snapshot
+            self._sincronizado_em = time.monotonic()
+            self._ultimo_ciclo = {
+                'versao': versao,
+                'alterados': [estado[trem_id] for trem_id in alterados],
+                'removidos': [base[trem_id] for trem_id in removidos]
+            }
+        return versao
+
+    def transmitir(self, channel_layer):
+        """Envia o delta do último ciclo publicado, um lote por linha.
+
+        Cada lote vai para o grupo ``linha_<numero>`` do TremConsumer, com os
+        trens alterados e os ids removidos daquela linha.
+        """
+        ciclo = self._ultimo_ciclo
+        if not channel_layer or ciclo is None:
+            return 0
+
+        lotes = {}
+        for trem in ciclo['alterados']:
+            lotes.setdefault(trem['linha']['numero'], {'trens': [], 'removidos': []})['trens'].append(trem)
+        for trem in ciclo['removidos']:
+            lotes.setdefault(trem['linha']['numero'], {'trens': [], 'removidos': []})['removidos'].append(trem['id'])
+
+        for numero, lote in lotes.items():
+            async_to_sync(channel_layer.group_send)(
+                f"linha_{numero}",
+                {
+                    'type': 'linha_trens',
+                    'data': {
+                        'versao': ciclo['versao'],
+                        'linha': numero,
+                        'trens': lote['trens'],
+                        'removidos': lote['removidos']
+                    }
+                }
+            )
+        return len(lotes)
+
+    def publicar_do_banco(self):
+        """Carrega todos os trens com uma única consulta e publica o snapshot"""
+        from apps.models import Trem
+        trens = Trem.objects.select_related('linha', 'estacao_atual', 'proxima_estacao')
+        return self.publicar(trens)
+
+    def obter(self):
+        """Retorna o snapshot atual ({'versao', 'corpo', 'etag'}) em tempo constante.
+
+        A versão publicada no estado compartilhado (mmap) diz, sem syscall, se
+        a cópia local está em dia; sem ele, o cache é consultado no máximo a
+        cada ``intervalo_sincronizacao`` segundos.
+        """
+        agora = time.monotonic()
+        publicada = estado_frota.versao()
+        if publicada is not None and self._snapshot is not None:
+            # Só igualdade: outro publicador (ou um restart) pode ter trocado a sequência
+            if publicada == self._snapshot['versao']:
+                return self._snapshot
+            self._sincronizado_em = 0.0  # há versão diferente: sincroniza já
+        if self._snapshot is None or agora - self._sincronizado_em >= self.intervalo_sincronizacao:
+            with self._lock:
+                if self._snapshot is None or agora - self._sincronizado_em >= self.intervalo_sincronizacao:
+                    compartilhado = cache.get(self.CHAVE_SNAPSHOT)
+                    if compartilhado and (self._snapshot is None or compartilhado['versao'] != self._snapshot['versao']):
+                        self._snapshot = compartilhado
+                    self._sincronizado_em = agora
+
+        if self._snapshot is None:
+            # Nenhum ciclo publicado ainda (ex.: worker parado): gera a partir do banco
+            self.publicar_do_banco()
+        return self._snapshot
+
+    def trens_atuais(self):
+        """Trens do snapshot atual, já serializados (sem acessar o banco)"""
+        return self._estado_do_snapshot(self.obter()).values()
+
+    def obter_delta(self, desde):
+        """Retorna apenas os trens alterados e removidos após a versão ``desde``.
+
+        Se a versão for antiga demais (fora da janela de deltas) ou
+        desconhecida, devolve o snapshot completo (``"delta": false``) para
+        ressincronização: o cliente descarta os trens que não estão nele.
+        """
+        snapshot = self.obter()
+        versao = snapshot['versao']
+        if desde > versao or versao - desde > self.JANELA_DELTAS:
+            return snapshot
+
+        chave = (versao, desde)
+        resposta = self._respostas_delta.get(chave)
+        if resposta is not None:
+            return resposta
+
+        alterados = set()
+        removidos = set()
+        for versao_delta in range(desde + 1, versao + 1):
+            delta = self._carregar_delta(versao_delta)
+            # Delta ausente ou que não parte da versão anterior: a cadeia quebrou
+            if delta is None or delta.get('base') != versao_delta - 1:
+                return snapshot
+            alterados.update(delta['alterados'])
+            removidos.difference_update(delta['alterados'])
+            removidos.update(delta['removidos'])
+            alterados.difference_update(delta['removidos'])
+
+        estado = self._estado_do_snapshot(snapshot)
+        trens = [estado[trem_id] for trem_id in sorted(alterados) if trem_id in estado]
+        corpo = json.dumps({
+            'delta': True,
+            'desde': desde,
+            'versao': versao,
+            'trens': trens,
+            'removidos': sorted(removidos),
+            'total': len(estado),
+            'timestamp': datetime.now().isoformat()
+        }, separators=(',', ':')).encode('utf-8')
+
+        resposta = {'versao': versao, 'corpo': corpo, 'etag': '"frota-{}-desde-{}"'.format(versao, desde)}
+        with self._lock:
+            # Clientes em dia pedem quase sempre o mesmo ``desde``: guarda só a versão atual
+            self._respostas_delta = {k: v for k, v in self._respostas_delta.items() if k[0] == versao}
+            self._respostas_delta[chave] = resposta
+        return resposta
+
+    def _carregar_delta(self, versao):
+        """Busca o delta de uma versão, mantendo cópia local (deltas são imutáveis)"""
+        delta = self._deltas.get(versao)
+        if delta is None:
+            delta = cache.get(self._chave_delta(versao))
+            if delta is None:
+                return None
+            with self._lock:
+                self._deltas[versao] = delta
+                for antiga in [v for v in self._deltas if v <= versao - self.JANELA_DELTAS]:
+                    del self._deltas[antiga]
+        return delta
+
+    def _estado_do_snapshot(self, snapshot):
+        """Índice id -> trem do snapshot, decodificado uma vez por versão"""
+        estado = snapshot.get('estado')
+        if estado is None:
+            estado = {trem['id']: trem for trem in json.loads(snapshot['corpo'])['trens']}
+            snapshot['estado'] = estado
+        return estado
+
+    def _estado_publicado(self):
+        """(versão, estado) do último snapshot publicado, base do próximo delta.
+
+        Vem do cache compartilhado, não da cópia local: com mais de um
+        publicador (simulador e Celery), a cópia local pode estar atrasada.
+        """
+        snapshot = cache.get(self.CHAVE_SNAPSHOT)
+        if snapshot is None:
+            return None, None
+        local = self._snapshot
+        if local is not None and local['versao'] == snapshot['versao']:
+            snapshot = local  # mesma versão: reaproveita o estado já decodificado
+        return snapshot['versao'], self._estado_do_snapshot(snapshot)
+
+    @contextmanager
+    def _trava_publicacao(self):
+        """Exclusão mútua entre publicadores (threads e processos)"""
+        os.makedirs(os.path.dirname(self.caminho_trava), exist_ok=True)
+        with open(self.caminho_trava, 'a+b') as trava, self._lock_publicacao:
+            locks.lock(trava, locks.LOCK_EX)
+            try:
+                yield
+            finally:
+                locks.unlock(trava)
+
+    def _chave_delta(self, versao):
+        return self.CHAVE_DELTA.format(versao)
+
+    @staticmethod
+    def _assinatura(trem):
+        """Campos que caracterizam mudança (``ultima_atualizacao`` muda a cada save)"""
+        if trem is None:
+            return None
+        return {campo: valor for campo, valor in trem.items() if campo != 'ultima_atualizacao'}
+
+    def _proxima_versao(self):
+        """Incrementa a versão global da frota de forma monotônica.
+
+        O contador parte do relógio (ms), como em ``VersoesDados``: depois de
+        um restart ou de o cache ser limpo, as versões continuam acima de
+        todas as já entregues, sem repetir ETags nem bases de delta.
+        """
+        semente = max(
+            self._snapshot['versao'] if self._snapshot else 0,
+            estado_frota.versao() or 0,
+            int(time.time() * 1000)
+        )
+        cache.add(self.CHAVE_VERSAO, semente, None)
+        try:
+            return cache.incr(self.CHAVE_VERSAO)
+        except ValueError:
+            cache.set(self.CHAVE_VERSAO, semente + 1, None)
+            return semente + 1
+
+
+# Instância global do serviço
+frota_service = FrotaService()
@@ -0,0 +1,185 @@
+"""
+Estado da frota em memória compartilhada (mmap) entre os processos web
+"""
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from django.conf import settings
+from django.core.files import locks
+from cptm_tracker.services.historico_posicoes import STATUS, LOTACAO
+
+# Cabeçalho: assinatura, versão do layout, tamanho do registro, sequência (seqlock),
+# versão da frota, quantidade de trens, capacidade, instante da publicação
+CABECALHO = struct.Struct('<4sHHQQIId')
+ASSINATURA = b'FROT'
+VERSAO_LAYOUT = 1
+
+# Um registro por trem: id, linha_id, latitude, longitude, velocidade (float32),
+# status e lotação (enums), índices no registro de estações da estação atual,
+# próxima e terminal (-1 = nenhuma), última atualização e previsão (epoch; NaN = nenhuma)
+REGISTRO = struct.Struct('<iifffBBhhhxxxxdd')
+CAMPOS = ('id', 'linha_id', 'latitude', 'longitude', 'velocidade', 'status', 'lotacao',
+          'estacao_atual', 'proxima_estacao', 'direcao', 'ultima_atualizacao', 'previsao_chegada')
+
+POSICAO_SEQUENCIA = 8
+POSICAO_VERSAO = 16
+POSICAO_CAPACIDADE = 28
+
+
+class EstadoFrotaCompartilhado:
+    """Array de registros de tamanho fixo num arquivo mapeado em memória.
+
+    O atualizador de posições grava a frota inteira a cada ciclo; os workers
+    leem direto do mapeamento, sem banco nem cache. A consistência vem de um
+    seqlock: o escritor torna a sequência ímpar, grava e a torna par de novo;
+    o leitor repete a leitura se a sequência era ímpar ou mudou no meio.
+    """
+
+    def __init__(self, caminho=None, capacidade_inicial=256):
+        self.caminho = str(caminho or getattr(
+            settings, 'FROTA_COMPARTILHADA_PATH', os.path.join(settings.DADOS_DIR, 'frota.mmap')))
+        self.capacidade_inicial = capacidade_inicial
+        self._lock = threading.Lock()
+        self._mapa = None
+        self._pid = None
+
+    # --- Escrita (atualizador) -----------------------------------------------
+
+    def publicar(self, trens, versao):
+        """Grava os trens (objetos Trem) e a versão da frota de forma atômica para os leitores"""
+        from cptm_tracker.services.estacoes import estacoes_service
+
+        registro = estacoes_service.obter()
+
+        def indice(estacao_id):
+            info = registro.por_id(estacao_id) if estacao_id else None
+            return info.indice if info else -1
+
+        dados = bytearray()
+        quantidade = 0
+        for trem in trens:
+            if trem.latitude_atual is None or trem.longitude_atual is None:
+                continue
+            terminal = registro.por_nome(trem.direcao, linha=trem.linha.numero) if trem.direcao else None
+            dados += REGISTRO.pack(
+                trem.id,
+                trem.linha_id,
+                trem.latitude_atual,
+                trem.longitude_atual,
+                trem.velocidade or 0.0,
+                STATUS.index(trem.status) if trem.status in STATUS else 0,
+                LOTACAO.index(trem.lotacao) if trem.lotacao in LOTACAO else 0,
+                indice(trem.estacao_atual_id),
+                indice(trem.proxima_estacao_id),
+                terminal.indice if terminal else -1,
+                trem.ultima_atualizacao.timestamp() if trem.ultima_atualizacao else time.time(),
+                trem.previsao_chegada.timestamp() if trem.previsao_chegada else math.nan,
+            )
+            quantidade += 1
+
+        os.makedirs(os.path.dirname(self.caminho), exist_ok=True)
+        with open(self.caminho + '.lock', 'a+b') as trava, self._lock:
+            locks.lock(trava, locks.LOCK_EX)
+            try:
+                mapa = self._mapear(para_escrita=True, capacidade=quantidade)
+                _, _, _, sequencia, _, _, capacidade, _ = CABECALHO.unpack_from(mapa)
+                struct.pack_into('<Q', mapa, POSICAO_SEQUENCIA, sequencia + 1)  # ímpar: gravando
+                mapa[CABECALHO.size:CABECALHO.size + len(dados)] = dados
+                CABECALHO.pack_into(mapa, 0, ASSINATURA, VERSAO_LAYOUT, REGISTRO.size, sequencia + 1,
+                                    versao, quantidade, capacidade, time.time())
+                struct.pack_into('<Q', mapa, POSICAO_SEQUENCIA, sequencia + 2)  # par: pronto
+            finally:
+                locks.unlock(trava)
+        return quantidade
+
+    # --- Leitura (workers) ---------------------------------------------------
+
+    def versao(self):
+        """Versão da frota publicada, ou None se o estado compartilhado não existe"""
+        mapa = self._mapear()
+        if mapa is None:
+            return None
+        return struct.unpack_from('<Q', mapa, POSICAO_VERSAO)[0]
+
+    def ler(self, tentativas=100):
+        """Snapshot consistente: {'versao', 'publicado_em', 'trens': [tuplas na ordem de CAMPOS]}.
+
+        Os registros são decodificados direto do mapeamento (sem copiar o
+        buffer); retorna None se não houver estado publicado.
+        """
+        for _ in range(tentativas):
+            mapa = self._mapear()
+            if mapa is None:
+                return None
+            inicio = struct.unpack_from('<Q', mapa, POSICAO_SEQUENCIA)[0]
+            if inicio & 1:
+                time.sleep(0)
+                continue
+            _, _, _, _, versao, quantidade, capacidade, publicado_em = CABECALHO.unpack_from(mapa)
+            if CABECALHO.size + capacidade * REGISTRO.size > len(mapa):
+                self._descartar_mapa()  # o escritor aumentou o arquivo: remapeia
+                continue
+            with memoryview(mapa) as visao:
+                trens = list(REGISTRO.iter_unpack(visao[CABECALHO.size:CABECALHO.size + quantidade * REGISTRO.size]))
+            if struct.unpack_from('<Q', mapa, POSICAO_SEQUENCIA)[0] == inicio:
+                return {'versao': versao, 'publicado_em': publicado_em, 'trens': trens}
+        return None
+
+    # --- Mapeamento ----------------------------------------------------------
+
+    def _mapear(self, para_escrita=False, capacidade=0):
+        """Mapeamento do arquivo no processo atual (refeito após fork ou crescimento)"""
+        if self._pid != os.getpid():
+            self._mapa = None
+            self._pid = os.getpid()
+        if self._mapa is not None and not para_escrita:
+            return self._mapa
+
+        try:
+            tamanho_atual = os.path.getsize(self.caminho)
+        except OSError:
+            tamanho_atual = 0
+        if not para_escrita:
+            if tamanho_atual < CABECALHO.size:
+                return None
+            with open(self.caminho, 'r+b') as arquivo:
+                mapa = mmap.mmap(arquivo.fileno(), tamanho_atual)
+            if bytes(mapa[:4]) != ASSINATURA or struct.unpack_from('<H', mapa, 6)[0] != REGISTRO.size:
+                mapa.close()
+                return None
+            self._mapa = mapa
+            return mapa
+
+        # Escritor: garante cabeçalho válido e espaço para ``capacidade`` registros
+        capacidade_atual = (tamanho_atual - CABECALHO.size) // REGISTRO.size if tamanho_atual else 0
+        valido = self._mapa is not None and bytes(self._mapa[:4]) == ASSINATURA and \
+            struct.unpack_from('<H', self._mapa, 6)[0] == REGISTRO.size
+        if valido and capacidade <= capacidade_atual and len(self._mapa) == tamanho_atual:
+            return self._mapa
+
+        nova_capacidade = max(capacidade_atual, self.capacidade_inicial)
+        while nova_capacidade < capacidade:
+            nova_capacidade *= 2
+        tamanho = CABECALHO.size + nova_capacidade * REGISTRO.size
+        with open(self.caminho, 'a+b') as arquivo:
+            if tamanho_atual < tamanho:
+                arquivo.truncate(tamanho)
+            mapa = mmap.mmap(arquivo.fileno(), tamanho)
+        if bytes(mapa[:4]) != ASSINATURA or struct.unpack_from('<H', mapa, 6)[0] != REGISTRO.size:
+            CABECALHO.pack_into(mapa, 0, ASSINATURA, VERSAO_LAYOUT, REGISTRO.size, 0, 0, 0, nova_capacidade, 0.0)
+        else:
+            struct.pack_into('<I', mapa, POSICAO_CAPACIDADE, nova_capacidade)
+        self._descartar_mapa()
+        self._mapa = mapa
+        return mapa
+
+    def _descartar_mapa(self):
+        # Sem close(): outra thread pode estar lendo o mapeamento antigo; o GC o fecha
+        self._mapa = None
+
+
+# Instância global do serviço
+estado_frota = EstadoFrotaCompartilhado()
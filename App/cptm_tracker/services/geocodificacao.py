@@ -0,0 +1,207 @@
+"""
+Cache persistente de geocodificação e fila com limite de taxa para o Nominatim
+"""
+import queue
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future, wait
+from datetime import timedelta
+from django.utils import timezone
+
+
+def normalizar_endereco(endereco):
+    """Chave do cache: sem acentos, minúsculo, sem pontuação e espaços repetidos"""
+    sem_acentos = unicodedata.normalize('NFKD', endereco).encode('ascii', 'ignore').decode('ascii')
+    return ' '.join(re.sub(r'[^\w]+', ' ', sem_acentos.lower()).split())[:255]
+
+
+class FilaLimitada:
+    """Executa consultas a um provedor em uma única thread, no máximo uma por
+    ``intervalo`` segundos (política de uso do Nominatim: 1 req/s).
+
+    Pedidos repetidos do mesmo endereço enquanto ele ainda está na fila
+    compartilham o mesmo resultado.
+    """
+
+    def __init__(self, consultar, intervalo=1.0, tamanho_maximo=1000):
+        self.consultar = consultar
+        self.intervalo = intervalo
+        self._fila = queue.Queue(maxsize=tamanho_maximo)
+        self._lock = threading.Lock()
+        self._pendentes = {}
+        self._thread = None
+        self._ultima_consulta = 0.0
+
+    def enviar(self, endereco):
+        """Enfileira uma consulta e retorna um Future com o resultado"""
+        with self._lock:
+            futuro = self._pendentes.get(endereco)
+            if futuro is not None:
+                return futuro
+            futuro = self._pendentes[endereco] = Future()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._processar, daemon=True)
+                self._thread.start()
+        try:
+            self._fila.put_nowait(endereco)
+        except queue.Full:
+            with self._lock:
+                self._pendentes.pop(endereco, None)
+            futuro.set_exception(RuntimeError('Fila de geocodificação cheia'))
+        return futuro
+
+    def _processar(self):
+        while True:
+            endereco = self._fila.get()
+            espera = self._ultima_consulta + self.intervalo - time.monotonic()
+            if espera > 0:
+                time.sleep(espera)
+            with self._lock:
+                futuro = self._pendentes.pop(endereco, None)
+            try:
+                resultado = self.consultar(endereco)
+            except Exception as e:
+                futuro.set_exception(e)
+            else:
+                futuro.set_result(resultado)
+            finally:
+                self._ultima_consulta = time.monotonic()
+                self._fila.task_done()
+
+
+class CacheGeocodificacao:
+    """Resultados de geocodificação em memória (LRU) e no banco.
+
+    Endereços não encontrados também são guardados (cache negativo), por um
+    prazo menor. Erros do provedor (rede, limite de taxa) não são guardados.
+    ``buscar(endereco)`` deve retornar um Future com o resultado, None quando
+    o endereço não existe, ou exceção em caso de falha. O resultado é guardado
+    quando o Future termina, mesmo que quem pediu já tenha desistido de esperar.
+    """
+
+    def __init__(self, buscar, limite_memoria=2048, validade=timedelta(days=90),
+                 validade_negativa=timedelta(days=1), maximo_consultas=5, prazo=5.0):
+        self.buscar = buscar
+        self.limite_memoria = limite_memoria
+        self.maximo_consultas = maximo_consultas
+        self.prazo = prazo
+        self.validade = validade
+        self.validade_negativa = validade_negativa
+        self._lock = threading.Lock()
+        self._memoria = OrderedDict()  # chave -> (resultado, expira_em)
+
+    def obter(self, endereco, prazo=60):
+        """Geocodifica um endereço, consultando o provedor só em caso de falta"""
+        resultados, _ = self.obter_varios([endereco], prazo=prazo)
+        return resultados[endereco]
+
+    def obter_varios(self, enderecos, prazo=None):
+        """Geocodifica vários endereços: uma consulta ao banco para todos e o
+        provedor apenas para os que faltarem.
+
+        As faltas (no máximo ``maximo_consultas``) são enfileiradas de uma vez
+        e aguardadas juntas até ``prazo`` segundos no total. Retorna
+        ({endereco: resultado}, [pendentes]): os pendentes continuam sendo
+        resolvidos em segundo plano e entram no cache para o próximo pedido.
+        """
+        from apps.models import EnderecoGeocodificado
+
+        chaves = {endereco: normalizar_endereco(endereco) for endereco in enderecos}
+        encontrados = {}
+        faltando = set()
+        for chave in set(chaves.values()):
+            achou, resultado = self._da_memoria(chave)
+            if achou:
+                encontrados[chave] = resultado
+            else:
+                faltando.add(chave)
+
+        if faltando:
+            agora = timezone.now()
+            for registro in EnderecoGeocodificado.objects.filter(chave__in=faltando):
+                validade = self.validade if registro.encontrado else self.validade_negativa
+                if registro.atualizado_em + validade <= agora:
+                    continue
+                resultado = self._resultado_do_registro(registro)
+                encontrados[registro.chave] = resultado
+                faltando.discard(registro.chave)
+                self._guardar_memoria(registro.chave, resultado, registro.atualizado_em + validade)
+
+        originais = {}
+        for endereco, chave in chaves.items():
+            if chave in faltando and len(originais) < self.maximo_consultas:
+                originais.setdefault(chave, endereco)
+        futuros = {}
+        for chave, endereco in originais.items():
+            futuro = self.buscar(endereco)
+            futuro.add_done_callback(lambda f, chave=chave, endereco=endereco: self._concluir(chave, endereco, f))
+            futuros[futuro] = chave
+        if futuros:
+            concluidos, _ = wait(futuros, timeout=self.prazo if prazo is None else prazo)
+            for futuro in concluidos:
+                # Erro do provedor: responde sem resultado (e sem guardar)
+                encontrados[futuros[futuro]] = None if futuro.exception() else futuro.result()
+
+        resultados = {endereco: encontrados.get(chave) for endereco, chave in chaves.items()}
+        pendentes = [endereco for endereco, chave in chaves.items() if chave not in encontrados]
+        return resultados, pendentes
+
+    def _concluir(self, chave, endereco, futuro):
+        """Callback do Future: guarda o resultado ou registra o erro do provedor"""
+        if futuro.exception() is not None:
+            print(f"Erro na geocodificação de '{endereco}': {futuro.exception()}")
+            return
+        try:
+            self._guardar(chave, endereco, futuro.result())
+        except Exception as e:
+            print(f"Erro ao guardar geocodificação de '{endereco}': {e}")
+
+    def _da_memoria(self, chave):
+        with self._lock:
+            item = self._memoria.get(chave)
+            if item is None:
+                return False, None
+            resultado, expira_em = item
+            if expira_em <= timezone.now():
+                del self._memoria[chave]
+                return False, None
+            self._memoria.move_to_end(chave)
+            return True, resultado
+
+    def _guardar_memoria(self, chave, resultado, expira_em):
+        with self._lock:
+            self._memoria[chave] = (resultado, expira_em)
+            self._memoria.move_to_end(chave)
+            while len(self._memoria) > self.limite_memoria:
+                self._memoria.popitem(last=False)
+
+    def _guardar(self, chave, endereco, resultado):
+        from apps.models import EnderecoGeocodificado
+
+        EnderecoGeocodificado.objects.update_or_create(
+            chave=chave,
+            defaults={
+                'endereco': endereco[:500],
+                'encontrado': resultado is not None,
+                'latitude': resultado['latitude'] if resultado else None,
+                'longitude': resultado['longitude'] if resultado else None,
+                'endereco_formatado': (resultado or {}).get('endereco_formatado', '')[:500],
+                'fonte': (resultado or {}).get('fonte', '')
+            }
+        )
+        validade = self.validade if resultado is not None else self.validade_negativa
+        self._guardar_memoria(chave, resultado, timezone.now() + validade)
+
+    @staticmethod
+    def _resultado_do_registro(registro):
+        if not registro.encontrado:
+            return None
+        return {
+            'latitude': registro.latitude,
+            'longitude': registro.longitude,
+            'endereco_formatado': registro.endereco_formatado,
+            'fonte': registro.fonte
+        }
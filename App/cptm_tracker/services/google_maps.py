@@ -2,127 +2,34 @@
 Integração com Google Maps API e alternativas gratuitas para mapas
 """
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
 import json
+from cptm_tracker.instrumentacao import medir
+from cptm_tracker.services.estacoes import estacoes_service
+from cptm_tracker.services.geocodificacao import CacheGeocodificacao, FilaLimitada
 
 class MapsService:
     def __init__(self):
         self.google_api_key = getattr(settings, 'GOOGLE_MAPS_API_KEY', None)
-        
-        # Coordenadas oficiais das estações CPTM baseadas no mapa de 2019
-        self.coordenadas_estacoes = {
-            # Linha 7-Rubi: Luz ↔ Jundiaí
-            'Luz': {'lat': -23.534684, 'lng': -46.635199},
-            'Palmeiras-Barra Funda': {'lat': -23.527237, 'lng': -46.665668},
-            'Água Branca': {'lat': -23.520150, 'lng': -46.681050},
-            'Lapa': {'lat': -23.516033, 'lng': -46.700721},
-            'Piqueri': {'lat': -23.505199, 'lng': -46.720368},
-            'Pirituba': {'lat': -23.485199, 'lng': -46.739368},
-            'Vila Clarice': {'lat': -23.465199, 'lng': -46.740368},
-            'Jaraguá': {'lat': -23.445199, 'lng': -46.741368},
-            'Perus': {'lat': -23.410283, 'lng': -46.742836},
-            'Caieiras': {'lat': -23.366469, 'lng': -46.740847},
-            'Franco da Rocha': {'lat': -23.324103, 'lng': -46.726461},
-            'Baltazar Fidélis': {'lat': -23.305103, 'lng': -46.735461},
-            'Francisco Morato': {'lat': -23.286847, 'lng': -46.744932},
-            'Botujuru': {'lat': -23.250847, 'lng': -46.770932},
-            'Campo Limpo Paulista': {'lat': -23.210847, 'lng': -46.800932},
-            'Várzea Paulista': {'lat': -23.190847, 'lng': -46.830932},
-            'Jundiaí': {'lat': -23.178453, 'lng': -46.887738},
-            
-            # Linha 8-Diamante: Júlio Prestes ↔ Amador Bueno
-            'Júlio Prestes': {'lat': -23.535484, 'lng': -46.637299},
-            'Domingos de Moraes': {'lat': -23.520033, 'lng': -46.720721},
-            'Imperatriz Leopoldina': {'lat': -23.525033, 'lng': -46.750721},
-            'Presidente Altino': {'lat': -23.530033, 'lng': -46.780721},
-            'Osasco': {'lat': -23.532837, 'lng': -46.791898},
-            'Quitaúna': {'lat': -23.530837, 'lng': -46.810898},
-            'General Miguel Costa': {'lat': -23.525837, 'lng': -46.825898},
-            'Carapicuíba': {'lat': -23.522337, 'lng': -46.835699},
-            'Santa Terezinha': {'lat': -23.520337, 'lng': -46.845699},
-            'Antonio João': {'lat': -23.518337, 'lng': -46.855699},
-            'Barueri': {'lat': -23.510837, 'lng': -46.876199},
-            'Jardim Belval': {'lat': -23.515837, 'lng': -46.885199},
-            'Jardim Silveira': {'lat': -23.518837, 'lng': -46.895199},
-            'Jandira': {'lat': -23.525837, 'lng': -46.905199},
-            'Sagrado Coração': {'lat': -23.530837, 'lng': -46.915199},
-            'Engenheiro Cardoso': {'lat': -23.535837, 'lng': -46.925199},
-            'Itapevi': {'lat': -23.540837, 'lng': -46.935199},
-            'Santa Rita': {'lat': -23.545837, 'lng': -46.945199},
-            'Amador Bueno': {'lat': -23.550837, 'lng': -46.955199},
-            
-            # Linha 9-Esmeralda: Grajaú ↔ Osasco
-            'Grajaú': {'lat': -23.777337, 'lng': -46.697199},
-            'Autódromo': {'lat': -23.750337, 'lng': -46.697199},
-            'Primavera-Interlagos': {'lat': -23.720337, 'lng': -46.697199},
-            'Berrini': {'lat': -23.628337, 'lng': -46.693199},
-            'Morumbi': {'lat': -23.618337, 'lng': -46.703199},
-            'Granja Julieta': {'lat': -23.608337, 'lng': -46.713199},
-            'Santo Amaro': {'lat': -23.598337, 'lng': -46.723199},
-            'Socorro': {'lat': -23.588337, 'lng': -46.733199},
-            'Jurubatuba': {'lat': -23.578337, 'lng': -46.743199},
-            'Cidade Jardim': {'lat': -23.568337, 'lng': -46.753199},
-            'Vila Olímpia': {'lat': -23.568337, 'lng': -46.688199},
-            'Cidade Universitária': {'lat': -23.558337, 'lng': -46.725199},
-            'Pinheiros': {'lat': -23.561837, 'lng': -46.685199},
-            'Hebraica-Rebouças': {'lat': -23.558337, 'lng': -46.668199},
-            'Villa Lobos-Jaguaré': {'lat': -23.548337, 'lng': -46.724199},
-            'Ceasa': {'lat': -23.540337, 'lng': -46.755199},
-            
-            # Linha 10-Turquesa: Luz ↔ Rio Grande da Serra
-            'Mooca': {'lat': -23.551891, 'lng': -46.607743},
-            'Ipiranga': {'lat': -23.592891, 'lng': -46.597743},
-            'Tamanduateí': {'lat': -23.602891, 'lng': -46.587743},
-            'São Caetano do Sul': {'lat': -23.618891, 'lng': -46.564743},
-            'Utinga': {'lat': -23.628891, 'lng': -46.554743},
-            'Prefeito Saladino': {'lat': -23.638891, 'lng': -46.544743},
-            'Santo André': {'lat': -23.648891, 'lng': -46.534743},
-            'Capuava': {'lat': -23.658891, 'lng': -46.524743},
-            'Mauá': {'lat': -23.668891, 'lng': -46.514743},
-            'Guapituba': {'lat': -23.678891, 'lng': -46.504743},
-            'Ribeirão Pires': {'lat': -23.688891, 'lng': -46.494743},
-            'Rio Grande da Serra': {'lat': -23.698891, 'lng': -46.484743},
-            
-            # Linha 11-Coral: Luz ↔ Estudantes (COORDENADAS CORRIGIDAS)
-            'Estudantes': {'lat': -23.543200, 'lng': -46.309100},
-            'Cidade Patriarca': {'lat': -23.541000, 'lng': -46.331600},
-            'Artur Alvim': {'lat': -23.538700, 'lng': -46.380800},
-            'Corinthians-Itaquera': {'lat': -23.545500, 'lng': -46.464700},
-            'Dom Bosco': {'lat': -23.540300, 'lng': -46.481900},
-            'José Bonifácio': {'lat': -23.528200, 'lng': -46.491900},
-            'Guaianases': {'lat': -23.519800, 'lng': -46.510200},
-            'Antonio Gianetti Neto': {'lat': -23.512300, 'lng': -46.520500},
-            'Ferraz de Vasconcelos': {'lat': -23.508900, 'lng': -46.537800},
-            'Poá': {'lat': -23.529800, 'lng': -46.552300},
-            'Calmon Viana': {'lat': -23.518700, 'lng': -46.563400},
-            'Suzano': {'lat': -23.513400, 'lng': -46.592300},
-            'Jundiapeba': {'lat': -23.498700, 'lng': -46.612300},
-            'Braz Cubas': {'lat': -23.485600, 'lng': -46.623400},
-            'Mogi das Cruzes': {'lat': -23.523400, 'lng': -46.656700},
-            
-            # Linha 12-Safira: Brás ↔ Calmon Viana
-            'Tatuapé': {'lat': -23.538491, 'lng': -46.577299},
-            'Engenheiro Goulart': {'lat': -23.535391, 'lng': -46.560391},
-            'USP Leste': {'lat': -23.530391, 'lng': -46.550391},
-            'Comendador Ermelino': {'lat': -23.525391, 'lng': -46.540391},
-            'São Miguel Paulista': {'lat': -23.498484, 'lng': -46.443299},
-            'Jardim Helena-Vila Mara': {'lat': -23.515391, 'lng': -46.520391},
-            'Itaim Paulista': {'lat': -23.510391, 'lng': -46.510391},
-            'Jardim Romano': {'lat': -23.505391, 'lng': -46.500391},
-            'Engenheiro Manoel Feio': {'lat': -23.500391, 'lng': -46.490391},
-            'Itaquaquecetuba': {'lat': -23.479484, 'lng': -46.343299},
-            'Aracaré': {'lat': -23.490391, 'lng': -46.470391},
-            
-            # Linha 13-Jade: Engenheiro Goulart ↔ Aeroporto-Guarulhos
-            'Guarulhos-Cecap': {'lat': -23.462103, 'lng': -46.533265},
-            'Aeroporto-Guarulhos': {'lat': -23.432850, 'lng': -46.473201},
+        self.sessao = requests.Session()
+        self.fila_nominatim = FilaLimitada(self._geocodificar_nominatim, intervalo=1.0)
+        self.executor_google = ThreadPoolExecutor(max_workers=4, thread_name_prefix='geocodificacao')
+        self.geocodificacao = CacheGeocodificacao(self._geocodificar_provedores)
+
+    @property
+    def coordenadas_estacoes(self):
+        """Coordenadas {nome: {'lat', 'lng'}} vindas do registro de estações"""
+        return {
+            estacao.nome: {'lat': estacao.latitude, 'lng': estacao.longitude}
+            for estacao in estacoes_service.obter()
         }
 
     def obter_coordenadas_estacao(self, nome_estacao):
         """Retorna coordenadas de uma estação"""
-        return self.coordenadas_estacoes.get(nome_estacao, {
+        return estacoes_service.obter().coordenadas(nome_estacao) or {
             'lat': -23.5505, 'lng': -46.6333  # Centro de São Paulo como fallback
-        })
+        }
 
     def calcular_rota_entre_estacoes(self, origem, destino):
         """Calcula rota entre duas estações usando Google Maps ou alternativa"""
@@ -146,7 +53,8 @@ class MapsService:
                 'key': self.google_api_key
             }
             
-            response = requests.get(url, params=params, timeout=10)
+            with medir('externo'):
+                response = requests.get(url, params=params, timeout=10)
             if response.status_code == 200:
                 data = response.json()
                 if data['status'] == 'OK' and data['routes']:
@@ -188,75 +96,90 @@ class MapsService:
         return f"{origem['lat']},{origem['lng']}|{destino['lat']},{destino['lng']}"
 
     def buscar_estacoes_proximas(self, latitude, longitude, raio=2000):
-        """Busca estações próximas a uma coordenada"""
-        estacoes_proximas = []
-        
-        for nome, coord in self.coordenadas_estacoes.items():
-            # Cálculo simples de distância (não é preciso para o raio pequeno)
-            dist_lat = abs(coord['lat'] - latitude)
-            dist_lng = abs(coord['lng'] - longitude)
-            
-            # Aproximação simples: se está dentro de ~0.02 graus (aproximadamente 2km)
-            if dist_lat < 0.02 and dist_lng < 0.02:
-                estacoes_proximas.append({
-                    'nome': nome,
-                    'latitude': coord['lat'],
-                    'longitude': coord['lng'],
-                    'distancia_aproximada': f"{int((dist_lat + dist_lng) * 100)}m"
-                })
-        
-        return estacoes_proximas
+        """Busca estações próximas a uma coordenada (raio em metros)"""
+        return [
+            {
+                'nome': estacao.nome,
+                'latitude': estacao.latitude,
+                'longitude': estacao.longitude,
+                'distancia_metros': round(distancia * 1000),
+                'distancia_aproximada': f"{round(distancia * 1000)}m"
+            }
+            for distancia, estacao in estacoes_service.obter().proximas(latitude, longitude, raio_km=raio / 1000)
+        ]
 
     def geocodificar_endereco(self, endereco):
-        """Converte endereço em coordenadas"""
+        """Converte endereço em coordenadas (com cache persistente)"""
+        return self.geocodificacao.obter(endereco)
+
+    def geocodificar_enderecos(self, enderecos):
+        """Geocodifica vários endereços de uma vez; retorna ({endereco: resultado}, [pendentes])"""
+        return self.geocodificacao.obter_varios(enderecos)
+
+    def _geocodificar_provedores(self, endereco):
+        """Enfileira a consulta (Google, se configurado, e na falta o Nominatim); retorna um Future"""
         if self.google_api_key:
-            try:
-                url = "https://maps.googleapis.com/maps/api/geocode/json"
-                params = {
-                    'address': endereco,
-                    'key': self.google_api_key
-                }
-                
-                response = requests.get(url, params=params, timeout=10)
-                if response.status_code == 200:
-                    data = response.json()
-                    if data['status'] == 'OK' and data['results']:
-                        location = data['results'][0]['geometry']['location']
-                        return {
-                            'latitude': location['lat'],
-                            'longitude': location['lng'],
-                            'endereco_formatado': data['results'][0]['formatted_address']
-                        }
-            except Exception as e:
-                print(f"Erro na geocodificação: {e}")
+            return self.executor_google.submit(self._geocodificar_google_ou_nominatim, endereco)
+        # OpenStreetMap Nominatim (gratuito), respeitando 1 req/s
+        return self.fila_nominatim.enviar(endereco)
+
+    def _geocodificar_google_ou_nominatim(self, endereco):
+        try:
+            resultado = self._geocodificar_google(endereco)
+            if resultado:
+                return resultado
+        except Exception as e:
+            print(f"Erro na geocodificação: {e}")
+
+        # Fallback para o Nominatim, na thread do executor (não na da requisição)
+        return self.fila_nominatim.enviar(endereco).result(timeout=60)
+
+    def _geocodificar_google(self, endereco):
+        """Geocodificação usando Google Geocoding API"""
+        url = "https://maps.googleapis.com/maps/api/geocode/json"
+        params = {
+            'address': endereco,
+            'key': self.google_api_key
+        }
         
-        # Fallback para OpenStreetMap Nominatim (gratuito)
-        return self._geocodificar_nominatim(endereco)
+        with medir('externo'):
+            response = self.sessao.get(url, params=params, timeout=10)
+        response.raise_for_status()
+        data = response.json()
+        if data['status'] == 'OK' and data['results']:
+            location = data['results'][0]['geometry']['location']
+            return {
+                'latitude': location['lat'],
+                'longitude': location['lng'],
+                'endereco_formatado': data['results'][0]['formatted_address'],
+                'fonte': 'Google'
+            }
+        if data['status'] == 'ZERO_RESULTS':
+            return None
+        raise RuntimeError(f"Google Geocoding retornou {data['status']}")
 
     def _geocodificar_nominatim(self, endereco):
         """Geocodificação usando OpenStreetMap Nominatim"""
-        try:
-            url = "https://nominatim.openstreetmap.org/search"
-            params = {
-                'q': endereco,
-                'format': 'json',
-                'limit': 1,
-                'countrycodes': 'br'
-            }
-            headers = {'User-Agent': 'CPTMTracker/1.0'}
-            
-            response = requests.get(url, params=params, headers=headers, timeout=10)
-            if response.status_code == 200:
-                data = response.json()
-                if data:
-                    return {
-                        'latitude': float(data[0]['lat']),
-                        'longitude': float(data[0]['lon']),
-                        'endereco_formatado': data[0]['display_name']
-                    }
-        except Exception as e:
-            print(f"Erro na geocodificação Nominatim: {e}")
+        url = "https://nominatim.openstreetmap.org/search"
+        params = {
+            'q': endereco,
+            'format': 'json',
+            'limit': 1,
+            'countrycodes': 'br'
+        }
+        headers = {'User-Agent': 'CPTMTracker/1.0'}
         
+        with medir('externo'):
+            response = self.sessao.get(url, params=params, headers=headers, timeout=10)
+        response.raise_for_status()
+        data = response.json()
+        if data:
+            return {
+                'latitude': float(data[0]['lat']),
+                'longitude': float(data[0]['lon']),
+                'endereco_formatado': data[0]['display_name'],
+                'fonte': 'Nominatim'
+            }
         return None
 
 # Instância global do serviço
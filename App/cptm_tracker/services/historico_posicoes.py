@@ -0,0 +1,360 @@
+"""
+Histórico de posições dos trens em partições de tempo, com consolidação e retenção
+"""
+import os
+import shutil
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.conf import settings
+from django.core.files import locks
+
+# Colunas (nome, typecode do array); cada partição guarda um arquivo por coluna
+COLUNAS = (
+    ('t', 'd'),            # epoch em segundos
+    ('trem', 'i'),
+    ('linha', 'i'),
+    ('estacao', 'i'),      # 0 = sem estação
+    ('proxima', 'i'),
+    ('direcao', 'i'),      # id da estação terminal
+    ('latitude', 'f'),
+    ('longitude', 'f'),
+    ('velocidade', 'f'),
+    ('status', 'B'),
+    ('lotacao', 'B'),
+)
+
+STATUS = ('operacional', 'em_manutencao', 'fora_de_servico', 'atrasado')
+LOTACAO = ('baixa', 'media', 'alta', 'superlotado')
+
+# Resoluções: (nome, segundos por amostra, formato da partição, segundos por partição, retenção)
+RESOLUCOES = (
+    ('bruto', 0, '%Y%m%d%H', 3600, timedelta(hours=48)),
+    ('1min', 60, '%Y%m%d', 86400, timedelta(days=30)),
+    ('15min', 900, '%Y%m', None, timedelta(days=365)),
+)
+
+MARCA_CONSOLIDADA = '.consolidada'
+# Consolidação em andamento: guarda o tamanho da partição de destino antes da escrita
+MARCA_PENDENTE = '.consolidando'
+TRAVA = '.lock'
+
+
+class Amostras:
+    """Bloco colunar de amostras: um array por coluna, todos do mesmo tamanho"""
+
+    def __init__(self, colunas=None):
+        self.colunas = colunas or {nome: array(tipo) for nome, tipo in COLUNAS}
+
+    def __len__(self):
+        return len(self.colunas['t'])
+
+    def linha(self, i):
+        return {nome: self.colunas[nome][i] for nome, _ in COLUNAS}
+
+    def acrescentar(self, **valores):
+        for nome, _ in COLUNAS:
+            self.colunas[nome].append(valores[nome])
+
+    def estender(self, outras):
+        for nome, _ in COLUNAS:
+            self.colunas[nome].extend(outras.colunas[nome])
+
+    def filtrar(self, indices):
+        return Amostras({nome: array(tipo, (self.colunas[nome][i] for i in indices)) for nome, tipo in COLUNAS})
+
+
+class ArmazemPosicoes:
+    """Armazém append-only de posições em arquivos colunares por partição.
+
+    As amostras brutas vão para partições horárias; a consolidação gera
+    médias por minuto (partições diárias) e por 15 minutos (partições
+    mensais), e a retenção apaga partições inteiras. Consultas por intervalo
+    só abrem as partições que o intersectam, na resolução mais fina ainda
+    disponível para o período.
+    """
+
+    def __init__(self, diretorio=None):
+        self.diretorio = str(diretorio or getattr(
+            settings, 'HISTORICO_POSICOES_DIR', os.path.join(settings.DADOS_DIR, 'posicoes')))
+        self._lock = threading.Lock()
+
+    # --- Escrita ---------------------------------------------------------
+
+    def registrar(self, trens, agora=None):
+        """Acrescenta uma amostra por trem (objetos Trem) na partição bruta atual"""
+        from cptm_tracker.services.estacoes import estacoes_service
+
+        agora = agora or time.time()
+        if isinstance(agora, datetime):
+            agora = agora.timestamp()
+        registro = estacoes_service.obter()
+        amostras = Amostras()
+        for trem in trens:
+            if trem.pk is None or trem.latitude_atual is None or trem.longitude_atual is None:
+                continue
+            terminal = registro.por_nome(trem.direcao, linha=trem.linha.numero) if trem.direcao else None
+            amostras.acrescentar(
+                t=agora,
+                trem=trem.pk,
+                linha=trem.linha_id,
+                estacao=trem.estacao_atual_id or 0,
+                proxima=trem.proxima_estacao_id or 0,
+                direcao=terminal.id if terminal else 0,
+                latitude=trem.latitude_atual,
+                longitude=trem.longitude_atual,
+                velocidade=trem.velocidade or 0.0,
+                status=STATUS.index(trem.status) if trem.status in STATUS else 0,
+                lotacao=LOTACAO.index(trem.lotacao) if trem.lotacao in LOTACAO else 0,
+            )
+        self._acrescentar('bruto', self.particao('bruto', agora), amostras)
+        return len(amostras)
+
+    def _acrescentar(self, resolucao, particao, amostras):
+        if not len(amostras):
+            return
+        caminho = os.path.join(self.diretorio, resolucao, particao)
+        with self._travar(caminho):
+            self._alinhar(caminho)
+            self._gravar_colunas(caminho, amostras)
+
+    @contextmanager
+    def _travar(self, caminho):
+        """Trava exclusiva da partição entre threads e processos (simulador, Celery...)"""
+        os.makedirs(caminho, exist_ok=True)
+        with open(os.path.join(caminho, TRAVA), 'a+b') as trava, self._lock:
+            locks.lock(trava, locks.LOCK_EX)
+            try:
+                yield
+            finally:
+                locks.unlock(trava)
+
+    @staticmethod
+    def _alinhar(caminho, limite=None):
+        """Corta as colunas no mesmo número de linhas (no máximo ``limite``) e o retorna.
+
+        Uma escrita interrompida no meio deixa colunas de tamanhos diferentes;
+        sem o corte, o próximo lote ficaria desalinhado para sempre.
+        """
+        tamanhos = {}
+        for nome, tipo in COLUNAS:
+            arquivo = os.path.join(caminho, nome)
+            tamanhos[nome] = (os.path.getsize(arquivo) if os.path.exists(arquivo) else 0, array(tipo).itemsize)
+        linhas = min(tamanho // itemsize for tamanho, itemsize in tamanhos.values())
+        if limite is not None:
+            linhas = min(linhas, limite)
+        for nome, (tamanho, itemsize) in tamanhos.items():
+            if tamanho != linhas * itemsize:
+                os.truncate(os.path.join(caminho, nome), linhas * itemsize)
+        return linhas
+
+    @staticmethod
+    def _gravar_colunas(caminho, amostras):
+        for nome, _ in COLUNAS:
+            with open(os.path.join(caminho, nome), 'ab') as arquivo:
+                amostras.colunas[nome].tofile(arquivo)
+
+    # --- Leitura ---------------------------------------------------------
+
+    def ler_particao(self, resolucao, particao, desde=0):
+        """Lê as colunas de uma partição a partir da linha ``desde`` (tolerando escrita interrompida)"""
+        caminho = os.path.join(self.diretorio, resolucao, particao)
+        colunas = {}
+        for nome, tipo in COLUNAS:
+            dados = array(tipo)
+            try:
+                with open(os.path.join(caminho, nome), 'rb') as arquivo:
+                    arquivo.seek(desde * dados.itemsize)
+                    bruto = arquivo.read()
+                dados.frombytes(bruto[:len(bruto) - len(bruto) % dados.itemsize])
+            except FileNotFoundError:
+                pass
+            colunas[nome] = dados
+        tamanho = min(len(dados) for dados in colunas.values())
+        return Amostras({nome: dados[:tamanho] for nome, dados in colunas.items()})
+
+    def particoes(self, resolucao):
+        """Nomes das partições existentes de uma resolução, em ordem cronológica"""
+        try:
+            return sorted(nome for nome in os.listdir(os.path.join(self.diretorio, resolucao)) if nome.isdigit())
+        except FileNotFoundError:
+            return []
+
+    def consultar(self, trem_id, inicio, fim, resolucao=None):
+        """Amostras do trem entre ``inicio`` e ``fim`` (datetimes ou epoch).
+
+        Sem ``resolucao``, usa a mais fina cuja retenção ainda cobre ``inicio``.
+        Retorna (resolucao, Amostras).
+        """
+        inicio, fim = self._epoch(inicio), self._epoch(fim)
+        if resolucao is None:
+            resolucao = self.resolucao_retida(inicio) or RESOLUCOES[-1][0]
+
+        resultado = Amostras()
+        for particao in self.particoes_no_intervalo(resolucao, inicio, fim):
+            amostras = self.ler_particao(resolucao, particao)
+            tempos, trens = amostras.colunas['t'], amostras.colunas['trem']
+            indices = [i for i in range(len(amostras))
+                       if trens[i] == trem_id and inicio <= tempos[i] <= fim]
+            resultado.estender(amostras.filtrar(indices))
+        return resolucao, resultado
+
+    @staticmethod
+    def resolucao_retida(epoch):
+        """Resolução mais fina cuja retenção ainda cobre ``epoch`` (None: fora de todas)"""
+        for nome, _, _, _, retencao in RESOLUCOES:
+            if epoch >= time.time() - retencao.total_seconds():
+                return nome
+        return None
+
+    def particoes_no_intervalo(self, resolucao, inicio, fim):
+        primeira = self.particao(resolucao, inicio)
+        ultima = self.particao(resolucao, fim)
+        return [particao for particao in self.particoes(resolucao) if primeira <= particao <= ultima]
+
+    # --- Consolidação e retenção ---------------------------------------------
+
+    def consolidar(self, agora=None):
+        """Gera as partições de 1 e 15 minutos a partir das já fechadas e aplica a retenção"""
+        agora = self._epoch(agora or time.time())
+        resumo = {}
+        anteriores = (None,) + tuple(nome for nome, _, _, _, _ in RESOLUCOES)
+        for anterior, origem, destino in zip(anteriores, RESOLUCOES, RESOLUCOES[1:]):
+            resumo[destino[0]] = self._consolidar_nivel(origem, destino, agora, anterior)
+        resumo['removidas'] = self.aplicar_retencao(agora)
+        return resumo
+
+    def _consolidar_nivel(self, origem, destino, agora, anterior=None):
+        nome_origem, _, _, _, _ = origem
+        nome_destino, passo, _, _, _ = destino
+        atual = self.particao(nome_origem, agora)
+        consolidadas = 0
+        for particao in self.particoes(nome_origem):
+            caminho = os.path.join(self.diretorio, nome_origem, particao)
+            # Partição ainda aberta (recebendo escrita) ou já consolidada
+            if particao >= atual or self.consolidada(nome_origem, particao):
+                continue
+            # Uma partição diária só fecha quando todas as suas horas já foram consolidadas nela
+            if anterior is not None and self._fontes_pendentes(anterior, particao):
+                continue
+            amostras = self._agregar(self.ler_particao(nome_origem, particao), passo)
+            # Todas as amostras de uma partição de origem cabem numa única partição de destino
+            if len(amostras):
+                destino_caminho = os.path.join(
+                    self.diretorio, nome_destino, self.particao(nome_destino, amostras.colunas['t'][0]))
+                if not self._consolidar_em(caminho, destino_caminho, amostras):
+                    continue
+            else:
+                self._gravar_marca(os.path.join(caminho, MARCA_CONSOLIDADA), '0')
+            consolidadas += 1
+        return consolidadas
+
+    def consolidada(self, resolucao, particao):
+        """Se a partição já foi acrescentada à resolução seguinte"""
+        return os.path.exists(os.path.join(self.diretorio, resolucao, particao, MARCA_CONSOLIDADA))
+
+    def _fontes_pendentes(self, resolucao, particao):
+        """Partições de ``resolucao`` que alimentam ``particao`` e ainda não foram consolidadas.
+
+        Os formatos das partições são prefixos uns dos outros (hora → dia → mês),
+        então as fontes de uma partição são as que começam com o seu nome.
+        """
+        return [fonte for fonte in self.particoes(resolucao)
+                if fonte.startswith(particao) and not self.consolidada(resolucao, fonte)]
+
+    def _consolidar_em(self, origem, destino, amostras):
+        """Acrescenta a consolidação de ``origem`` em ``destino`` exatamente uma vez.
+
+        Antes de escrever, grava em ``origem`` o tamanho do destino; se o
+        processo cair antes da marca final, a próxima consolidação corta o
+        destino de volta a esse tamanho e refaz, sem duplicar linhas.
+        """
+        marca = os.path.join(origem, MARCA_CONSOLIDADA)
+        pendente = os.path.join(origem, MARCA_PENDENTE)
+        with self._travar(destino):
+            if os.path.exists(marca):
+                return False  # outro processo consolidou enquanto esperávamos a trava
+            limite = None
+            try:
+                with open(pendente) as arquivo:
+                    limite = int(arquivo.read())
+            except (FileNotFoundError, ValueError):
+                pass
+            tamanho = self._alinhar(destino, limite)
+            self._gravar_marca(pendente, str(tamanho))
+            self._gravar_colunas(destino, amostras)
+            self._gravar_marca(marca, str(tamanho + len(amostras)))
+            os.remove(pendente)
+        return True
+
+    @staticmethod
+    def _gravar_marca(caminho, conteudo):
+        """Grava num temporário e troca com ``os.replace``: a marca nunca fica pela metade"""
+        temporario = f'{caminho}.{os.getpid()}.tmp'
+        with open(temporario, 'w') as arquivo:
+            arquivo.write(conteudo)
+            arquivo.flush()
+            os.fsync(arquivo.fileno())
+        os.replace(temporario, caminho)
+
+    @staticmethod
+    def _agregar(amostras, passo):
+        """Média de posição e velocidade por (trem, janela de ``passo`` segundos);
+        os demais campos vêm da última amostra da janela"""
+        grupos = {}
+        colunas = amostras.colunas
+        for i in range(len(amostras)):
+            chave = (colunas['trem'][i], int(colunas['t'][i] // passo) * passo)
+            grupo = grupos.get(chave)
+            if grupo is None:
+                grupos[chave] = [1, colunas['latitude'][i], colunas['longitude'][i], colunas['velocidade'][i], i]
+            else:
+                grupo[0] += 1
+                grupo[1] += colunas['latitude'][i]
+                grupo[2] += colunas['longitude'][i]
+                grupo[3] += colunas['velocidade'][i]
+                grupo[4] = i
+
+        resultado = Amostras()
+        for (trem_id, inicio), (n, lat, lng, velocidade, ultima) in sorted(grupos.items(), key=lambda item: item[0][::-1]):
+            valores = amostras.linha(ultima)
+            valores.update(t=inicio, latitude=lat / n, longitude=lng / n, velocidade=velocidade / n)
+            resultado.acrescentar(**valores)
+        return resultado
+
+    def aplicar_retencao(self, agora=None):
+        """Apaga partições inteiras mais antigas que a retenção de cada resolução.
+
+        Partições que alimentam a resolução seguinte só são apagadas depois de
+        consolidadas; as ainda pendentes ficam para a próxima consolidação.
+        """
+        agora = self._epoch(agora or time.time())
+        removidas = 0
+        for indice, (nome, _, _, _, retencao) in enumerate(RESOLUCOES):
+            consolidavel = indice < len(RESOLUCOES) - 1
+            limite = self.particao(nome, agora - retencao.total_seconds())
+            for particao in self.particoes(nome):
+                if particao >= limite:
+                    continue
+                if consolidavel and not self.consolidada(nome, particao):
+                    continue
+                shutil.rmtree(os.path.join(self.diretorio, nome, particao), ignore_errors=True)
+                removidas += 1
+        return removidas
+
+    # --- Auxiliares ----------------------------------------------------------
+
+    @staticmethod
+    def _epoch(momento):
+        return momento.timestamp() if isinstance(momento, datetime) else float(momento)
+
+    @staticmethod
+    def particao(resolucao, epoch):
+        formato = next(formato for nome, _, formato, _, _ in RESOLUCOES if nome == resolucao)
+        return datetime.fromtimestamp(epoch, dt_timezone.utc).strftime(formato)
+
+
+# Instância global do serviço
+historico_posicoes = ArmazemPosicoes()
@@ -0,0 +1,127 @@
+"""
+Ingestão em lote das posições dos trens (um ciclo do atualizador por chamada)
+"""
+import time
+from contextlib import contextmanager
+from django.db import connection, transaction
+from django.utils import timezone
+from cptm_tracker.services.estacoes import estacoes_service
+from cptm_tracker.services.eta import eta_service
+from cptm_tracker.services.historico_posicoes import historico_posicoes
+
+CAMPOS_POSICAO = [
+    'linha', 'status', 'lotacao', 'velocidade', 'direcao', 'latitude_atual',
+    'longitude_atual', 'estacao_atual', 'proxima_estacao', 'previsao_chegada',
+    'ultima_atualizacao',
+]
+
+TAMANHO_LOTE = 500
+
+
+@contextmanager
+def contar_consultas():
+    """Conta as consultas SQL executadas no bloco (funciona com DEBUG=False)"""
+    contador = {'consultas': 0}
+
+    def wrapper(execute, sql, params, many, context):
+        contador['consultas'] += 1
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(wrapper):
+        yield contador
+
+
+def ingerir_posicoes(trens_por_linha):
+    """Grava as posições de um ciclo com um upsert em lote dentro de uma transação.
+
+    ``trens_por_linha`` é uma lista de pares (Linha, [dados do simulador]).
+    Retorna estatísticas do ciclo: trens criados/atualizados, consultas e latência.
+    """
+    from apps.models import Trem
+
+    inicio = time.perf_counter()
+    with contar_consultas() as contador:
+        registro = estacoes_service.obter()
+
+        identificadores = [dados['identificador'] for _, trens in trens_por_linha for dados in trens]
+        existentes = {}
+        for i in range(0, len(identificadores), TAMANHO_LOTE):
+            for trem in Trem.objects.filter(identificador__in=identificadores[i:i + TAMANHO_LOTE]):
+                existentes[trem.identificador] = trem
+
+        agora = timezone.now()
+        novos = []
+        alterados = []
+        chegadas = []
+        for linha, trens in trens_por_linha:
+            for dados in trens:
+                trem = existentes.get(dados['identificador'])
+                if trem is None:
+                    trem = Trem(identificador=dados['identificador'])
+                    novos.append(trem)
+                else:
+                    alterados.append(trem)
+
+                trem.linha = linha
+                trem.status = dados['status']
+                trem.lotacao = dados['lotacao']
+                trem.velocidade = dados['velocidade']
+                trem.direcao = dados['direcao']
+                trem.latitude_atual = dados['latitude']
+                trem.longitude_atual = dados['longitude']
+                trem.ultima_atualizacao = agora
+
+                estacao_anterior_id = trem.estacao_atual_id
+                proxima_anterior_id = trem.proxima_estacao_id
+                if dados.get('estacao_atual'):
+                    estacao = registro.por_nome(dados['estacao_atual'], linha=linha.numero)
+                    if estacao:
+                        trem.estacao_atual_id = estacao.id
+
+                if dados.get('proxima_estacao'):
+                    estacao = registro.por_nome(dados['proxima_estacao'], linha=linha.numero)
+                    if estacao:
+                        trem.proxima_estacao_id = estacao.id
+
+                chegou = trem.estacao_atual_id is not None and trem.estacao_atual_id != estacao_anterior_id
+                if chegou:
+                    atrasado = (trem.previsao_chegada is not None and
+                                agora > trem.previsao_chegada + eta_service.TOLERANCIA_ATRASO)
+                    chegadas.append((trem, atrasado))
+
+                # Previsão de chegada: mediana do trecho a partir da chegada na estação atual;
+                # só é refeita quando o trem muda de trecho
+                if trem.estacao_atual_id and trem.proxima_estacao_id and (
+                        chegou or trem.proxima_estacao_id != proxima_anterior_id or trem.previsao_chegada is None):
+                    trem.previsao_chegada = eta_service.prever_chegada(
+                        trem.estacao_atual_id, trem.proxima_estacao_id, agora
+                    )
+
+        # Upsert (INSERT ... ON CONFLICT DO UPDATE): evita o CASE WHEN por linha
+        # do bulk_update, cujo custo cresce muito com o tamanho do lote
+        with transaction.atomic():
+            Trem.objects.bulk_create(
+                novos + alterados,
+                batch_size=TAMANHO_LOTE,
+                update_conflicts=True,
+                unique_fields=['identificador'],
+                update_fields=CAMPOS_POSICAO,
+            )
+            # Passagens pelas estações alimentam a tabela de ETA
+            eta_service.registrar_passagens(
+                [(trem.pk, trem.estacao_atual_id, atrasado) for trem, atrasado in chegadas], agora
+            )
+
+    # Trajetórias: uma amostra por trem no histórico de posições (fora do banco)
+    try:
+        historico_posicoes.registrar(novos + alterados, agora)
+    except OSError as e:
+        print(f"Erro ao gravar histórico de posições: {e}")
+
+    return {
+        'criados': len(novos),
+        'atualizados': len(alterados),
+        'chegadas': len(chegadas),
+        'consultas': contador['consultas'],
+        'duracao_ms': (time.perf_counter() - inicio) * 1000
+    }
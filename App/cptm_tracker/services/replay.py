@@ -0,0 +1,314 @@
+"""
+Reconstrução da frota em instantes passados (time-travel e replay) a partir do
+histórico de posições
+"""
+import os
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import datetime, timezone as dt_timezone
+from django.utils import timezone
+from cptm_tracker.services.estacoes import estacoes_service
+from cptm_tracker.services.historico_posicoes import (
+    historico_posicoes, STATUS, LOTACAO, MARCA_CONSOLIDADA, RESOLUCOES,
+)
+
+# Intervalo entre quadros-chave do índice de cada partição
+INTERVALO_QUADRO_CHAVE = 60
+
+# Trem sem amostra há mais que isso é considerado fora da frota naquele instante
+DEFASAGEM_MAXIMA = 120
+
+ARQUIVO_INDICE = 'indice'
+
+
+class IndiceParticao:
+    """Quadros-chave de uma partição bruta do histórico.
+
+    O quadro ``k`` guarda, para cada trem, a linha (posição nas colunas) da sua
+    última amostra anterior a ``base + k * INTERVALO_QUADRO_CHAVE``, e
+    ``inicios[k]`` é a primeira linha depois do quadro. O estado num instante
+    é o quadro-chave anterior mais as amostras (deltas) até o instante.
+    Partições abertas são indexadas incrementalmente à medida que crescem.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.inicios = array('q')
+        self.quadros = []
+        self.linhas_indexadas = 0
+        self._estado = {}
+
+    def atualizar(self, amostras):
+        """Indexa as amostras acrescentadas desde a última chamada"""
+        tempos, trens = amostras.colunas['t'], amostras.colunas['trem']
+        for i in range(self.linhas_indexadas, len(amostras)):
+            while tempos[i] >= self.base + len(self.quadros) * INTERVALO_QUADRO_CHAVE:
+                self.inicios.append(i)
+                self.quadros.append(dict(self._estado))
+            self._estado[trens[i]] = i
+        self.linhas_indexadas = len(amostras)
+
+    def estado_em(self, amostras, epoch):
+        """Trem -> linha da última amostra até ``epoch`` (inclusive)"""
+        if not self.quadros:
+            return {}
+        k = min(max(int((epoch - self.base) // INTERVALO_QUADRO_CHAVE), 0), len(self.quadros) - 1)
+        estado = dict(self.quadros[k])
+        trens = amostras.colunas['trem']
+        fim = bisect_right(amostras.colunas['t'], epoch, lo=self.inicios[k], hi=self.linhas_indexadas)
+        for i in range(self.inicios[k], fim):
+            estado[trens[i]] = i
+        return estado
+
+    def salvar(self, caminho):
+        dados = array('q', [self.linhas_indexadas, len(self.quadros)])
+        for inicio, quadro in zip(self.inicios, self.quadros):
+            dados.extend((inicio, len(quadro)))
+            dados.extend(quadro.keys())
+            dados.extend(quadro.values())
+        # Grava num temporário e troca com ``os.replace``: um leitor nunca vê o índice pela metade
+        temporario = f'{caminho}.{os.getpid()}.tmp'
+        with open(temporario, 'wb') as arquivo:
+            dados.tofile(arquivo)
+        os.replace(temporario, caminho)
+
+    @classmethod
+    def carregar(cls, caminho, base):
+        dados = array('q')
+        with open(caminho, 'rb') as arquivo:
+            dados.frombytes(arquivo.read())
+        indice = cls(base)
+        indice.linhas_indexadas, total = dados[0], dados[1]
+        pos = 2
+        for _ in range(total):
+            inicio, tamanho = dados[pos], dados[pos + 1]
+            pos += 2
+            indice.inicios.append(inicio)
+            indice.quadros.append(dict(zip(dados[pos:pos + tamanho], dados[pos + tamanho:pos + 2 * tamanho])))
+            pos += 2 * tamanho
+        return indice
+
+
+class ReplayService:
+    """Frota reconstruída em qualquer instante retido no histórico bruto.
+
+    Mantém em memória as últimas ``limite_particoes`` partições lidas com seus
+    índices; partições fechadas têm o índice gravado em disco junto das
+    colunas, então uma busca lê só a partição do instante (e a anterior, perto
+    da virada da hora) e aplica no máximo um minuto de deltas.
+    """
+
+    def __init__(self, armazem=None, limite_particoes=4):
+        self.armazem = armazem or historico_posicoes
+        self.limite_particoes = limite_particoes
+        self._lock = threading.Lock()
+        self._particoes = OrderedDict()
+        self._identificadores = {}
+
+    def snapshot_em(self, momento):
+        """Frota no instante ``momento``, no formato da API /api/trens/.
+
+        Usa o histórico bruto enquanto ele existir para o instante e, depois
+        da retenção, as médias de 1 ou 15 minutos. Retorna None se não há
+        amostras perto do instante em nenhuma resolução.
+        """
+        epoch = self._epoch(momento)
+        resolucao = self._resolucao_disponivel(epoch)
+        if resolucao is None:
+            return None
+        estado = self._estado_em(epoch) if resolucao == 'bruto' else self._estado_consolidado(resolucao, epoch)
+        if not estado:
+            return None
+        trens = self._serializar(estado.values())
+        return {
+            'trens': trens,
+            'total': len(trens),
+            'instante': self._iso(epoch),
+            'resolucao': resolucao,
+            'timestamp': datetime.now().isoformat()
+        }
+
+    def _resolucao_disponivel(self, epoch):
+        """Resolução mais fina com partição gravada para o instante"""
+        for nome, _, _, _, _ in RESOLUCOES:
+            if os.path.isdir(os.path.join(self.armazem.diretorio, nome, self.armazem.particao(nome, epoch))):
+                return nome
+        return None
+
+    def _estado_consolidado(self, resolucao, epoch):
+        """Trem -> última média (1 ou 15 min) até ``epoch``, sem trens defasados.
+
+        As médias são acrescentadas hora a hora, em ordem de tempo; cada uma
+        cobre ``[t, t + passo)``.
+        """
+        passo = next(passo for nome, passo, _, _, _ in RESOLUCOES if nome == resolucao)
+        limite = epoch - passo - DEFASAGEM_MAXIMA
+        estado = {}
+        for particao in self.armazem.particoes_no_intervalo(resolucao, limite, epoch):
+            amostras = self.armazem.ler_particao(resolucao, particao)
+            tempos, trens = amostras.colunas['t'], amostras.colunas['trem']
+            for i in range(bisect_left(tempos, limite), bisect_right(tempos, epoch)):
+                estado[trens[i]] = amostras.linha(i)
+        return estado
+
+    def quadros(self, inicio, fim):
+        """Ciclos gravados em (``inicio``, ``fim``], cada um com os trens alterados
+        e os ids removidos em relação ao ciclo anterior"""
+        inicio, fim = self._epoch(inicio), self._epoch(fim)
+        estado = self._estado_em(inicio)
+        quadros = []
+        for particao in self.armazem.particoes_no_intervalo('bruto', inicio, fim):
+            carregada = self._carregar(particao)
+            if carregada is None:
+                continue
+            amostras, _ = carregada
+            tempos = amostras.colunas['t']
+            i = bisect_right(tempos, inicio)
+            ultima = bisect_right(tempos, fim)
+            while i < ultima:
+                instante = tempos[i]
+                alterados = []
+                while i < ultima and tempos[i] == instante:
+                    valores = amostras.linha(i)
+                    anterior = estado.get(valores['trem'])
+                    if anterior is None or self._assinatura(anterior) != self._assinatura(valores):
+                        alterados.append(valores)
+                    estado[valores['trem']] = valores
+                    i += 1
+                removidos = sorted(trem_id for trem_id, valores in estado.items()
+                                   if valores['t'] < instante - DEFASAGEM_MAXIMA)
+                for trem_id in removidos:
+                    del estado[trem_id]
+                quadros.append({
+                    't': instante,
+                    'instante': self._iso(instante),
+                    'trens': self._serializar(alterados),
+                    'removidos': removidos
+                })
+        return quadros
+
+    def _estado_em(self, epoch):
+        """Trem -> valores da última amostra até ``epoch``, sem trens defasados"""
+        particao = self.armazem.particao('bruto', epoch)
+        estado = {}
+        if epoch - self._base(particao) < DEFASAGEM_MAXIMA:
+            # Início da hora: amostras recentes podem estar na partição anterior
+            estado.update(self._estado_particao(self.armazem.particao('bruto', epoch - DEFASAGEM_MAXIMA), epoch))
+        estado.update(self._estado_particao(particao, epoch))
+        return {trem_id: valores for trem_id, valores in estado.items()
+                if valores['t'] >= epoch - DEFASAGEM_MAXIMA}
+
+    def _estado_particao(self, particao, epoch):
+        carregada = self._carregar(particao)
+        if carregada is None:
+            return {}
+        amostras, indice = carregada
+        return {trem_id: amostras.linha(i) for trem_id, i in indice.estado_em(amostras, epoch).items()}
+
+    def _carregar(self, particao):
+        """Colunas e índice de uma partição, indexando só o que cresceu desde a última leitura"""
+        caminho = os.path.join(self.armazem.diretorio, 'bruto', particao)
+        try:
+            tamanho = os.path.getsize(os.path.join(caminho, 't'))
+        except OSError:
+            return None
+
+        with self._lock:
+            carregada = self._particoes.get(particao)
+            if carregada is not None and carregada[0] == tamanho:
+                self._particoes.move_to_end(particao)
+                return carregada[1:]
+
+            if carregada is not None and carregada[0] < tamanho:
+                # Partição aberta que cresceu: lê só as linhas acrescentadas
+                amostras = carregada[1]
+                amostras.estender(self.armazem.ler_particao('bruto', particao, desde=len(amostras)))
+            else:
+                amostras = self.armazem.ler_particao('bruto', particao)
+            fechada = os.path.exists(os.path.join(caminho, MARCA_CONSOLIDADA))
+            arquivo_indice = os.path.join(caminho, ARQUIVO_INDICE)
+            indice = None
+            if carregada is not None:
+                indice = carregada[2]
+            elif fechada and os.path.exists(arquivo_indice):
+                indice = IndiceParticao.carregar(arquivo_indice, self._base(particao))
+            if indice is None or indice.linhas_indexadas > len(amostras):
+                indice = IndiceParticao(self._base(particao))
+            if indice.linhas_indexadas < len(amostras):
+                indice.atualizar(amostras)
+            if fechada and not os.path.exists(arquivo_indice):
+                indice.salvar(arquivo_indice)
+
+            self._particoes[particao] = (tamanho, amostras, indice)
+            self._particoes.move_to_end(particao)
+            while len(self._particoes) > self.limite_particoes:
+                self._particoes.popitem(last=False)
+            return amostras, indice
+
+    def _serializar(self, amostras):
+        """Converte valores do histórico no formato público dos trens"""
+        registro = estacoes_service.obter()
+        linhas = {}
+        for estacao in registro.estacoes:
+            linhas.setdefault(estacao.linha_id, {
+                'numero': estacao.linha_numero, 'nome': estacao.linha_nome, 'cor': estacao.linha_cor
+            })
+        identificadores = self._obter_identificadores({valores['trem'] for valores in amostras})
+
+        def estacao(estacao_id):
+            info = registro.por_id(estacao_id) if estacao_id else None
+            if info is None:
+                return None
+            return {'nome': info.nome, 'latitude': info.latitude, 'longitude': info.longitude}
+
+        trens = []
+        for valores in amostras:
+            terminal = registro.por_id(valores['direcao']) if valores['direcao'] else None
+            trens.append({
+                'id': valores['trem'],
+                'identificador': identificadores.get(valores['trem']),
+                'linha': linhas.get(valores['linha']),
+                'lotacao': LOTACAO[valores['lotacao']],
+                'status': STATUS[valores['status']],
+                'velocidade': round(valores['velocidade'], 1),
+                'direcao': terminal.nome if terminal else None,
+                'ultima_atualizacao': self._iso(valores['t']),
+                'estacao_atual': estacao(valores['estacao']),
+                'proxima_estacao': estacao(valores['proxima']),
+                'posicao_atual': {
+                    'latitude': round(valores['latitude'], 6),
+                    'longitude': round(valores['longitude'], 6)
+                },
+                'previsao_chegada': None
+            })
+        return trens
+
+    def _obter_identificadores(self, trem_ids):
+        """Identificadores dos trens (uma consulta só quando aparece um id desconhecido)"""
+        from apps.models import Trem
+
+        if not trem_ids.issubset(self._identificadores):
+            self._identificadores = dict(Trem.objects.values_list('id', 'identificador'))
+        return self._identificadores
+
+    @staticmethod
+    def _assinatura(valores):
+        return tuple(valor for campo, valor in valores.items() if campo != 't')
+
+    @staticmethod
+    def _base(particao):
+        return datetime.strptime(particao, '%Y%m%d%H').replace(tzinfo=dt_timezone.utc).timestamp()
+
+    @staticmethod
+    def _epoch(momento):
+        return momento.timestamp() if isinstance(momento, datetime) else float(momento)
+
+    @staticmethod
+    def _iso(epoch):
+        return datetime.fromtimestamp(epoch, tz=timezone.get_current_timezone()).isoformat()
+
+
+# Instância global do serviço
+replay_service = ReplayService()
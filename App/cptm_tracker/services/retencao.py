@@ -0,0 +1,70 @@
+"""
+Remoção de dados antigos em lotes curtos, sem travar o banco para o tráfego ao vivo
+"""
+import time
+from collections import namedtuple
+from datetime import timedelta
+from django.apps import apps as registro_apps
+from django.db import router, transaction
+from django.db.models.deletion import Collector
+from django.utils import timezone
+
+PoliticaRetencao = namedtuple('PoliticaRetencao', ['modelo', 'campo_data', 'dias', 'tamanho_lote', 'pausa'])
+PoliticaRetencao.__new__.__defaults__ = (1000, 0.05)
+
+# Modelos limpos pela tarefa diária: (app.Modelo, campo de data, dias mantidos[, lote, pausa em segundos])
+POLITICAS = (
+    PoliticaRetencao('apps.NotificacaoUsuario', 'criada_em', 30),
+    PoliticaRetencao('apps.CondiciaoClimatica', 'atualizada_em', 7),
+)
+
+
+def aplicar_politica(politica, agora=None, duracao_maxima=None):
+    """Remove os registros vencidos de um modelo em lotes curtos.
+
+    Cada lote é lido pelo índice do campo de data (os mais antigos primeiro),
+    apagado em ordem de chave primária na sua própria transação (o SQLite só
+    fica travado para escrita durante um lote) e seguido de uma pausa. O
+    ``delete()`` do lote já usa um único DELETE, sem carregar as linhas,
+    quando o modelo não tem signals de delete nem relações dependentes
+    (``rapido`` no resultado); caso contrário resolve as cascatas.
+    """
+    modelo = registro_apps.get_model(politica.modelo)
+    limite = (agora or timezone.now()) - timedelta(days=politica.dias)
+    # Ordenar pela data (e não pela pk) mantém a busca no índice, sem varrer a tabela
+    vencidos = modelo.objects.filter(**{f'{politica.campo_data}__lt': limite}).order_by(politica.campo_data)
+    banco = router.db_for_write(modelo)
+    rapido = Collector(using=banco).can_fast_delete(vencidos)
+
+    inicio = time.perf_counter()
+    removidos = 0
+    lotes = 0
+    while True:
+        pks = sorted(vencidos.values_list('pk', flat=True)[:politica.tamanho_lote])
+        if not pks:
+            break
+        with transaction.atomic(using=banco):
+            apagados = modelo.objects.filter(pk__in=pks).delete()[1].get(modelo._meta.label, 0)
+        removidos += apagados
+        lotes += 1
+        if len(pks) < politica.tamanho_lote or not apagados:
+            break
+        if duracao_maxima is not None and time.perf_counter() - inicio >= duracao_maxima:
+            break
+        time.sleep(politica.pausa)
+
+    segundos = time.perf_counter() - inicio
+    return {
+        'modelo': politica.modelo,
+        'removidos': removidos,
+        'lotes': lotes,
+        'rapido': rapido,
+        'segundos': segundos,
+        'linhas_por_segundo': removidos / segundos if segundos > 0 else 0.0
+    }
+
+
+def executar_retencao(politicas=POLITICAS, agora=None, duracao_maxima=None):
+    """Aplica todas as políticas; ``duracao_maxima`` (segundos) vale para cada modelo"""
+    agora = agora or timezone.now()
+    return [aplicar_politica(politica, agora, duracao_maxima) for politica in politicas]
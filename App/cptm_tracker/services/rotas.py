@@ -0,0 +1,240 @@
+"""
+Planejador de viagens sobre o grafo da rede (sem chamadas externas)
+"""
+import heapq
+import threading
+from cptm_tracker.services.espacial import distancia_km
+from cptm_tracker.services.estacoes import estacoes_service, normalizar_nome
+
+# Parâmetros do modelo de tempo de viagem
+VELOCIDADE_MEDIA_KMH = 45.0
+TEMPO_PARADA_MIN = 0.5
+TEMPO_BALDEACAO_MIN = 5.0
+
+CRITERIOS = ('tempo', 'baldeacoes')
+
+
+class GrafoRede:
+    """Grafo da rede construído a partir de um registro de estações.
+
+    Os nós são os índices do registro (uma estação por linha). Arestas de
+    viagem ligam estações consecutivas (``ordem``) da mesma linha; arestas de
+    baldeação ligam a mesma estação em linhas diferentes (M2M ``baldeacao``
+    ou mesmo nome normalizado).
+    """
+
+    LIMITE_MEMO = 1024
+
+    def __init__(self, registro):
+        self.registro = registro
+        # adjacencias[i] = [(j, minutos, km, eh_baldeacao), ...]
+        self.adjacencias = [[] for _ in range(len(registro))]
+
+        for linha in registro.linhas():
+            estacoes = registro.da_linha(linha)
+            for atual, proxima in zip(estacoes, estacoes[1:]):
+                km = distancia_km(atual.latitude, atual.longitude, proxima.latitude, proxima.longitude)
+                minutos = km / VELOCIDADE_MEDIA_KMH * 60 + TEMPO_PARADA_MIN
+                self.adjacencias[atual.indice].append((proxima.indice, minutos, km, False))
+                self.adjacencias[proxima.indice].append((atual.indice, minutos, km, False))
+
+        pares = set()
+        for estacao in registro:
+            for destino_id in estacao.baldeacao:
+                destino = registro.por_id(destino_id)
+                if destino is not None:
+                    pares.add(tuple(sorted((estacao.indice, destino.indice))))
+            for mesma in registro.todas_por_nome(estacao.nome):
+                if mesma.indice != estacao.indice:
+                    pares.add(tuple(sorted((estacao.indice, mesma.indice))))
+        for a, b in pares:
+            self.adjacencias[a].append((b, TEMPO_BALDEACAO_MIN, 0.0, True))
+            self.adjacencias[b].append((a, TEMPO_BALDEACAO_MIN, 0.0, True))
+
+        self._memo = {}
+        self._lock = threading.Lock()
+
+    def planejar(self, origem, destino, criterio='tempo'):
+        """Melhor itinerário entre dois nomes de estação, ou None se não houver.
+
+        ``criterio='tempo'`` minimiza a duração; ``'baldeacoes'`` minimiza o
+        número de baldeações e, em empate, a duração.
+        """
+        chave = (normalizar_nome(origem), normalizar_nome(destino), criterio)
+        if chave in self._memo:
+            return self._copiar(self._memo[chave])
+
+        origens = [e.indice for e in self.registro.todas_por_nome(origem)]
+        destinos = {e.indice for e in self.registro.todas_por_nome(destino)}
+        itinerario = None
+        if origens and destinos:
+            itinerario = self._dijkstra(origens, destinos, criterio)
+
+        with self._lock:
+            if len(self._memo) >= self.LIMITE_MEMO:
+                self._memo.clear()
+            self._memo[chave] = itinerario
+        return self._copiar(itinerario)
+
+    @staticmethod
+    def _copiar(itinerario):
+        """Cópia do itinerário memorizado: quem recebe pode alterá-lo sem afetar as
+        próximas requisições (as estações do registro são compartilhadas, imutáveis)"""
+        if itinerario is None:
+            return None
+        return dict(
+            itinerario,
+            estacoes=list(itinerario['estacoes']),
+            trechos=[dict(trecho, paradas=list(trecho['paradas'])) for trecho in itinerario['trechos']]
+        )
+
+    def _dijkstra(self, origens, destinos, criterio):
+        por_baldeacoes = criterio == 'baldeacoes'
+        # custo = (baldeações, minutos) ou (minutos, baldeações)
+        melhor = {}
+        anterior = {}
+        fila = []
+        for indice in origens:
+            melhor[indice] = (0, 0.0)
+            heapq.heappush(fila, (0, 0.0, indice))
+
+        chegada = None
+        while fila:
+            c1, c2, atual = heapq.heappop(fila)
+            if (c1, c2) > melhor.get(atual, (c1, c2)):
+                continue
+            if atual in destinos:
+                chegada = atual
+                break
+            for vizinho, minutos, _, eh_baldeacao in self.adjacencias[atual]:
+                if por_baldeacoes:
+                    custo = (c1 + eh_baldeacao, c2 + minutos)
+                else:
+                    custo = (c1 + minutos, c2 + eh_baldeacao)
+                if custo < melhor.get(vizinho, (float('inf'), float('inf'))):
+                    melhor[vizinho] = custo
+                    anterior[vizinho] = atual
+                    heapq.heappush(fila, (custo[0], custo[1], vizinho))
+
+        if chegada is None:
+            return None
+
+        caminho = [chegada]
+        while caminho[-1] in anterior:
+            caminho.append(anterior[caminho[-1]])
+        caminho.reverse()
+        # Baldeações no início ou no fim não fazem sentido (mesma estação física)
+        while len(caminho) > 1 and self._eh_baldeacao(caminho[0], caminho[1]):
+            caminho.pop(0)
+        while len(caminho) > 1 and self._eh_baldeacao(caminho[-2], caminho[-1]):
+            caminho.pop()
+        return self._montar_itinerario(caminho)
+
+    def _aresta(self, a, b):
+        for vizinho, minutos, km, eh_baldeacao in self.adjacencias[a]:
+            if vizinho == b:
+                return minutos, km, eh_baldeacao
+        raise KeyError((a, b))
+
+    def _eh_baldeacao(self, a, b):
+        return self._aresta(a, b)[2]
+
+    def _montar_itinerario(self, caminho):
+        """Agrupa o caminho em trechos por linha"""
+        estacoes = self.registro.estacoes
+        trechos = []
+        trecho = None
+        duracao = 0.0
+        distancia = 0.0
+        baldeacoes = 0
+
+        for a, b in zip(caminho, caminho[1:]):
+            minutos, km, eh_baldeacao = self._aresta(a, b)
+            duracao += minutos
+            distancia += km
+            if eh_baldeacao:
+                baldeacoes += 1
+                trecho = None
+                continue
+            if trecho is None:
+                trecho = {'linha': estacoes[a].linha_numero, 'paradas': [a], 'minutos': 0.0, 'km': 0.0}
+                trechos.append(trecho)
+            trecho['paradas'].append(b)
+            trecho['minutos'] += minutos
+            trecho['km'] += km
+
+        return {
+            'duracao_min': round(duracao, 1),
+            'distancia_km': round(distancia, 1),
+            'baldeacoes': baldeacoes,
+            'estacoes': [estacoes[i] for i in caminho],
+            'trechos': [self._formatar_trecho(t) for t in trechos]
+        }
+
+    def _formatar_trecho(self, trecho):
+        estacoes = self.registro.estacoes
+        paradas = [estacoes[i] for i in trecho['paradas']]
+        da_linha = self.registro.da_linha(trecho['linha'])
+        crescente = paradas[-1].ordem > paradas[0].ordem
+        sentido = da_linha[-1] if crescente else da_linha[0]
+        return {
+            'linha': paradas[0].linha_numero,
+            'linha_nome': paradas[0].linha_nome,
+            'linha_cor': paradas[0].linha_cor,
+            'embarque': paradas[0].nome,
+            'desembarque': paradas[-1].nome,
+            'sentido': sentido.nome,
+            'paradas': [estacao.nome for estacao in paradas],
+            'duracao_min': round(trecho['minutos'], 1),
+            'distancia_km': round(trecho['km'], 1)
+        }
+
+
+class RotasService:
+    """Planejador de rotas do processo; o grafo é refeito quando o registro de estações muda"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._grafo = None
+
+    def obter_grafo(self):
+        registro = estacoes_service.obter()
+        grafo = self._grafo
+        if grafo is None or grafo.registro is not registro:
+            with self._lock:
+                if self._grafo is None or self._grafo.registro is not registro:
+                    self._grafo = GrafoRede(registro)
+                grafo = self._grafo
+        return grafo
+
+    def planejar(self, origem, destino, criterio='tempo'):
+        """Itinerário entre duas estações (por nome)"""
+        return self.obter_grafo().planejar(origem, destino, criterio)
+
+    def rota_compativel(self, itinerario):
+        """Itinerário no formato antigo de ``MapsService.calcular_rota_entre_estacoes``"""
+        passos = []
+        for i, trecho in enumerate(itinerario['trechos']):
+            if i > 0:
+                passos.append({
+                    'instruction': f"Baldeação em {trecho['embarque']} para a {trecho['linha_nome']}",
+                    'duration': f"{TEMPO_BALDEACAO_MIN:.0f} min"
+                })
+            passos.append({
+                'instruction': (
+                    f"Embarque na {trecho['linha_nome']} em {trecho['embarque']} sentido "
+                    f"{trecho['sentido']} e desça em {trecho['desembarque']} "
+                    f"({len(trecho['paradas']) - 1} paradas)"
+                ),
+                'duration': f"{trecho['duracao_min']:.0f} min"
+            })
+        return {
+            'polyline': '|'.join(f"{e.latitude},{e.longitude}" for e in itinerario['estacoes']),
+            'duration': f"{itinerario['duracao_min']:.0f} minutos",
+            'distance': f"{itinerario['distancia_km']:.1f} km",
+            'steps': passos
+        }
+
+
+# Instância global do serviço
+rotas_service = RotasService()
@@ -0,0 +1,235 @@
+"""
+Simulador vetorizado da frota: todos os trens de todas as linhas em arrays NumPy
+"""
+import threading
+import time
+from datetime import datetime, timedelta
+import numpy as np
+from cptm_tracker.services.espacial import RAIO_TERRA_KM
+from cptm_tracker.services.estacoes import estacoes_service
+from cptm_tracker.services.historico_posicoes import STATUS, LOTACAO
+
+# Velocidade de cruzeiro sorteada por trem (km/h)
+VELOCIDADE_MINIMA = 40.0
+VELOCIDADE_MAXIMA = 90.0
+# Tempo parado em cada estação (s); nos terminais, para inverter o sentido, o dobro
+PARADA_MINIMA = 20.0
+PARADA_MAXIMA = 45.0
+# Trechos com estações no mesmo ponto (coordenadas repetidas) ainda levam algum tempo
+TRECHO_MINIMO_KM = 0.2
+# Chance, por segundo simulado, de um trem mudar de status/lotação
+MUDANCA_POR_SEGUNDO = 0.025
+# Chance de sortear nova velocidade de cruzeiro a cada chegada
+MUDANCA_VELOCIDADE = 0.1
+STATUS_SORTEADOS = (STATUS.index('operacional'), STATUS.index('atrasado'))
+PESOS_STATUS = (0.75, 0.25)
+
+
+def distancias_km(lat1, lng1, lat2, lng2):
+    """Distância haversine entre pares de pontos (arrays), em km"""
+    lat1, lng1, lat2, lng2 = map(np.radians, (lat1, lng1, lat2, lng2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * RAIO_TERRA_KM * np.arcsin(np.sqrt(a))
+
+
+class SimuladorFrota:
+    """Simula a frota inteira de uma vez, com um array por atributo dos trens.
+
+    As linhas viram um único ``percurso``: as posições (no registro de
+    estações) de todas as estações, linha após linha, na ordem do trajeto.
+    Cada trem guarda a posição no percurso da última estação por onde passou,
+    o sentido (+1/-1) e quantos km já andou no trecho até a próxima. Um passo
+    da simulação é feito só com operações sobre os arrays: avança os trens em
+    movimento, desconta o tempo parado, trata as chegadas (parada, inversão
+    de sentido nos terminais) e interpola as coordenadas, sem laço por trem.
+    """
+
+    def __init__(self, trens_por_linha=10, semente=None):
+        self.quantidade_por_linha = trens_por_linha
+        self._aleatorio = np.random.default_rng(semente)
+        self._lock = threading.Lock()
+        self._registro = None
+        self._ultimo_passo = None
+
+    # --- Rede ----------------------------------------------------------------
+
+    def _preparar(self):
+        """(Re)monta rede e frota quando o registro de estações muda"""
+        registro = estacoes_service.obter()
+        if registro is self._registro:
+            return
+        self._registro = registro
+
+        linhas = [linha for linha in registro.linhas() if len(registro.da_linha(linha)) >= 2]
+        percurso = [estacao.indice for linha in linhas for estacao in registro.da_linha(linha)]
+        quantidades = np.array([len(registro.da_linha(linha)) for linha in linhas], dtype=np.int32)
+
+        self.linhas = tuple(linhas)
+        self.percurso = np.array(percurso, dtype=np.int32)
+        self.inicio_linha = np.concatenate(([0], np.cumsum(quantidades)[:-1])).astype(np.int32)
+        self.fim_linha = self.inicio_linha + quantidades - 1
+        self.latitudes = np.asarray(registro.latitudes)[self.percurso]
+        self.longitudes = np.asarray(registro.longitudes)[self.percurso]
+        self.ids_estacoes = np.asarray(registro.ids)[self.percurso]
+        self.nomes_estacoes = [registro.estacoes[indice].nome for indice in percurso]
+
+        # Comprimento do trecho que começa em cada posição (o da última estação de cada linha não é usado)
+        self.comprimentos = np.full(len(percurso), TRECHO_MINIMO_KM)
+        if len(percurso) > 1:
+            trechos = distancias_km(self.latitudes[:-1], self.longitudes[:-1],
+                                    self.latitudes[1:], self.longitudes[1:])
+            self.comprimentos[:-1] = np.maximum(trechos, TRECHO_MINIMO_KM)
+
+        self._criar_frota()
+
+    def _criar_frota(self):
+        """Distribui ``quantidade_por_linha`` trens ao longo de cada linha, em sentidos alternados"""
+        aleatorio = self._aleatorio
+        total = len(self.linhas) * self.quantidade_por_linha
+        self.linha = np.repeat(np.arange(len(self.linhas), dtype=np.int16), self.quantidade_por_linha)
+        numero = np.tile(np.arange(self.quantidade_por_linha), len(self.linhas))
+        inicio, fim = self.inicio_linha[self.linha], self.fim_linha[self.linha]
+
+        self.direcao = np.where(numero % 2 == 0, 1, -1).astype(np.int8)
+        # Trecho sorteado entre as posições válidas para o sentido (nunca parte do terminal para fora)
+        self.posicao = np.where(
+            self.direcao > 0,
+            inicio + (aleatorio.random(total) * (fim - inicio)).astype(np.int32),
+            inicio + 1 + (aleatorio.random(total) * (fim - inicio)).astype(np.int32),
+        ).astype(np.int32)
+        self.distancia = aleatorio.random(total) * self._comprimento_trecho()
+        self.espera = np.zeros(total)
+        self.cruzeiro = aleatorio.uniform(VELOCIDADE_MINIMA, VELOCIDADE_MAXIMA, total)
+        self.status = aleatorio.choice(STATUS_SORTEADOS, total, p=PESOS_STATUS).astype(np.uint8)
+        self.lotacao = aleatorio.integers(0, len(LOTACAO), total, dtype=np.uint8)
+        self.identificadores = [
+            f"T{self.linhas[linha]}{i + 1:02d}" for linha, i in zip(self.linha.tolist(), numero.tolist())
+        ]
+        self._ultimo_passo = None
+
+    def _comprimento_trecho(self):
+        return self.comprimentos[np.where(self.direcao > 0, self.posicao, self.posicao - 1)]
+
+    # --- Simulação -----------------------------------------------------------
+
+    def avancar(self, segundos=None):
+        """Avança a simulação ``segundos`` (padrão: o tempo real desde o último passo)"""
+        with self._lock:
+            self._preparar()
+            agora = time.monotonic()
+            if segundos is None:
+                segundos = agora - self._ultimo_passo if self._ultimo_passo is not None else 0.0
+            self._ultimo_passo = agora
+            if segundos > 0 and len(self.linha):
+                self._passo(segundos)
+        return self
+
+    def _passo(self, dt):
+        aleatorio = self._aleatorio
+        total = len(self.linha)
+
+        # Quem está parado desconta a espera; o que sobrar do passo é tempo em movimento
+        em_movimento = np.maximum(dt - self.espera, 0.0)
+        self.espera = np.maximum(self.espera - dt, 0.0)
+        self.distancia += self.cruzeiro * em_movimento / 3600.0
+
+        # Chegadas: um trecho por passo no máximo; o excedente é absorvido pela parada
+        chegaram = np.flatnonzero(self.distancia >= self._comprimento_trecho())
+        if len(chegaram):
+            self.posicao[chegaram] += self.direcao[chegaram]
+            self.distancia[chegaram] = 0.0
+            linha = self.linha[chegaram]
+            terminal = np.where(self.direcao[chegaram] > 0,
+                                self.posicao[chegaram] == self.fim_linha[linha],
+                                self.posicao[chegaram] == self.inicio_linha[linha])
+            self.direcao[chegaram[terminal]] *= -1
+            self.espera[chegaram] = aleatorio.uniform(PARADA_MINIMA, PARADA_MAXIMA, len(chegaram)) * \
+                np.where(terminal, 2.0, 1.0)
+            sorteio = chegaram[aleatorio.random(len(chegaram)) < MUDANCA_VELOCIDADE]
+            self.cruzeiro[sorteio] = aleatorio.uniform(VELOCIDADE_MINIMA, VELOCIDADE_MAXIMA, len(sorteio))
+
+        mudam = np.flatnonzero(aleatorio.random(total) < min(1.0, MUDANCA_POR_SEGUNDO * dt))
+        if len(mudam):
+            self.status[mudam] = aleatorio.choice(STATUS_SORTEADOS, len(mudam), p=PESOS_STATUS)
+            self.lotacao[mudam] = aleatorio.integers(0, len(LOTACAO), len(mudam))
+
+    # --- Leitura -------------------------------------------------------------
+
+    def posicoes(self):
+        """Estado atual da frota em arrays (um elemento por trem).
+
+        ``linha`` indexa ``linhas``; estações e terminal são posições no
+        percurso (``nomes_estacoes``/``ids_estacoes``).
+        """
+        with self._lock:
+            self._preparar()
+            origem = self.posicao
+            destino = self.posicao + self.direcao
+            comprimento = self._comprimento_trecho()
+            progresso = np.minimum(self.distancia / comprimento, 1.0)
+            parado = self.espera > 0
+            terminal = np.where(self.direcao > 0, self.fim_linha[self.linha], self.inicio_linha[self.linha])
+            return {
+                'linha': self.linha.copy(),
+                'latitude': self.latitudes[origem] + (self.latitudes[destino] - self.latitudes[origem]) * progresso,
+                'longitude': self.longitudes[origem] + (self.longitudes[destino] - self.longitudes[origem]) * progresso,
+                'velocidade': np.where(parado, 0.0, self.cruzeiro),
+                'estacao_atual': origem.copy(),
+                'proxima_estacao': destino,
+                'terminal': terminal,
+                'segundos_ate_chegada': self.espera + (comprimento - self.distancia) / self.cruzeiro * 3600.0,
+                'status': self.status.copy(),
+                'lotacao': self.lotacao.copy(),
+            }
+
+    def trens_por_linha(self, linhas=None):
+        """Trens no formato do simulador da CPTM (dicts), agrupados por número de linha.
+
+        É o formato consumido por ``ingerir_posicoes``; a conversão para dicts
+        é a única parte por trem e só acontece aqui, na saída.
+        """
+        estado = self.posicoes()
+        if linhas is not None:
+            quer = [i for i, numero in enumerate(self.linhas) if numero in set(map(str, linhas))]
+            selecionados = np.flatnonzero(np.isin(estado['linha'], quer))
+            estado = {campo: valores[selecionados] for campo, valores in estado.items()}
+            identificadores = [self.identificadores[i] for i in selecionados.tolist()]
+        else:
+            identificadores = self.identificadores
+
+        nomes = self.nomes_estacoes
+        agora = datetime.now()
+        colunas = zip(
+            identificadores, estado['linha'].tolist(), estado['estacao_atual'].tolist(),
+            estado['proxima_estacao'].tolist(), estado['terminal'].tolist(), estado['status'].tolist(),
+            estado['lotacao'].tolist(), np.rint(estado['velocidade']).astype(int).tolist(),
+            estado['segundos_ate_chegada'].tolist(), estado['latitude'].tolist(), estado['longitude'].tolist(),
+        )
+        resultado = {}
+        for (identificador, linha, atual, proxima, terminal, status, lotacao, velocidade, segundos,
+             latitude, longitude) in colunas:
+            numero = self.linhas[linha]
+            resultado.setdefault(numero, []).append({
+                'identificador': identificador,
+                'linha': numero,
+                'estacao_atual': nomes[atual],
+                'proxima_estacao': nomes[proxima],
+                'status': STATUS[status],
+                'lotacao': LOTACAO[lotacao],
+                'velocidade': velocidade,
+                'previsao_chegada': (agora + timedelta(seconds=segundos)).isoformat(),
+                'direcao': nomes[terminal],
+                'latitude': latitude,
+                'longitude': longitude
+            })
+        return resultado
+
+    def trens_da_linha(self, linha):
+        """Trens de uma linha, avançando a simulação até agora"""
+        self.avancar()
+        return self.trens_por_linha([linha]).get(str(linha), [])
+
+
+# Instância global do serviço
+simulador_frota = SimuladorFrota()
@@ -11,7 +11,11 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
 from pathlib import Path
+import atexit
 import os
+import shutil
+import sys
+import tempfile
 from dotenv import load_dotenv
 
 # Carrega variáveis de ambiente
@@ -62,6 +66,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Primeiro da lista: mede a requisição inteira (Server-Timing e log por requisição)
+    'cptm_tracker.instrumentacao.InstrumentacaoMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
@@ -101,13 +107,48 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Com Redis disponível, o worker Celery alcança os WebSockets dos processos web
+if os.getenv('REDIS_URL'):
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': [os.getenv('REDIS_URL')],
+                'capacity': 100,
+                'expiry': 10,
+            },
+        },
+    }
+
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# SQLite com WAL: leitores não bloqueiam o escritor (atualizador de posições)
+# nem são bloqueados por ele. Os PRAGMAs são aplicados a cada nova conexão
+# (init_command); journal_mode=WAL fica gravado no arquivo do banco.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',  # com WAL, só o último commit pode se perder numa queda de energia
+    'busy_timeout': 20000,  # ms esperando o lock de escrita antes de "database is locked"
+    'mmap_size': int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+    'cache_size': -32000,  # KiB por conexão
+    'temp_store': 'MEMORY',
+}
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Conexões persistentes: evita reabrir o arquivo e reaplicar os PRAGMAs a cada requisição
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', 600)),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'timeout': 20,
+            # BEGIN IMMEDIATE: a transação pega o lock de escrita no início e espera
+            # pelo busy_timeout, em vez de falhar ao tentar promover um lock de leitura
+            'transaction_mode': 'IMMEDIATE',
+            'init_command': ';'.join(f'PRAGMA {nome}={valor}' for nome, valor in SQLITE_PRAGMAS.items()),
+        },
     }
 }
 
@@ -174,11 +215,51 @@ CORS_ALLOW_ALL_ORIGINS = DEBUG
 GOOGLE_MAPS_API_KEY = os.getenv('GOOGLE_MAPS_API_KEY', 'SUA_API_KEY_GOOGLE')
 OPENWEATHER_API_KEY = os.getenv('OPENWEATHER_API_KEY', 'SUA_API_KEY_OPENWEATHER')
 
-# Configurações de cache (usando DB cache para deploy gratuito)
+# Push notifications (OneSignal); ONESIGNAL_API_URL permite apontar para um servidor de testes
+ONESIGNAL_APP_ID = os.getenv('ONESIGNAL_APP_ID')
+ONESIGNAL_API_KEY = os.getenv('ONESIGNAL_API_KEY')
+ONESIGNAL_API_URL = os.getenv('ONESIGNAL_API_URL', 'https://onesignal.com/api/v1/notifications')
+
+# Estado de execução (cache em arquivos, histórico de posições, mmap da frota), fora do
+# código-fonte em produção via DADOS_DIR. Nos testes, um diretório temporário descartável.
+TESTANDO = sys.argv[1:2] == ['test']
+if TESTANDO:
+    DADOS_DIR = Path(tempfile.mkdtemp(prefix='cptm_tracker_testes_'))
+    atexit.register(shutil.rmtree, DADOS_DIR, True)
+else:
+    DADOS_DIR = Path(os.getenv('DADOS_DIR', BASE_DIR / 'dados'))
+
+def _caminho_dados(variavel, padrao):
+    """Caminho sob DADOS_DIR, sobrescrevível pela variável de ambiente (exceto nos testes)"""
+    return str(DADOS_DIR / padrao) if TESTANDO else os.getenv(variavel, str(DADOS_DIR / padrao))
+
+# Histórico de posições dos trens (arquivos colunares particionados por tempo)
+HISTORICO_POSICOES_DIR = _caminho_dados('HISTORICO_POSICOES_DIR', 'posicoes')
+
+# Estado atual da frota em memória compartilhada (mmap) entre os processos web
+FROTA_COMPARTILHADA_PATH = _caminho_dados('FROTA_COMPARTILHADA_PATH', 'frota.mmap')
+
+# Instrumentação por requisição (cptm_tracker/instrumentacao.py): header Server-Timing,
+# log JSON das requisições acima de INSTRUMENTACAO_LOG_MS (vazio = sem log) e alerta de N+1.
+# Fora do DEBUG o header (que expõe consultas e tempos) e o log só valem se ativados.
+INSTRUMENTACAO_HEADER = os.getenv('INSTRUMENTACAO_HEADER', str(DEBUG)).lower() == 'true'
+_instrumentacao_log_ms = os.getenv('INSTRUMENTACAO_LOG_MS', '500' if DEBUG else '')
+INSTRUMENTACAO_LOG_MS = float(_instrumentacao_log_ms) if _instrumentacao_log_ms else None
+INSTRUMENTACAO_N_MAIS_1 = os.getenv('INSTRUMENTACAO_N_MAIS_1', str(DEBUG)).lower() == 'true'
+INSTRUMENTACAO_LIMIAR_N_MAIS_1 = int(os.getenv('INSTRUMENTACAO_LIMIAR_N_MAIS_1', 5))
+
+# Configurações de cache
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
-        'LOCATION': 'cache_table',
+        # LRU em memória por processo + arquivos compartilhados entre os workers
+        # (cptm_tracker/cache.py); não disputa o lock de escrita do SQLite
+        'BACKEND': 'cptm_tracker.cache.CacheEmCamadas',
+        'LOCATION': _caminho_dados('CACHE_DIR', 'cache'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 2000,  # camada local
+            'TAMANHO_MAXIMO_LOCAL': 64 * 1024 * 1024,
+            'MAX_ENTRIES_COMPARTILHADO': 20000,
+        },
     }
 }
 
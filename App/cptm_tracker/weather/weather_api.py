@@ -1,11 +1,136 @@
 """
 Integração com APIs de clima
 """
+import math
+import threading
+import time
 import requests
 from django.conf import settings
+from django.core.cache import cache
+from cptm_tracker.instrumentacao import medir
 from datetime import datetime
 import random
 
+
+class CacheClima:
+    """Cache de clima por célula de grade, com TTL e stale-while-revalidate.
+
+    As coordenadas são quantizadas em células de ``tamanho_celula`` graus
+    (~5 km), então estações vizinhas compartilham a mesma consulta. Dentro de
+    ``ttl`` segundos a entrada é servida direto; entre ``ttl`` e ``ttl_maximo``
+    ela ainda é servida, mas uma atualização é disparada em segundo plano.
+    Faltas simultâneas da mesma célula geram uma única chamada ao provedor.
+    As entradas ficam em memória e no cache do Django (compartilhado entre
+    processos).
+
+    Se ``buscar`` falhar (levantar exceção), nada é guardado: serve-se a
+    última leitura real da célula, se houver, e a célula fica marcada como
+    indisponível por ``ttl_indisponivel`` segundos, sem novas chamadas.
+    """
+
+    CHAVE = 'clima:{}:{}'
+
+    def __init__(self, buscar, tamanho_celula=0.05, ttl=600, ttl_maximo=3600, espera_maxima=15,
+                 ttl_indisponivel=60):
+        self.buscar = buscar
+        self.tamanho_celula = tamanho_celula
+        self.ttl = ttl
+        self.ttl_maximo = ttl_maximo
+        self.espera_maxima = espera_maxima
+        self.ttl_indisponivel = ttl_indisponivel
+        self._lock = threading.Lock()
+        self._locais = {}
+        self._em_andamento = {}
+        self._indisponiveis = {}  # celula -> até quando não consultar o provedor
+
+    def celula(self, latitude, longitude):
+        return (math.floor(latitude / self.tamanho_celula), math.floor(longitude / self.tamanho_celula))
+
+    def centro(self, celula):
+        """Coordenadas do centro da célula, usadas na consulta ao provedor"""
+        return ((celula[0] + 0.5) * self.tamanho_celula, (celula[1] + 0.5) * self.tamanho_celula)
+
+    def obter(self, latitude, longitude, aguardar=True):
+        """Clima da célula do ponto.
+
+        Com ``aguardar=False`` nunca bloqueia: numa falta dispara a busca em
+        segundo plano e retorna None.
+        """
+        celula = self.celula(latitude, longitude)
+        entrada = self._entrada(celula)
+        if entrada is not None:
+            idade = time.time() - entrada['obtido_em']
+            if idade < self.ttl:
+                return entrada['dados']
+            if idade < self.ttl_maximo:
+                if not self._indisponivel(celula):
+                    self._atualizar(celula, segundo_plano=True)
+                return entrada['dados']
+
+        if self._indisponivel(celula):
+            return entrada['dados'] if entrada else None
+        if not aguardar:
+            self._atualizar(celula, segundo_plano=True)
+            return None
+        return self._atualizar(celula)
+
+    def _indisponivel(self, celula):
+        return self._indisponiveis.get(celula, 0) > time.time()
+
+    def _entrada(self, celula):
+        entrada = self._locais.get(celula)
+        if entrada is not None and time.time() - entrada['obtido_em'] < self.ttl:
+            return entrada
+        # Vencida ou ausente aqui: outro processo pode já ter atualizado
+        compartilhada = cache.get(self.CHAVE.format(*celula))
+        if compartilhada is not None and (entrada is None or compartilhada['obtido_em'] > entrada['obtido_em']):
+            with self._lock:
+                self._locais[celula] = compartilhada
+            entrada = compartilhada
+        return entrada
+
+    def _atualizar(self, celula, segundo_plano=False):
+        """Busca o clima da célula, agrupando chamadas concorrentes"""
+        with self._lock:
+            evento = self._em_andamento.get(celula)
+            responsavel = evento is None
+            if responsavel:
+                evento = self._em_andamento[celula] = threading.Event()
+
+        if not responsavel:
+            if segundo_plano:
+                return None
+            # Outra thread já está buscando esta célula: espera o resultado dela
+            evento.wait(self.espera_maxima)
+            entrada = self._locais.get(celula)
+            return entrada['dados'] if entrada else None
+
+        if segundo_plano:
+            threading.Thread(target=self._buscar_e_guardar, args=(celula, evento), daemon=True).start()
+            return None
+        return self._buscar_e_guardar(celula, evento)
+
+    def _buscar_e_guardar(self, celula, evento):
+        try:
+            dados = self.buscar(*self.centro(celula))
+            if dados is not None:
+                entrada = {'dados': dados, 'obtido_em': time.time()}
+                cache.set(self.CHAVE.format(*celula), entrada, self.ttl_maximo)
+                with self._lock:
+                    self._locais[celula] = entrada
+            return dados
+        except Exception as e:
+            print(f"Erro ao atualizar cache de clima: {e}")
+            with self._lock:
+                self._indisponiveis[celula] = time.time() + self.ttl_indisponivel
+            entrada = self._locais.get(celula)
+            return entrada['dados'] if entrada else None
+        finally:
+            with self._lock:
+                self._em_andamento.pop(celula, None)
+            evento.set()
+
+
 class ClimaService:
     def __init__(self):
         self.openweather_api_key = getattr(settings, 'OPENWEATHER_API_KEY', None)
@@ -15,52 +140,58 @@ class ClimaService:
             'lat': -23.5505,
             'lng': -46.6333
         }
+        
+        self.cache = CacheClima(self._buscar_clima)
+
+    def obter_clima_atual(self, latitude=None, longitude=None, aguardar=True):
+        """Obtém condições climáticas atuais (via cache por região).
 
-    def obter_clima_atual(self, latitude=None, longitude=None):
-        """Obtém condições climáticas atuais"""
+        Com ``aguardar=False`` (renderização de páginas) retorna None em vez de
+        esperar o provedor quando a região ainda não está em cache.
+        """
         if not latitude or not longitude:
             latitude = self.sao_paulo_coords['lat']
             longitude = self.sao_paulo_coords['lng']
         
+        return self.cache.obter(latitude, longitude, aguardar=aguardar)
+
+    def _buscar_clima(self, latitude, longitude):
+        """Consulta o provedor de clima, sem cache (simulação só sem chave de API)"""
         if self.openweather_api_key:
             return self._obter_clima_openweather(latitude, longitude)
         else:
             return self._simular_clima()
 
     def _obter_clima_openweather(self, lat, lng):
-        """Usa OpenWeatherMap API"""
-        try:
-            url = "http://api.openweathermap.org/data/2.5/weather"
-            params = {
-                'lat': lat,
-                'lon': lng,
-                'appid': self.openweather_api_key,
-                'units': 'metric',
-                'lang': 'pt_br'
-            }
-            
+        """Usa OpenWeatherMap API (levanta exceção se o provedor falhar)"""
+        url = "http://api.openweathermap.org/data/2.5/weather"
+        params = {
+            'lat': lat,
+            'lon': lng,
+            'appid': self.openweather_api_key,
+            'units': 'metric',
+            'lang': 'pt_br'
+        }
+
+        with medir('externo'):
             response = requests.get(url, params=params, timeout=10)
-            if response.status_code == 200:
-                data = response.json()
-                return {
-                    'temperatura': data['main']['temp'],
-                    'sensacao_termica': data['main']['feels_like'],
-                    'umidade': data['main']['humidity'],
-                    'pressao': data['main']['pressure'],
-                    'vento_velocidade': data['wind']['speed'] * 3.6,  # Convert m/s to km/h
-                    'vento_direcao': data['wind'].get('deg', 0),
-                    'condicao': data['weather'][0]['main'].lower(),
-                    'descricao': data['weather'][0]['description'],
-                    'visibilidade': data.get('visibility', 10000) / 1000,  # Convert m to km
-                    'chuva_1h': data.get('rain', {}).get('1h', 0),
-                    'neve_1h': data.get('snow', {}).get('1h', 0),
-                    'atualizado_em': datetime.now().isoformat(),
-                    'fonte': 'OpenWeatherMap'
-                }
-        except Exception as e:
-            print(f"Erro ao obter clima OpenWeather: {e}")
-        
-        return self._simular_clima()
+        response.raise_for_status()
+        data = response.json()
+        return {
+            'temperatura': data['main']['temp'],
+            'sensacao_termica': data['main']['feels_like'],
+            'umidade': data['main']['humidity'],
+            'pressao': data['main']['pressure'],
+            'vento_velocidade': data['wind']['speed'] * 3.6,  # Convert m/s to km/h
+            'vento_direcao': data['wind'].get('deg', 0),
+            'condicao': data['weather'][0]['main'].lower(),
+            'descricao': data['weather'][0]['description'],
+            'visibilidade': data.get('visibility', 10000) / 1000,  # Convert m to km
+            'chuva_1h': data.get('rain', {}).get('1h', 0),
+            'neve_1h': data.get('snow', {}).get('1h', 0),
+            'atualizado_em': datetime.now().isoformat(),
+            'fonte': 'OpenWeatherMap'
+        }
 
     def _simular_clima(self):
         """Simula dados climáticos para demonstração"""
@@ -3,14 +3,22 @@ Tarefas automatizadas para atualização de dados em tempo real
 """
 from celery import Celery
 from django.conf import settings
+from django.utils import timezone
 from datetime import datetime, timedelta
 import random
-from apps.models import Trem, Linha, Estacao, CondiciaoClimatica, NotificacaoUsuario
+from apps.models import Trem, Linha, CondiciaoClimatica
 from cptm_tracker.services.cptm_api import cptm_service
+from cptm_tracker.services.frota import frota_service
+from cptm_tracker.services.estacoes import estacoes_service
+from cptm_tracker.services.ingestao import ingerir_posicoes
+from cptm_tracker.services.escrita import fila_escrita
+from cptm_tracker.services.eta import eta_service
+from cptm_tracker.services.historico_posicoes import historico_posicoes
+from cptm_tracker.services.retencao import executar_retencao
 from cptm_tracker.weather.weather_api import clima_service
 from cptm_tracker.notifications.push import notificacao_service
+from cptm_tracker.notifications.assinantes import assinantes_service
 from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
 
 # Configuração do Celery
 app = Celery('cptm_tracker')
@@ -24,76 +32,25 @@ def atualizar_posicoes_trens():
     try:
         linhas = Linha.objects.filter(ativa=True)
         
-        for linha in linhas:
-            # Simular posições dos trens
-            trens_simulados = cptm_service.simular_posicao_trens(linha.numero)
-            
-            for trem_data in trens_simulados:
-                trem, created = Trem.objects.get_or_create(
-                    identificador=trem_data['identificador'],
-                    defaults={
-                        'linha': linha,
-                        'status': trem_data['status'],
-                        'lotacao': trem_data['lotacao'],
-                        'velocidade': trem_data['velocidade'],
-                        'direcao': trem_data['direcao'],
-                        'latitude_atual': trem_data['latitude'],
-                        'longitude_atual': trem_data['longitude'],
-                    }
-                )
-                
-                if not created:
-                    # Atualizar posição existente
-                    trem.status = trem_data['status']
-                    trem.lotacao = trem_data['lotacao']
-                    trem.velocidade = trem_data['velocidade']
-                    trem.latitude_atual = trem_data['latitude']
-                    trem.longitude_atual = trem_data['longitude']
-                    
-                    # Atualizar estação atual se mudou
-                    if trem_data.get('estacao_atual'):
-                        try:
-                            estacao_atual = Estacao.objects.get(nome=trem_data['estacao_atual'])
-                            trem.estacao_atual = estacao_atual
-                        except Estacao.DoesNotExist:
-                            pass
-                    
-                    # Atualizar próxima estação
-                    if trem_data.get('proxima_estacao'):
-                        try:
-                            proxima_estacao = Estacao.objects.get(nome=trem_data['proxima_estacao'])
-                            trem.proxima_estacao = proxima_estacao
-                            
-                            # Calcular previsão de chegada
-                            if trem.velocidade > 0:
-                                # Estimativa simples baseada na velocidade
-                                minutos_chegada = random.randint(2, 8)
-                                trem.previsao_chegada = datetime.now() + timedelta(minutes=minutos_chegada)
-                        except Estacao.DoesNotExist:
-                            pass
-                    
-                    trem.save()
-                
-                # Enviar atualização via WebSocket
-                if channel_layer:
-                    async_to_sync(channel_layer.group_send)(
-                        "trens_real_time",
-                        {
-                            'type': 'trem_update',
-                            'data': {
-                                'id': trem.id,
-                                'identificador': trem.identificador,
-                                'latitude': trem.latitude_atual,
-                                'longitude': trem.longitude_atual,
-                                'status': trem.status,
-                                'lotacao': trem.lotacao,
-                                'velocidade': trem.velocidade,
-                                'linha': linha.numero
-                            }
-                        }
-                    )
+        # Simular posições dos trens de todas as linhas e gravar o ciclo em lote
+        trens_por_linha = [
+            (linha, cptm_service.simular_posicao_trens(linha.numero))
+            for linha in linhas
+        ]
+        # Gravação pela fila de escrita: uma transação curta por ciclo, sem
+        # disputar o lock com outras escritas do processo
+        estatisticas = fila_escrita.executar(ingerir_posicoes, trens_por_linha, chave='posicoes')
+        
+        # Publicar snapshot pré-serializado do ciclo para a API e enviar
+        # via WebSocket um lote por linha apenas com os trens alterados
+        frota_service.publicar_do_banco()
+        frota_service.transmitir(channel_layer)
         
-        print(f"Posições dos trens atualizadas: {datetime.now()}")
+        print(
+            f"Posições dos trens atualizadas: {datetime.now()} - "
+            f"{estatisticas['criados']} criados, {estatisticas['atualizados']} atualizados, "
+            f"{estatisticas['consultas']} consultas em {estatisticas['duracao_ms']:.1f} ms"
+        )
         return True
         
     except Exception as e:
@@ -104,34 +61,25 @@ def atualizar_posicoes_trens():
 def verificar_chegadas_trens():
     """Verifica chegadas iminentes e envia notificações"""
     try:
-        # Buscar trens com previsão de chegada nos próximos 5 minutos
-        agora = datetime.now()
+        # Buscar trens com previsão de chegada nos próximos 5 minutos,
+        # apenas para estações que têm algum usuário inscrito
+        agora = timezone.now()
         limite_notificacao = agora + timedelta(minutes=5)
+        assinantes = assinantes_service.obter()
         
         trens_chegando = Trem.objects.filter(
             previsao_chegada__gte=agora,
             previsao_chegada__lte=limite_notificacao,
-            proxima_estacao__isnull=False
+            proxima_estacao_id__in=assinantes.estacoes_com_assinantes()
         ).select_related('linha', 'proxima_estacao')
         
         for trem in trens_chegando:
             minutos_chegada = int((trem.previsao_chegada - agora).total_seconds() / 60)
             
-            # Buscar usuários interessados nesta estação
-            usuarios_interessados = set()
-            
-            # Usuários com estação nos favoritos
-            preferencias = trem.proxima_estacao.preferenciasUsuario_set.filter(
-                notificar_chegada=True
+            # Enviar notificações em lote aos inscritos na estação
+            notificacao_service.notificar_chegada(
+                assinantes.chegada(trem.proxima_estacao_id), trem, trem.proxima_estacao, minutos_chegada
             )
-            for pref in preferencias:
-                usuarios_interessados.add(pref.usuario)
-            
-            # Enviar notificações
-            for usuario in usuarios_interessados:
-                notificacao_service.enviar_notificacao_chegada(
-                    usuario, trem, trem.proxima_estacao, minutos_chegada
-                )
         
         print(f"Verificação de chegadas concluída: {len(trens_chegando)} trens")
         return True
@@ -145,9 +93,12 @@ def atualizar_condicoes_climaticas():
     """Atualiza condições climáticas para as principais estações"""
     try:
         # Selecionar algumas estações principais para monitoramento climático
-        estacoes_principais = Estacao.objects.filter(
-            nome__in=['Luz', 'Sé', 'Brás', 'Osasco', 'Santo André', 'Mogi das Cruzes']
-        )
+        registro = estacoes_service.obter()
+        estacoes_principais = [
+            estacao
+            for nome in ['Luz', 'Sé', 'Brás', 'Osasco', 'Santo André', 'Mogi das Cruzes']
+            for estacao in registro.todas_por_nome(nome)
+        ]
         
         for estacao in estacoes_principais:
             # Obter dados climáticos
@@ -176,7 +127,7 @@ def atualizar_condicoes_climaticas():
                 
                 # Criar ou atualizar condição climática
                 condicao_climatica, created = CondiciaoClimatica.objects.update_or_create(
-                    estacao=estacao,
+                    estacao_id=estacao.id,
                     defaults={
                         'condicao': condicao,
                         'temperatura': clima_data['temperatura'],
@@ -219,17 +170,10 @@ def simular_eventos_operacionais():
                 motivo = random.choice(motivos)
                 
                 # Notificar usuários da linha
-                from django.contrib.auth.models import User
-                usuarios = User.objects.filter(
-                    preferencias__linhas_favoritas=linha,
-                    preferencias__notificar_atraso=True
+                notificacao_service.notificar_atraso(
+                    assinantes_service.obter().atraso(linha.id), linha, estacao, motivo
                 )
                 
-                for usuario in usuarios:
-                    notificacao_service.enviar_notificacao_atraso(
-                        usuario, linha, estacao, motivo
-                    )
-                
                 print(f"Evento de atraso simulado na {linha.nome}")
             
             elif evento_tipo == 'superlotacao':
@@ -242,6 +186,9 @@ def simular_eventos_operacionais():
                     if random.random() < 0.3:  # 30% chance
                         trem.lotacao = 'superlotado'
                         trem.save()
+                
+                frota_service.publicar_do_banco()
+                frota_service.transmitir(channel_layer)
         
         return True
         
@@ -250,20 +197,42 @@ def simular_eventos_operacionais():
         return False
 
 @app.task
-def limpar_dados_antigos():
-    """Remove dados antigos para manter performance"""
+def recalcular_tabela_eta():
+    """Recalcula as medianas de tempo por trecho e hora da semana a partir do histórico"""
+    try:
+        tabela = eta_service.recalcular()
+        print(f"Tabela de ETA recalculada: {len(tabela.segmentos)} trechos, {tabela.amostras} amostras")
+        return True
+        
+    except Exception as e:
+        print(f"Erro ao recalcular tabela de ETA: {e}")
+        return False
+
+@app.task
+def consolidar_historico_posicoes():
+    """Gera as médias de 1 e 15 minutos das partições fechadas e aplica a retenção"""
     try:
-        # Remover notificações antigas (mais de 30 dias)
-        data_limite = datetime.now() - timedelta(days=30)
-        NotificacaoUsuario.objects.filter(
-            criada_em__lt=data_limite
-        ).delete()
+        resumo = historico_posicoes.consolidar()
+        print(
+            f"Histórico de posições consolidado: {resumo['1min']} partições em 1 min, "
+            f"{resumo['15min']} em 15 min, {resumo['removidas']} removidas"
+        )
+        return True
         
-        # Limpar condições climáticas antigas (mais de 7 dias)
-        data_limite_clima = datetime.now() - timedelta(days=7)
-        CondiciaoClimatica.objects.filter(
-            atualizada_em__lt=data_limite_clima
-        ).delete()
+    except Exception as e:
+        print(f"Erro ao consolidar histórico de posições: {e}")
+        return False
+
+@app.task
+def limpar_dados_antigos():
+    """Remove dados antigos para manter performance (políticas em services/retencao.py)"""
+    try:
+        for resultado in executar_retencao():
+            print(
+                f"Retenção {resultado['modelo']}: {resultado['removidos']} removidos em "
+                f"{resultado['lotes']} lotes, {resultado['linhas_por_segundo']:.0f} linhas/s"
+                f"{' (delete direto)' if resultado['rapido'] else ''}"
+            )
         
         print(f"Limpeza de dados concluída: {datetime.now()}")
         return True
@@ -288,6 +257,14 @@ app.conf.beat_schedule = {
         'task': 'tasks.atualizar_condicoes_climaticas',
         'schedule': crontab(minute='*/15'),  # A cada 15 minutos
     },
+    'recalcular-eta': {
+        'task': 'tasks.recalcular_tabela_eta',
+        'schedule': crontab(minute='*/15'),  # A cada 15 minutos
+    },
+    'consolidar-historico-posicoes': {
+        'task': 'tasks.consolidar_historico_posicoes',
+        'schedule': crontab(minute=5),  # A cada hora, após o fechamento da partição
+    },
     'simular-eventos': {
         'task': 'tasks.simular_eventos_operacionais',
         'schedule': crontab(minute='*/5'),  # A cada 5 minutos